@@ -1,8 +1,6 @@
 """
 Configurations of the models for admin panel.
 """
-import xlwt
-from daterangefilter.filters import PastDateRangeFilter
 from apps.auth_.forms import (MainUserChangeForm,
                               MainUserCreationForm,
                               CompanyUserForm,
@@ -10,15 +8,30 @@ from apps.auth_.forms import (MainUserChangeForm,
                               FanDiscountForm)
 from apps.auth_.models import (Activation, MainUser, Company,
                                UserCompany, CompanyDiscount,
-                               FanDiscount)
+                               FanDiscount, UserExport, SmsMessage)
+from apps.auth_.discounts import get_fan_discount_label, get_fan_catalog_version
+from apps.auth_.exports import export_response
+from apps.auth_.instrumentation import record_cache
+from apps.auth_.paginators import KeysetAutocompleteMixin, KeysetAdminMixin
+from apps.auth_.search import search_users, search_discounts, SEARCH_ORDERING
 from dal import autocomplete
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
+import hashlib
 
+EXPORT_BACKGROUND_THRESHOLD = getattr(settings, 'USER_EXPORT_BACKGROUND_THRESHOLD', 50000)
+# autocomplete of discounts returns at most this amount of results for one query
+DISCOUNT_AUTOCOMPLETE_MAX_ROWS = getattr(settings, 'DISCOUNT_AUTOCOMPLETE_MAX_ROWS', 100)
+# results of queries which are not longer are cached
+DISCOUNT_AUTOCOMPLETE_CACHE_LENGTH = getattr(settings, 'DISCOUNT_AUTOCOMPLETE_CACHE_LENGTH', 3)
+DISCOUNT_AUTOCOMPLETE_CACHE_TIMEOUT = getattr(settings, 'DISCOUNT_AUTOCOMPLETE_CACHE_TIMEOUT',
+                                              60 * 60)
 
-class UserAutocomplete(autocomplete.Select2QuerySetView):
+
+class UserAutocomplete(KeysetAutocompleteMixin, autocomplete.Select2QuerySetView):
     """
     To search users by phone, full_name or username.
 
@@ -29,9 +42,12 @@ class UserAutocomplete(autocomplete.Select2QuerySetView):
     get_queryset(self)
         to search user by phone, full_name or username and autocomplete
     """
+    keyset_ordering = SEARCH_ORDERING
+
     def get_queryset(self):
         """
-        To search user by phone, full_name or username and autocomplete
+        To search user by phone, full_name or username and autocomplete.
+        Results are ranked by similarity and paginated by keyset.
         :return: queryset of the users which is compatible with the request
         :rtype: queryset
         """
@@ -39,20 +55,14 @@ class UserAutocomplete(autocomplete.Select2QuerySetView):
                     self.request.user.is_staff)):
             return MainUser.objects.none()
 
-        qs = MainUser.objects.all()
-
-        if self.q:
-            qs = qs.filter(
-                Q(phone__icontains=self.q) | Q(full_name__icontains=self.q) | Q(
-                    username__icontains=self.q)
-            )
-
-        return qs
+        return search_users(self.q)
 
 
-class CompanyDiscountAutocomplete(autocomplete.Select2QuerySetView):
+class CompanyDiscountAutocomplete(KeysetAutocompleteMixin, autocomplete.Select2QuerySetView):
     """
-    Class to search and autocomplete the entered request
+    Class to search and autocomplete the entered request. Results of short queries are
+    cached for the version of the fan catalog, which is changed with companies and
+    discounts.
 
     ...
 
@@ -60,11 +70,18 @@ class CompanyDiscountAutocomplete(autocomplete.Select2QuerySetView):
     -------
     get_queryset(self)
         Filter the queryset by entered company name ot description of the discount
+    get(self, request, *args, **kwargs)
+        returns results from the cache for short queries
     """
+    keyset_ordering = SEARCH_ORDERING
+    keyset_max_rows = DISCOUNT_AUTOCOMPLETE_MAX_ROWS
+
     def get_queryset(self):
         """
         Checks for the authentication and that the user is staff in the admin
-        and search by companies' name and description of the discount
+        and search by companies' name and description of the discount.
+        Results are ranked by similarity and paginated by keyset, companies are selected
+        in the same query for labels of the discounts.
         :return: queryset of the companyDiscount model which is filtered by request
         :rtype: queryset of the class CompanyDiscount
         """
@@ -72,34 +89,54 @@ class CompanyDiscountAutocomplete(autocomplete.Select2QuerySetView):
                     self.request.user.is_staff)):
             return CompanyDiscount.objects.none()
 
-        qs = CompanyDiscount.objects.all()
-
-        if self.q:
-            qs = qs.filter(
-                Q(company__name__icontains=self.q) | Q(description__icontains=self.q)
-            )
+        return search_discounts(self.q).select_related('company')
 
-        return qs
+    def get(self, request, *args, **kwargs):
+        """
+        Returns json with results. Queries not longer than DISCOUNT_AUTOCOMPLETE_CACHE_LENGTH
+        are read from the cache, they match most of the discounts and are the slowest.
+        :return: json response of select2
+        """
+        if len(self.q) > DISCOUNT_AUTOCOMPLETE_CACHE_LENGTH or \
+                not (request.user.is_authenticated and request.user.is_staff):
+            return super().get(request, *args, **kwargs)
+        key = 'discount_autocomplete:{}:{}'.format(
+            get_fan_catalog_version(),
+            hashlib.md5('{}:{}'.format(self.q.lower(), request.GET.get(self.page_kwarg, 1))
+                        .encode('utf-8')).hexdigest())
+        content = cache.get(key)
+        record_cache('discount_autocomplete', content is not None)
+        if content is None:
+            response = super().get(request, *args, **kwargs)
+            content = response.content
+            cache.set(key, content, DISCOUNT_AUTOCOMPLETE_CACHE_TIMEOUT)
+        return HttpResponse(content, content_type='application/json')
 
 
 @admin.register(MainUser)
-class MainUserAdmin(UserAdmin):
+class MainUserAdmin(KeysetAdminMixin, UserAdmin):
     """
     Model admin for MainUser class.
     Setted creation form and change form of the user.
     Changed fields which will be represented in the list of the objects,
     in the change form and add form. Has filter by created date and search by username.
+    List is paginated by keyset on (username, id) and big lists are counted by estimate.
 
     ...
 
     Methods
     -------
+    get_list_filter(self, request)
+        returns filter by created date
+    export(self, request, queryset, file_format)
+        streams selected users to the file or schedules export in the background
     export_xlsx(self, request, queryset)
         custom action in the admin to export users in excel
+    export_csv(self, request, queryset)
+        custom action in the admin to export users in csv
     """
     form = MainUserChangeForm
     add_form = MainUserCreationForm
-    list_filter = (('created_at', PastDateRangeFilter),)
     list_display = ('id', 'email', 'full_name')
     fieldsets = (
         ('Main Fields', dict(fields=(
@@ -121,9 +158,46 @@ class MainUserAdmin(UserAdmin):
             'fields': ('email',)}
          ),
     )
-    ordering = ['username']
+    ordering = ['username', 'id']
+    keyset_ordering = ('username', 'id')
     search_fields = ['username']
-    actions = ['export_xlsx']
+    actions = ['export_xlsx', 'export_csv']
+
+    def get_list_filter(self, request):
+        """
+        Returns filter by created date. Filter is imported only when the list is opened,
+        so workers and management commands don't load daterangefilter.
+        """
+        from daterangefilter.filters import PastDateRangeFilter
+        return (('created_at', PastDateRangeFilter),)
+
+    def export(self, request, queryset, file_format):
+        """
+        Exports selected users to the file. Small selections are streamed in the response,
+        big selections are scheduled to be built in the background and then the file can be
+        downloaded from the list of exports.
+        :param request: request of the action
+        :param queryset: queryset of the users which the user picked in the admin
+        :param file_format: csv or xlsx
+        :return: streaming response with the file or None if export is scheduled
+        """
+        if queryset.count() > EXPORT_BACKGROUND_THRESHOLD:
+            UserExport.objects.schedule(queryset, file_format, user=request.user)
+            self.message_user(request, 'Выгрузка поставлена в очередь, файл будет доступен '
+                                       'в разделе "Выгрузки пользователей"')
+            return None
+        return export_response(queryset, file_format)
+
+    def export_csv(self, request, queryset):
+        """
+        Function to export to csv file list of users.
+        :param request: request of the action
+        :param queryset: queryset of the users which the user picked in the admin
+        :return: csv file
+        """
+        return self.export(request, queryset, UserExport.CSV)
+
+    export_csv.short_description = "Скачать данные (CSV)"
 
     def export_xlsx(self, request, queryset):
         """
@@ -132,37 +206,7 @@ class MainUserAdmin(UserAdmin):
         :param queryset: queryset of the users which the user picked in the admin
         :return: excel file
         """
-        response = HttpResponse(content_type='application/ms-excel')
-        response['Content-Disposition'] = 'attachment; filename="users.xls"'
-        wb = xlwt.Workbook(encoding='utf-8')
-        ws = wb.add_sheet('Пользователи')
-        row_num = 0
-
-        font_style = xlwt.XFStyle()
-        font_style.font.bold = True
-
-        columns = [
-            "ID",
-            "Почта",
-            "Полное имя"
-        ]
-
-        for col_num in range(len(columns)):
-            ws.write(row_num, col_num, columns[col_num], font_style)
-
-        font_style = xlwt.XFStyle()
-
-        for s in queryset:
-            row_num += 1
-            row = [
-                s.id,
-                s.email,
-                s.full_name,
-            ]
-            for col_num in range(len(row)):
-                ws.write(row_num, col_num, row[col_num], font_style)
-        wb.save(response)
-        return response
+        return self.export(request, queryset, UserExport.XLSX)
 
     export_xlsx.short_description = "Скачать данные"
 
@@ -195,6 +239,7 @@ class UserCompanyAdmin(admin.ModelAdmin):
     """
     form = CompanyUserForm
     list_display = ('user', 'company')
+    list_select_related = ('user', 'company')
     fieldsets = (
         ('Main', {'fields': ('user', 'company', 'isEmployer', 'position')}),
         ('Discounts of companies', {'fields': ('company_discount',)})
@@ -210,6 +255,7 @@ class CompanyDiscountAdmin(admin.ModelAdmin):
     """
     form = CompanyDiscountForm
     list_display = ('company', 'percent', 'amount', 'description')
+    list_select_related = ('company', )
 
 
 @admin.register(FanDiscount)
@@ -232,13 +278,42 @@ class FanDiscountAdmin(admin.ModelAdmin):
     def get_company_discounts(self, obj):
         """
         Returns company name, discount in percent or tenge and description which is setted
-        to the FanDiscount
+        to the FanDiscount. Labels of all rows are taken from one snapshot of the fan
+        catalog, so the list doesn't query discounts per row.
         :param obj: FanDiscount object
         :return: string of the setted company discounts with name of the company,
         discount and description of the discount
         """
-        company_discounts = ""
-        for d in obj.company_discounts.all():
-            company_discounts += f"{d.__str__()}, "
-        return company_discounts
+        return get_fan_discount_label(obj.pk)
     get_company_discounts.short_description = "Скидки компании"
+
+
+@admin.register(UserExport)
+class UserExportAdmin(admin.ModelAdmin):
+    """
+    Model admin for class UserExport to download files which are built in the background.
+    """
+    list_display = ('id', 'file_format', 'status', 'rows', 'file', 'created_by',
+                    'created_at', 'finished_at')
+    list_filter = ('status', 'file_format')
+    list_select_related = ('created_by', )
+    exclude = ('user_ids', )
+    readonly_fields = ('file_format', 'status', 'rows', 'attempts', 'file', 'created_by',
+                       'created_at', 'started_at', 'finished_at')
+
+    def has_add_permission(self, request):
+        """
+        Exports are created only by the action in the list of users
+        """
+        return False
+
+
+@admin.register(SmsMessage)
+class SmsMessageAdmin(admin.ModelAdmin):
+    """
+    Model admin for queue of sms to watch failed and dead messages.
+    """
+    list_display = ('phone', 'status', 'attempts', 'created_at', 'sent_at', 'last_error')
+    list_filter = ('status', )
+    search_fields = ['phone']
+    exclude = ('code', )
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class AuthConfig(AppConfig):
     name = 'apps.auth_'
+
+    def ready(self):
+        from django.core import checks
+        from apps.auth_ import signals  # noqa
+        from apps.auth_.qr import check_base_url
+        checks.register(check_base_url)
@@ -0,0 +1,42 @@
+"""
+Authentication of users by jwt token without loading the user from the database.
+"""
+from django.utils.translation import gettext as _
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+
+from apps.auth_.user_cache import get_cached_user
+
+
+class CachedJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    JWT authentication which takes the user from the two-level user cache.
+    Use it in REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] together with
+    apps.auth_.token.jwt_decode_handler.
+
+    ...
+
+    Methods
+    -------
+    authenticate_credentials(self, payload)
+        returns active user by id from the payload
+    """
+
+    def authenticate_credentials(self, payload):
+        """
+        Returns active user whose id is in the payload of the token
+        :param payload: verified payload of the token
+        :type payload: dict
+        :raises: :class:`AuthenticationFailed`: there is no such user or user isn't active
+        :return: user with cached fields
+        :rtype: class MainUser
+        """
+        user_id = payload.get('user_id')
+        if not user_id:
+            raise exceptions.AuthenticationFailed(_('Invalid payload.'))
+        user = get_cached_user(user_id)
+        if user is None:
+            raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User account is disabled.'))
+        return user
@@ -0,0 +1,259 @@
+"""
+Benchmarks of the login and scan flows. Real endpoints are called by the test client
+with the fake sms provider, latency percentiles, amount of queries and allocated memory
+are measured and compared with the saved baseline.
+"""
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from apps.auth_ import ratelimit
+from apps.auth_.models import Activation, Company, CompanyDiscount, UserCompany, FanDiscount
+from apps.auth_.sms_providers import InMemorySmsProvider, set_sms_provider
+from apps.auth_.token import get_token
+from apps.utils import constants
+
+User = get_user_model()
+
+BENCHMARK_BASELINE_PATH = getattr(
+    settings, 'AUTH_BENCHMARK_BASELINE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks_baseline.json'))
+BENCHMARK_THRESHOLD = getattr(settings, 'AUTH_BENCHMARK_THRESHOLD', 0.2)
+BENCHMARK_COMPANIES = 10
+BENCHMARK_DISCOUNTS = 5
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                'LOCATION': 'auth-benchmarks'}}
+
+
+def percentile(values, percent):
+    """
+    Returns percentile of the values (nearest rank)
+    :param values: measured values
+    :type values: list
+    :param percent: percent from 0 to 100
+    :type percent: int
+    :return: value of the percentile
+    :rtype: float
+    """
+    values = sorted(values)
+    index = max(int(round(percent / 100 * len(values))) - 1, 0)
+    return values[index]
+
+
+def measure(func, iterations, prepare=None):
+    """
+    Calls func several times. Latency and queries are measured in the first pass,
+    allocations are measured in the separate pass, because tracing slows down calls.
+    :param func: measured function, takes result of prepare
+    :param iterations: amount of calls
+    :type iterations: int
+    :param prepare: function which is called before each call and is not measured
+    :return: latency percentiles in milliseconds, amount of queries and allocated kilobytes
+    :rtype: dict
+    """
+    prepare = prepare or (lambda: None)
+    func(prepare())
+    latencies, queries = [], []
+    for _ in range(iterations):
+        argument = prepare()
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            func(argument)
+            latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(len(context))
+    argument = prepare()
+    tracemalloc.start()
+    func(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'p50': round(percentile(latencies, 50), 3),
+        'p95': round(percentile(latencies, 95), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'queries': max(queries),
+        'allocated_kb': round(peak / 1024, 1),
+    }
+
+
+class AuthBenchmarks:
+    """
+    Scenarios of the login and scan flows.
+
+    ...
+
+    Methods
+    -------
+    setup(self)
+        creates users, companies, discounts and QR code
+    run(self, iterations)
+        measures all scenarios
+    """
+
+    def __init__(self):
+        self.client = APIClient()
+        self.phone_counter = 0
+
+    def next_phone(self):
+        """
+        Returns new phone for each activation, so recent activations are not reused
+        :rtype: str
+        """
+        self.phone_counter += 1
+        return '+7701{:07d}'.format(self.phone_counter)
+
+    def setup(self):
+        """
+        Creates employee with discounts of several companies, the same discounts for fans
+        and QR code of the employee
+        """
+        self.user = User.objects.create(username='+77010000000', phone='+77010000000',
+                                        status=constants.EMPLOYEE)
+        employer = Company.objects.create(name='Employer')
+        user_company = UserCompany.objects.create(user=self.user, company=employer,
+                                                  isEmployer=True, position='Manager')
+        fan_discount = FanDiscount.objects.create()
+        for i in range(BENCHMARK_COMPANIES):
+            company = Company.objects.create(name='Company {}'.format(i))
+            for j in range(BENCHMARK_DISCOUNTS):
+                discount = CompanyDiscount.objects.create(company=company, percent=j + 1)
+                user_company.company_discount.add(discount)
+                fan_discount.company_discounts.add(discount)
+        qr_model = User._meta.get_field('qrcode').related_model
+        self.code = str(uuid.uuid4())
+        qr_model.objects.create(user=self.user, code=self.code)
+
+    def authenticate(self):
+        """
+        Sets token of the user to the client
+        """
+        self.client.credentials(HTTP_AUTHORIZATION='JWT ' + get_token(self.user))
+
+    def new_activation(self):
+        """
+        Creates activation which is not measured
+        :rtype: class Activation
+        """
+        return Activation.objects.generate_sms(phone=self.next_phone())
+
+    def scenarios(self):
+        """
+        Returns measured scenarios
+        :return: name, function and prepare function of each scenario
+        :rtype: list of tuples
+        """
+        client = self.client
+        return [
+            ('activation_create',
+             lambda _: client.post(reverse('auth_:activation-list'),
+                                   {'phone': self.next_phone()}, format='json'),
+             None),
+            ('activation_activate',
+             lambda activation: client.post(
+                 reverse('auth_:activation-activate', kwargs={'pk': activation.id}),
+                 {'code': activation.code}, format='json'),
+             self.new_activation),
+            ('activation_resend',
+             lambda activation: client.get(
+                 reverse('auth_:activation-resend', kwargs={'pk': activation.id})),
+             self.new_activation),
+            ('token_refresh',
+             lambda token: client.post(reverse('auth_:token-refresh'), {'token': token},
+                                       format='json'),
+             lambda: get_token(User.objects.get(id=self.user.id))),
+            ('user_get',
+             lambda _: client.get(reverse('auth_:user-get')),
+             self.authenticate),
+            ('user_update_profile',
+             lambda _: client.put(reverse('auth_:user-update-profile'),
+                                  {'full_name': 'Test User'}, format='json'),
+             self.authenticate),
+            ('user_detail',
+             lambda _: client.get(reverse('auth_:user-info', kwargs={'code': self.code})),
+             None),
+        ]
+
+    def run(self, iterations):
+        """
+        Measures all scenarios with the fake sms provider, without rate limits and with
+        the cache of the process, so ids of the benchmark users never get into the shared
+        cache of the project
+        :param iterations: amount of calls of each scenario
+        :type iterations: int
+        :return: results by name of scenario
+        :rtype: dict
+        """
+        set_sms_provider(InMemorySmsProvider())
+        limits = {activation_type: {} for activation_type, _ in constants.ACTIVATION_TYPES}
+        try:
+            with override_settings(SMS_ON=True, CACHES=BENCHMARK_CACHES), \
+                    mock.patch.object(ratelimit, 'ACTIVATION_RATE_LIMITS', limits):
+                self.setup()
+                return {name: measure(func, iterations, prepare)
+                        for name, func, prepare in self.scenarios()}
+        finally:
+            set_sms_provider(None)
+
+
+def load_baseline(path=BENCHMARK_BASELINE_PATH):
+    """
+    Loads saved results
+    :param path: path of the baseline file
+    :type path: str
+    :return: results by name of scenario, empty if there is no baseline
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baseline(results, path=BENCHMARK_BASELINE_PATH):
+    """
+    Saves results as the new baseline
+    :param results: results by name of scenario
+    :type results: dict
+    :param path: path of the baseline file
+    :type path: str
+    """
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def find_regressions(results, baseline, threshold=BENCHMARK_THRESHOLD):
+    """
+    Compares results with the baseline. Latency (p95) and allocations may grow by threshold,
+    amount of queries must not grow at all.
+    :param results: results by name of scenario
+    :type results: dict
+    :param baseline: baseline results by name of scenario
+    :type baseline: dict
+    :param threshold: allowed relative growth, 0.2 means 20%
+    :type threshold: float
+    :return: descriptions of regressions
+    :rtype: list of str
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['queries'] > base['queries']:
+            regressions.append('{}: queries {} > {}'.format(
+                name, result['queries'], base['queries']))
+        for metric in ('p95', 'allocated_kb'):
+            if result[metric] > base[metric] * (1 + threshold):
+                regressions.append('{}: {} {} > {} (+{:.0%})'.format(
+                    name, metric, result[metric], base[metric],
+                    result[metric] / base[metric] - 1 if base[metric] else 1))
+    return regressions
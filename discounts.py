@@ -0,0 +1,332 @@
+"""
+Resolution of discounts which are shown on the user's QR scan page.
+Discounts of fans are the same for everybody, so they are kept in the cache as
+a versioned snapshot which is rebuilt by one process at a time.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from apps.auth_.instrumentation import record_cache
+from apps.auth_.models import UserCompany, FanDiscount
+from apps.utils import constants
+
+FAN_CATALOG_TIMEOUT = getattr(settings, 'FAN_CATALOG_TIMEOUT', 24 * 60 * 60)
+# seconds, the lock is released by timeout if the process which rebuilds the catalog dies
+FAN_CATALOG_LOCK_TIMEOUT = getattr(settings, 'FAN_CATALOG_LOCK_TIMEOUT', 30)
+FAN_CATALOG_WAIT = 1
+FAN_CATALOG_VERSION_KEY = 'fan_catalog:version'
+FAN_CATALOG_STALE_KEY = 'fan_catalog:stale'
+
+
+def _discount_links(queryset):
+    """
+    Restricts through-table rows of discounts to the ones which really give a discount
+    and joins discount with its company, so the whole list is loaded by one query.
+    :param queryset: queryset of the through model between some model and CompanyDiscount
+    :type queryset: queryset
+    :return: queryset of the through model with joined discount and company
+    :rtype: queryset
+    """
+    return queryset.exclude(companydiscount__percent=0,
+                            companydiscount__amount=0) \
+        .select_related('companydiscount__company')
+
+
+def group_discounts(company_discounts):
+    """
+    Groups discounts by their companies keeping the order in which discounts are given.
+    :param company_discounts: iterable of discounts with loaded companies
+    :type company_discounts: iterable of class CompanyDiscount
+    :return: companies with lists of their discounts (percent, amount, description)
+    :rtype: dict
+    """
+    grouped = {}
+    for company_discount in company_discounts:
+        grouped.setdefault(company_discount.company, []).append({
+            'percent': company_discount.percent,
+            'amount': company_discount.amount,
+            'description': company_discount.description or ''})
+    return grouped
+
+
+def get_employee_discounts(user):
+    """
+    Returns discounts of the companies which are linked to the user (one query).
+    :param user: user with status EMPLOYEE
+    :type user: class MainUser
+    :return: companies with lists of their discounts
+    :rtype: dict
+    """
+    links = _discount_links(UserCompany.company_discount.through.objects.filter(
+        usercompany__user=user)).order_by('usercompany_id', 'id')
+    return group_discounts(link.companydiscount for link in links)
+
+
+def build_fan_catalog():
+    """
+    Reads discounts of all fans (one query).
+    :return: companies with lists of their discounts ('discounts') and labels of
+    FanDiscount objects by id ('labels')
+    :rtype: dict
+    """
+    links = list(FanDiscount.company_discounts.through.objects
+                 .select_related('companydiscount__company')
+                 .order_by('fandiscount_id', 'id'))
+    labels = {}
+    for link in links:
+        labels[link.fandiscount_id] = labels.get(link.fandiscount_id, '') + \
+            f'{link.companydiscount}, '
+    return {
+        'discounts': group_discounts(link.companydiscount for link in links
+                                     if link.companydiscount.percent or
+                                     link.companydiscount.amount),
+        'labels': labels,
+    }
+
+
+def get_version(key):
+    """
+    Returns version from the cache. Versions are times of changes in milliseconds.
+    If the version is lost, new one is made from the current time, so data of old
+    versions is never used again.
+    :param key: key of the version
+    :type key: str
+    :rtype: int
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(*keys):
+    """
+    Sets versions to the current time, new version is always greater than the previous one
+    :param keys: keys of the versions
+    :type keys: str
+    """
+    now = int(time.time() * 1000)
+    versions = cache.get_many(keys)
+    cache.set_many({key: max(now, versions.get(key, 0) + 1) for key in keys}, None)
+
+
+def get_fan_catalog_version():
+    """
+    Returns current version of the fan catalog
+    :rtype: int
+    """
+    return get_version(FAN_CATALOG_VERSION_KEY)
+
+
+def get_fan_catalog_key(version):
+    """
+    Returns key of the snapshot of the fan catalog
+    :param version: version of the catalog
+    :type version: int
+    :rtype: str
+    """
+    return 'fan_catalog:{}'.format(version)
+
+
+def bump_fan_catalog_version():
+    """
+    Makes new version of the fan catalog, snapshot of the new version is built by the next read
+    """
+    bump_version(FAN_CATALOG_VERSION_KEY)
+
+
+def invalidate_fan_catalog():
+    """
+    Makes new version of the fan catalog after commit of the current transaction,
+    so the catalog is not rebuilt from data which is not committed yet.
+    """
+    transaction.on_commit(bump_fan_catalog_version)
+
+
+def get_fan_catalog():
+    """
+    Returns snapshot of the fan catalog from the cache. If the snapshot of the current version
+    is absent, only one process rebuilds it, others return the previous snapshot or wait
+    for the new one.
+    :return: snapshot of the catalog (see build_fan_catalog)
+    :rtype: dict
+    """
+    version = get_fan_catalog_version()
+    key = get_fan_catalog_key(version)
+    catalog = cache.get(key)
+    record_cache('fan_catalog', catalog is not None)
+    if catalog is not None:
+        return catalog
+    lock_key = key + ':lock'
+    if cache.add(lock_key, 1, FAN_CATALOG_LOCK_TIMEOUT):
+        try:
+            catalog = build_fan_catalog()
+            cache.set(key, catalog, FAN_CATALOG_TIMEOUT)
+            cache.set(FAN_CATALOG_STALE_KEY, catalog, None)
+        finally:
+            cache.delete(lock_key)
+        return catalog
+    catalog = cache.get(FAN_CATALOG_STALE_KEY)
+    if catalog is not None:
+        return catalog
+    deadline = time.monotonic() + FAN_CATALOG_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        catalog = cache.get(key)
+        if catalog is not None:
+            return catalog
+    return build_fan_catalog()
+
+
+def get_fan_discounts():
+    """
+    Returns discounts of the companies which are given to all fans from the cache.
+    :return: companies with lists of their discounts
+    :rtype: dict
+    """
+    return get_fan_catalog()['discounts']
+
+
+def get_fan_discount_label(fan_discount_id):
+    """
+    Returns all discounts of the FanDiscount as one string
+    :param fan_discount_id: id of the FanDiscount
+    :type fan_discount_id: int
+    :return: discounts separated by commas
+    :rtype: str
+    """
+    return get_fan_catalog()['labels'].get(fan_discount_id, '')
+
+
+def get_user_version_key(user_id):
+    """
+    Returns key of the version of the user's discounts
+    :param user_id: id of the user
+    :rtype: str
+    """
+    return 'discount_version:{}'.format(user_id)
+
+
+def get_discount_version(user_id):
+    """
+    Returns version of everything what is shown on the scan page of the user: version of
+    the user, his companies and discounts, and version of the fan catalog, which is also
+    changed with discounts and companies.
+    :param user_id: id of the user
+    :type user_id: int
+    :return: version of the user and version of the catalog (milliseconds)
+    :rtype: tuple
+    """
+    user_key = get_user_version_key(user_id)
+    versions = cache.get_many([user_key, FAN_CATALOG_VERSION_KEY])
+    user_version = versions.get(user_key) or get_version(user_key)
+    catalog_version = versions.get(FAN_CATALOG_VERSION_KEY) or get_fan_catalog_version()
+    return user_version, catalog_version
+
+
+def invalidate_user_discounts(user_ids):
+    """
+    Makes new versions of the users after commit of the current transaction.
+    Must be called when users, their links with companies or their discounts are changed.
+    :param user_ids: ids of the users
+    :type user_ids: iterable of int
+    """
+    keys = [get_user_version_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        transaction.on_commit(lambda: bump_version(*keys))
+
+
+def get_employer(user):
+    """
+    Returns name of the company where user works and his position (one query).
+    :param user: user with status EMPLOYEE
+    :type user: class MainUser
+    :return: company name and position, empty strings if user doesn't work anywhere
+    :rtype: tuple
+    """
+    employer = user.user_companies.filter(isEmployer=True) \
+        .order_by('id').values_list('company__name', 'position').last()
+    if employer is None:
+        return '', ''
+    return employer
+
+
+def resolve_discounts(user):
+    """
+    Returns data which is shown to partner when he scans QR code of the user.
+    Number of queries doesn't depend on amount of companies and discounts.
+    :param user: user whose QR code is scanned
+    :type user: class MainUser
+    :return: company name, position and discounts grouped by companies
+    :rtype: dict
+    """
+    company_name, company_position = '', ''
+    if user.status == constants.EMPLOYEE:
+        company_discounts = get_employee_discounts(user)
+        company_name, company_position = get_employer(user)
+    else:
+        company_discounts = get_fan_discounts()
+    return {'company_name': company_name or '',
+            'company_position': company_position,
+            'company_discounts': company_discounts}
+
+
+def serialize_discounts(company_discounts):
+    """
+    Converts discounts grouped by companies to the compact JSON form
+    :param company_discounts: companies with lists of their discounts
+    :type company_discounts: dict
+    :return: companies with their discounts
+    :rtype: list of dict
+    """
+    return [{'company': company.name, 'discounts': discounts}
+            for company, discounts in company_discounts.items()]
+
+
+def resolve_discounts_bulk(statuses):
+    """
+    Returns the same data as resolve_discounts for many users at once. Number of queries
+    doesn't depend on amount of users: one query for discounts of employees and one for
+    their employers, discounts of fans are read from the cache.
+    :param statuses: statuses of users by their ids
+    :type statuses: dict
+    :return: company name, position and discounts (see serialize_discounts) by user id
+    :rtype: dict
+    """
+    employee_ids = [user_id for user_id, status in statuses.items()
+                    if status == constants.EMPLOYEE]
+    employee_discounts = {}
+    if employee_ids:
+        links = _discount_links(UserCompany.company_discount.through.objects.filter(
+            usercompany__user_id__in=employee_ids)) \
+            .annotate(user_id=F('usercompany__user_id')) \
+            .order_by('usercompany_id', 'id')
+        for link in links:
+            employee_discounts.setdefault(link.user_id, []).append(link.companydiscount)
+    employers = {}
+    if employee_ids:
+        for user_id, company_name, position in UserCompany.objects \
+                .filter(user_id__in=employee_ids, isEmployer=True).order_by('id') \
+                .values_list('user_id', 'company__name', 'position'):
+            employers[user_id] = (company_name, position)
+    fan_discounts = None
+    result = {}
+    for user_id, status in statuses.items():
+        if status == constants.EMPLOYEE:
+            company_name, company_position = employers.get(user_id, ('', ''))
+            company_discounts = serialize_discounts(
+                group_discounts(employee_discounts.get(user_id, [])))
+        else:
+            company_name, company_position = '', ''
+            if fan_discounts is None:
+                fan_discounts = serialize_discounts(get_fan_discounts())
+            company_discounts = fan_discounts
+        result[user_id] = {'company_name': company_name or '',
+                           'company_position': company_position,
+                           'company_discounts': company_discounts}
+    return result
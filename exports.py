@@ -0,0 +1,168 @@
+"""
+Streaming export of users to CSV and XLSX files.
+"""
+import csv
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils import timezone
+
+from apps.auth_.models import UserExport
+
+EXPORT_COLUMNS = (
+    ('id', 'ID'),
+    ('email', 'Почта'),
+    ('full_name', 'Полное имя'),
+)
+EXPORT_CHUNK_SIZE = getattr(settings, 'USER_EXPORT_CHUNK_SIZE', 2000)
+EXPORT_SHEET_NAME = 'Пользователи'
+CONTENT_TYPES = {
+    UserExport.CSV: 'text/csv; charset=utf-8',
+    UserExport.XLSX: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class Echo:
+    """
+    Pseudo buffer for csv writer which returns written line instead of keeping it.
+    """
+
+    def write(self, value):
+        """
+        Returns the written value
+        :param value: line which is written by csv writer
+        :type value: str
+        :return: the same line
+        :rtype: str
+        """
+        return value
+
+
+def iter_rows(queryset):
+    """
+    Reads only exported columns of the users by chunks
+    (server-side cursor on PostgreSQL), so the whole selection is never kept in memory.
+    :param queryset: users to export
+    :type queryset: queryset of class MainUser
+    :return: generator of tuples with values of the columns
+    """
+    fields = [field for field, _ in EXPORT_COLUMNS]
+    return queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def iter_csv(queryset):
+    """
+    Generates lines of CSV file with header. Starts with BOM to be opened in excel correctly.
+    :param queryset: users to export
+    :type queryset: queryset of class MainUser
+    :return: generator of lines of the file
+    """
+    writer = csv.writer(Echo())
+    yield '\ufeff' + writer.writerow([title for _, title in EXPORT_COLUMNS])
+    for row in iter_rows(queryset):
+        yield writer.writerow(['' if value is None else value for value in row])
+
+
+def write_csv(queryset, file):
+    """
+    Writes CSV file of users to the opened text file.
+    :param queryset: users to export
+    :type queryset: queryset of class MainUser
+    :param file: opened text file
+    :return: amount of written users
+    :rtype: int
+    """
+    rows = -1
+    for rows, line in enumerate(iter_csv(queryset)):
+        file.write(line)
+    return rows
+
+
+def write_xlsx(queryset, file):
+    """
+    Writes XLSX file of users to the opened binary file. Workbook is in constant memory
+    mode, so each row is flushed to the disk as soon as it is written.
+    :param queryset: users to export
+    :type queryset: queryset of class MainUser
+    :param file: opened binary file
+    :return: amount of written users
+    :rtype: int
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(file, {'constant_memory': True,
+                                          'tmpdir': tempfile.gettempdir()})
+    worksheet = workbook.add_worksheet(EXPORT_SHEET_NAME)
+    bold = workbook.add_format({'bold': True})
+    worksheet.write_row(0, 0, [title for _, title in EXPORT_COLUMNS], bold)
+    rows = 0
+    for rows, row in enumerate(iter_rows(queryset), start=1):
+        worksheet.write_row(rows, 0, row)
+    workbook.close()
+    return rows
+
+
+def get_filename(file_format):
+    """
+    Returns name of the exported file
+    :param file_format: csv or xlsx
+    :type file_format: str
+    :return: name of the file with current date
+    :rtype: str
+    """
+    return 'users_{}.{}'.format(timezone.now().strftime('%Y%m%d_%H%M%S'), file_format)
+
+
+def export_response(queryset, file_format):
+    """
+    Returns streaming response with exported users. CSV is generated while it is sent,
+    XLSX is built in a temporary file on the disk and then sent by chunks.
+    :param queryset: users to export
+    :type queryset: queryset of class MainUser
+    :param file_format: csv or xlsx
+    :type file_format: str
+    :return: streaming response with the file
+    """
+    if file_format == UserExport.CSV:
+        response = StreamingHttpResponse(iter_csv(queryset),
+                                         content_type=CONTENT_TYPES[file_format])
+    else:
+        file = tempfile.TemporaryFile()
+        write_xlsx(queryset, file)
+        file.seek(0)
+        response = FileResponse(file, content_type=CONTENT_TYPES[file_format])
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        get_filename(file_format))
+    return response
+
+
+def run_export(export):
+    """
+    Builds file of the export which is claimed by UserExport.objects.claim
+    and saves it to the storage.
+    :param export: running export
+    :type export: class UserExport
+    """
+    try:
+        queryset = export.get_queryset()
+        if export.file_format == UserExport.CSV:
+            with tempfile.TemporaryFile('w+', encoding='utf-8', newline='') as file:
+                rows = write_csv(queryset, file)
+                file.seek(0)
+                export.file.save(get_filename(export.file_format), File(file), save=False)
+        else:
+            with tempfile.TemporaryFile() as file:
+                rows = write_xlsx(queryset, file)
+                file.seek(0)
+                export.file.save(get_filename(export.file_format), File(file), save=False)
+    except Exception:
+        export.status = UserExport.FAILED
+        export.finished_at = timezone.now()
+        export.save(update_fields=['status', 'finished_at'])
+        raise
+    export.rows = rows
+    export.status = UserExport.DONE
+    export.finished_at = timezone.now()
+    export.save(update_fields=['file', 'rows', 'status', 'finished_at'])
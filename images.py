@@ -0,0 +1,170 @@
+"""
+Background processing of logos of companies: the uploaded logo is decoded once and
+resized to several widths in its own format and in WebP. The uploaded logo is kept as the
+source of the variants. Files are stored by hash of the content, so the same logo is never
+processed twice.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction, connection
+
+from apps.auth_.discounts import invalidate_fan_catalog
+from apps.auth_.models import Company, CompanyLogoVariant
+
+logger = logging.getLogger(__name__)
+
+COMPANY_LOGO_WIDTHS = getattr(settings, 'COMPANY_LOGO_WIDTHS', (512, 256, 128))
+# directory of the variants in the storage, variants of each logo are in its subdirectory
+COMPANY_LOGO_VARIANTS_DIR = getattr(settings, 'COMPANY_LOGO_VARIANTS_DIR', 'logo_variants')
+COMPANY_LOGO_ASYNC = getattr(settings, 'COMPANY_LOGO_ASYNC', True)
+COMPANY_LOGO_WORKERS = getattr(settings, 'COMPANY_LOGO_WORKERS', 2)
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+_executor = None
+
+
+def get_executor():
+    """
+    Returns pool of threads which process logos, created on first use
+    :rtype: ThreadPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=COMPANY_LOGO_WORKERS,
+                                       thread_name_prefix='company-logo')
+    return _executor
+
+
+def get_content_hash(file):
+    """
+    Returns sha256 of the file reading it by chunks
+    :param file: opened binary file
+    :return: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(64 * 1024), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def encode(image, image_format):
+    """
+    Encodes image to the format
+    :param image: Pillow image
+    :param image_format: JPEG, PNG or WEBP
+    :type image_format: str
+    :return: encoded image
+    :rtype: bytes
+    """
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, image_format, quality=85, optimize=True)
+    return buffer.getvalue()
+
+
+def build_variants(company_id, name):
+    """
+    Decodes the logo once and saves its variants to the storage. JPEG is decoded in draft
+    mode directly at reduced scale, so big photos don't take much memory.
+    :param company_id: id of the company
+    :type company_id: int
+    :param name: name of the uploaded logo in the storage
+    :type name: str
+    :return: variants which are not saved to the database
+    :rtype: list of class CompanyLogoVariant
+    """
+    from PIL import Image
+
+    with default_storage.open(name, 'rb') as file:
+        content_hash = get_content_hash(file)
+        image = Image.open(file)
+        source_format = image.format if image.format in EXTENSIONS else 'PNG'
+        max_width = max(COMPANY_LOGO_WIDTHS)
+        image.draft('RGB', (max_width, max_width))
+        image.load()
+
+    formats = (source_format, 'WEBP') if source_format != 'WEBP' else ('WEBP', )
+    directory = os.path.join(COMPANY_LOGO_VARIANTS_DIR, content_hash)
+    variants = []
+    for width in sorted(COMPANY_LOGO_WIDTHS, reverse=True):
+        # each variant is made from the previous bigger one
+        image.thumbnail((width, width), Image.LANCZOS)
+        for image_format in formats:
+            path = os.path.join(directory, '{}.{}'.format(width, EXTENSIONS[image_format]))
+            if not default_storage.exists(path):
+                default_storage.save(path, ContentFile(encode(image, image_format)))
+            variants.append(CompanyLogoVariant(company_id=company_id, width=width,
+                                               image_format=image_format, path=path,
+                                               source=name, content_hash=content_hash))
+    return variants
+
+
+def process_company_logo(company_id):
+    """
+    Processes current logo of the company and swaps its variants in one transaction.
+    The uploaded logo is not changed, so it is always the source of the next processing.
+    If the logo is changed while it is processed, results are dropped, the new logo has
+    its own processing.
+    :param company_id: id of the company
+    :type company_id: int
+    """
+    name = Company.objects.filter(id=company_id).values_list('image', flat=True).first()
+    if not name:
+        return
+    variants = build_variants(company_id, name)
+    with transaction.atomic():
+        if not Company.objects.select_for_update().filter(id=company_id, image=name).exists():
+            return
+        CompanyLogoVariant.objects.filter(company_id=company_id).delete()
+        CompanyLogoVariant.objects.bulk_create(variants)
+    # companies in the fan catalog keep urls of the logos
+    invalidate_fan_catalog()
+
+
+def _process_in_background(company_id):
+    """
+    Processes the logo in the thread of the pool and closes connection of the thread
+    """
+    try:
+        process_company_logo(company_id)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        connection.close()
+
+
+def drop_variants(company_id):
+    """
+    Deletes variants of the previous logo, so the new logo is served as it is uploaded
+    until it is processed
+    :param company_id: id of the company
+    :type company_id: int
+    """
+    CompanyLogoVariant.objects.filter(company_id=company_id).delete()
+
+
+def schedule_logo_processing(company_id):
+    """
+    Drops variants of the previous logo and processes the new one after the current
+    transaction is committed, in the pool of threads or in the same thread if
+    COMPANY_LOGO_ASYNC is false. If the processing is lost, process_logos command
+    picks the company up.
+    :param company_id: id of the company
+    :type company_id: int
+    """
+    transaction.on_commit(lambda: drop_variants(company_id))
+    if COMPANY_LOGO_ASYNC:
+        transaction.on_commit(lambda: get_executor().submit(_process_in_background,
+                                                            company_id))
+    else:
+        transaction.on_commit(lambda: process_company_logo(company_id))
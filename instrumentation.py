@@ -0,0 +1,333 @@
+"""
+Instrumentation of views: latency, amount and time of database queries and cache hits
+per view and action. Metrics are aggregated in the shared django cache, so they are the
+same in all worker processes, and are exposed in Prometheus text format. Slow requests are
+written to the log as JSON.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import ExitStack
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# seconds, requests which take longer are logged
+SLOW_REQUEST_THRESHOLD = getattr(settings, 'SLOW_REQUEST_THRESHOLD', 0.5)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# seconds between flushes of observations of the process to the shared cache by the thread
+METRICS_FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+METRICS_KEY_PREFIX = 'auth_metrics'
+METRICS_INDEX_KEY = METRICS_KEY_PREFIX + ':index'
+# seconds are kept as integer microseconds, because only integers are incremented atomically
+METRICS_SUM_SCALE = 10 ** 6
+SCALED_METRICS = ('auth_request_duration_seconds_sum', 'auth_request_db_seconds_total')
+HISTOGRAMS = (
+    ('auth_request_duration_seconds', 'Latency of requests', LATENCY_BUCKETS),
+    ('auth_request_queries', 'Database queries per request', QUERY_BUCKETS),
+)
+COUNTERS = (
+    ('auth_request_db_seconds_total', 'Time of database queries'),
+    ('auth_requests_total', 'Requests by status'),
+    ('auth_cache_requests_total', 'Cache lookups'),
+)
+
+_state = threading.local()
+
+
+def get_series_key(series):
+    """
+    Returns key of the series in the shared cache
+    :param series: name of the metric and pairs of names and values of labels
+    :type series: tuple
+    :return: key of the cache
+    :rtype: str
+    """
+    metric, labels = series
+    return '{}:{}:{}'.format(METRICS_KEY_PREFIX, metric,
+                             ','.join(label for _, label in labels))
+
+
+def to_integer(metric, value):
+    """
+    Returns value which can be incremented in the cache, seconds of scaled metrics are
+    kept as microseconds
+    :param metric: name of the metric
+    :type metric: str
+    :param value: observed value
+    :return: integer value
+    :rtype: int
+    """
+    if metric in SCALED_METRICS:
+        return int(round(value * METRICS_SUM_SCALE))
+    return int(value)
+
+
+class MetricsRegistry:
+    """
+    Metrics of requests and caches shared by all processes of the service.
+
+    Observations are added to the buffer of the process, requests never wait for the cache.
+    The buffer is flushed to the shared django cache by atomic increments in a background
+    thread every METRICS_FLUSH_INTERVAL seconds, at exit of the process and before
+    rendering, so every worker exposes the same monotonic series and the scraper may hit
+    any of them. Observations of the process which is killed before the flush are lost.
+
+    ...
+
+    Methods
+    -------
+    observe_request(self, view, status, duration, stats)
+        saves metrics of the request
+    observe_cache(self, name, hit)
+        counts hit or miss of the cache
+    flush(self)
+        adds buffered observations to the shared cache
+    render(self)
+        returns metrics in Prometheus text format
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._known = set()
+        self._flusher_pid = None
+
+    def reset(self):
+        """
+        Removes all metrics of all processes
+        """
+        with self._lock:
+            self._pending = {}
+            self._known = set()
+        index = cache.get(METRICS_INDEX_KEY) or set()
+        cache.delete_many([get_series_key(series) for series in index] + [METRICS_INDEX_KEY])
+
+    def _add(self, metric, labels, value=1):
+        series = (metric, labels)
+        self._pending[series] = self._pending.get(series, 0) + value
+
+    def _observe_histogram(self, metric, view, value, buckets):
+        for bucket in buckets:
+            if value <= bucket:
+                self._add(metric + '_bucket', (('view', view), ('le', str(bucket))))
+        self._add(metric + '_sum', (('view', view),), to_integer(metric + '_sum', value))
+        self._add(metric + '_count', (('view', view),))
+
+    def _start_flusher(self):
+        """
+        Starts the flushing thread once in each process, workers forked from the master
+        process don't inherit its threads
+        """
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def observe_request(self, view, status, duration, stats):
+        """
+        Saves metrics of the request
+        :param view: name of the view and action
+        :type view: str
+        :param status: status code of the response
+        :type status: int
+        :param duration: seconds
+        :type duration: float
+        :param stats: queries, db_time, cache_hits and cache_misses of the request
+        :type stats: dict
+        """
+        with self._lock:
+            self._observe_histogram('auth_request_duration_seconds', view, duration,
+                                    LATENCY_BUCKETS)
+            self._observe_histogram('auth_request_queries', view, stats['queries'],
+                                    QUERY_BUCKETS)
+            self._add('auth_request_db_seconds_total', (('view', view),),
+                      to_integer('auth_request_db_seconds_total', stats['db_time']))
+            self._add('auth_requests_total', (('view', view), ('status', str(status))))
+        self._start_flusher()
+
+    def observe_cache(self, name, hit):
+        """
+        Counts hit or miss of the cache
+        :param name: name of the cache
+        :type name: str
+        :param hit: True if value is found
+        :type hit: bool
+        """
+        with self._lock:
+            self._add('auth_cache_requests_total',
+                      (('cache', name), ('result', 'hit' if hit else 'miss')))
+        self._start_flusher()
+
+    def flush(self):
+        """
+        Adds buffered observations of the process to the counters in the shared cache.
+        Index of the series is rewritten if it lost series of the process, for example
+        because of concurrent update by another process.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._known |= set(pending)
+            known = set(self._known)
+        if not known:
+            return
+        for series, value in pending.items():
+            key = get_series_key(series)
+            if cache.add(key, value, None):
+                continue
+            try:
+                cache.incr(key, value)
+            except ValueError:
+                # the key is evicted after add
+                cache.set(key, value, None)
+        index = cache.get(METRICS_INDEX_KEY) or set()
+        if not known <= index:
+            cache.set(METRICS_INDEX_KEY, index | known, None)
+
+    @staticmethod
+    def _format(metric, labels, value):
+        if metric in SCALED_METRICS:
+            value /= METRICS_SUM_SCALE
+        return '{}{{{}}} {}'.format(
+            metric, ','.join('{}="{}"'.format(name, label) for name, label in labels), value)
+
+    def render(self):
+        """
+        Returns metrics of all processes in Prometheus text format
+        :rtype: str
+        """
+        self.flush()
+        index = cache.get(METRICS_INDEX_KEY) or set()
+        keys = {get_series_key(series): series for series in index}
+        values = {keys[key]: value for key, value in cache.get_many(list(keys)).items()}
+        lines = []
+        for metric, help_text, buckets in HISTOGRAMS:
+            lines += ['# HELP {} {}'.format(metric, help_text),
+                      '# TYPE {} histogram'.format(metric)]
+            for series in sorted(series for series in values
+                                 if series[0] == metric + '_count'):
+                labels = series[1]
+                for bucket in buckets:
+                    bucket_labels = labels + (('le', str(bucket)),)
+                    lines.append(self._format(metric + '_bucket', bucket_labels,
+                                              values.get((metric + '_bucket', bucket_labels),
+                                                         0)))
+                lines.append(self._format(metric + '_bucket', labels + (('le', '+Inf'),),
+                                          values[series]))
+                lines.append(self._format(metric + '_sum', labels,
+                                          values.get((metric + '_sum', labels), 0)))
+                lines.append(self._format(metric + '_count', labels, values[series]))
+        for metric, help_text in COUNTERS:
+            lines += ['# HELP {} {}'.format(metric, help_text),
+                      '# TYPE {} counter'.format(metric)]
+            lines += [self._format(metric, labels, value)
+                      for (name, labels), value in sorted(values.items()) if name == metric]
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def record_cache(name, hit):
+    """
+    Counts hit or miss of the cache in metrics and in stats of the current request
+    :param name: name of the cache
+    :type name: str
+    :param hit: True if value is found
+    :type hit: bool
+    """
+    registry.observe_cache(name, hit)
+    stats = getattr(_state, 'stats', None)
+    if stats is not None:
+        stats['cache_hits' if hit else 'cache_misses'] += 1
+
+
+def _count_query(execute, sql, params, many, context):
+    """
+    Execute wrapper of database connections which counts queries of the current request
+    """
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats = getattr(_state, 'stats', None)
+        if stats is not None:
+            stats['queries'] += 1
+            stats['db_time'] += time.perf_counter() - start
+
+
+def get_view_name(request):
+    """
+    Returns name of the url of the request, for viewsets it contains action
+    (for example auth_:activation-activate)
+    :param request: django request
+    :return: name of the view
+    :rtype: str
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unknown'
+    return match.view_name or match._func_path
+
+
+def instrument():
+    """
+    Decorator of dispatch of the view which saves metrics of each request.
+    Use it together with response_wrapper:
+    @method_decorator(instrument(), name='dispatch')
+    :return: decorator
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(request, *args, **kwargs):
+            stats = {'queries': 0, 'db_time': 0.0, 'cache_hits': 0, 'cache_misses': 0}
+            previous, _state.stats = getattr(_state, 'stats', None), stats
+            status = 500
+            start = time.perf_counter()
+            try:
+                with ExitStack() as stack:
+                    for connection in connections.all():
+                        stack.enter_context(connection.execute_wrapper(_count_query))
+                    response = func(request, *args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                duration = time.perf_counter() - start
+                _state.stats = previous
+                view = get_view_name(request)
+                registry.observe_request(view, status, duration, stats)
+                if duration >= SLOW_REQUEST_THRESHOLD:
+                    logger.warning(json.dumps({
+                        'event': 'slow_request',
+                        'view': view,
+                        'method': request.method,
+                        'path': request.path,
+                        'status': status,
+                        'duration_ms': round(duration * 1000, 1),
+                        'queries': stats['queries'],
+                        'db_ms': round(stats['db_time'] * 1000, 1),
+                        'cache_hits': stats['cache_hits'],
+                        'cache_misses': stats['cache_misses'],
+                    }))
+        return wrapper
+    return decorator
@@ -0,0 +1,51 @@
+"""
+Management command to benchmark the login and scan flows and compare with the baseline.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from apps.auth_.benchmarks import (AuthBenchmarks, load_baseline, save_baseline,
+                                   find_regressions, BENCHMARK_BASELINE_PATH,
+                                   BENCHMARK_THRESHOLD)
+
+
+class Command(BaseCommand):
+    """
+    Runs benchmarks in a separate test database, prints results and fails if they are
+    worse than the baseline by more than the threshold.
+    """
+    help = 'Benchmarks activation, token refresh, profile and scan endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50,
+                            help='Amount of calls of each endpoint')
+        parser.add_argument('--baseline', default=BENCHMARK_BASELINE_PATH,
+                            help='Path to the baseline file')
+        parser.add_argument('--threshold', type=float, default=BENCHMARK_THRESHOLD,
+                            help='Allowed relative growth of latency and allocations')
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Save results as the new baseline')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = AuthBenchmarks().run(options['iterations'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in sorted(results.items()):
+            self.stdout.write('{:<22} p50={p50:>8}ms p95={p95:>8}ms p99={p99:>8}ms '
+                              'queries={queries:>3} allocated={allocated_kb}KB'
+                              .format(name, **result))
+        if options['update_baseline']:
+            save_baseline(results, options['baseline'])
+            self.stdout.write('Baseline is saved to {}'.format(options['baseline']))
+            return
+        regressions = find_regressions(results, load_baseline(options['baseline']),
+                                       options['threshold'])
+        if regressions:
+            raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
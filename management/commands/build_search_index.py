@@ -0,0 +1,69 @@
+"""
+Management command to build search indexes for autocompletes of users and discounts.
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from apps.auth_.models import MainUser, Company, CompanyDiscount
+from apps.auth_.search import use_trigram, index_users, index_discounts
+
+TRIGRAM_INDEXES = (
+    (MainUser, 'phone'),
+    (MainUser, 'full_name'),
+    (MainUser, 'username'),
+    (Company, 'name'),
+    (CompanyDiscount, 'description'),
+)
+
+
+class Command(BaseCommand):
+    """
+    On PostgreSQL creates trigram GIN indexes of the searched columns without locking
+    the tables, on other databases rebuilds the n-gram lookup table by batches.
+    """
+    help = 'Builds search indexes for autocompletes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Amount of objects indexed at once')
+
+    def handle(self, *args, **options):
+        if use_trigram():
+            self.create_trigram_indexes()
+        else:
+            self.build_ngrams(options['batch_size'])
+
+    def create_trigram_indexes(self):
+        """
+        Creates pg_trgm extension and trigram indexes if they don't exist
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for model, field_name in TRIGRAM_INDEXES:
+                table = model._meta.db_table
+                column = model._meta.get_field(field_name).column
+                name = '{}_{}_trgm'.format(table, column)[:63]
+                cursor.execute(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} USING gin ({} gin_trgm_ops)'
+                    .format(connection.ops.quote_name(name), connection.ops.quote_name(table),
+                            connection.ops.quote_name(column)))
+                self.stdout.write('Index {} is created'.format(name))
+
+    def build_ngrams(self, batch_size):
+        """
+        Rebuilds n-grams of all users and discounts
+        :param batch_size: amount of objects indexed at once
+        :type batch_size: int
+        """
+        for queryset, index in ((MainUser.objects.only('id', 'phone', 'full_name', 'username'),
+                                 index_users),
+                                (CompanyDiscount.objects.select_related('company'),
+                                 index_discounts)):
+            last_id = 0
+            while True:
+                objects = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+                if not objects:
+                    break
+                index(objects)
+                last_id = objects[-1].id
+            self.stdout.write('{} is indexed'.format(queryset.model._meta.verbose_name_plural))
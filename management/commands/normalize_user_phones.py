@@ -0,0 +1,71 @@
+"""
+Management command to rewrite usernames and phones of users saved before logins were
+normalized to E.164.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.auth_.models import MainUser
+from apps.auth_.phones import normalize_phone
+from apps.auth_.search import use_trigram, index_users
+from apps.auth_.user_cache import invalidate_user_on_commit
+
+
+class Command(BaseCommand):
+    """
+    Normalizes usernames and phones of users by small batches. If the normalized username
+    already belongs to another user, accounts are not merged automatically: the legacy user
+    is kept as it is and is reported, so support can merge discounts and QR code by hand.
+    Is run once after deploy, can be rerun safely.
+    """
+    help = 'Normalizes usernames and phones of users to E.164'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Amount of users updated in one transaction')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to wait between batches')
+
+    def handle(self, *args, **options):
+        updated = 0
+        duplicates = []
+        last_id = 0
+        while True:
+            users = list(MainUser.objects.filter(id__gt=last_id).order_by('id')
+                         .only('id', 'username', 'phone', 'full_name')[:options['batch_size']])
+            if not users:
+                break
+            last_id = users[-1].id
+            changed = []
+            for user in users:
+                username = normalize_phone(user.username)
+                if username is None:
+                    continue
+                phone = normalize_phone(user.phone) or username
+                if user.username == username and user.phone == phone:
+                    continue
+                user.username, user.phone = username, phone
+                changed.append(user)
+            with transaction.atomic():
+                owners = dict(MainUser.objects.filter(
+                    username__in=[user.username for user in changed]
+                ).values_list('username', 'id'))
+                saved = []
+                for user in changed:
+                    if owners.setdefault(user.username, user.id) != user.id:
+                        duplicates.append(user.id)
+                        continue
+                    saved.append(user)
+                MainUser.objects.bulk_update(saved, ['username', 'phone'])
+                for user in saved:
+                    invalidate_user_on_commit(user.id)
+            if saved and not use_trigram():
+                index_users(saved)
+            updated += len(saved)
+            time.sleep(options['sleep'])
+        self.stdout.write('Normalized {} users'.format(updated))
+        if duplicates:
+            self.stdout.write('Users whose normalized phone belongs to another user: {}'
+                              .format(', '.join(map(str, duplicates))))
@@ -0,0 +1,34 @@
+"""
+Management command to create QR codes of users who have no codes and to pre-render images.
+"""
+from django.core.management.base import BaseCommand
+
+from apps.auth_.qr import (get_qr_model, create_missing_codes, pre_render,
+                           QR_RENDER_WORKERS)
+
+
+class Command(BaseCommand):
+    """
+    Creates missing QR codes and renders their images in the pool of processes.
+    """
+    help = 'Creates QR codes of users and pre-renders QR images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=QR_RENDER_WORKERS,
+                            help='Amount of processes which render images')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Amount of codes rendered at once')
+
+    def handle(self, *args, **options):
+        created = create_missing_codes(options['batch_size'])
+        self.stdout.write('{} QR codes are created'.format(created))
+        codes = get_qr_model().objects.order_by('pk').values_list('code', flat=True)
+        rendered, batch = 0, []
+        for code in codes.iterator(chunk_size=options['batch_size']):
+            batch.append(str(code))
+            if len(batch) >= options['batch_size']:
+                rendered += pre_render(batch, options['workers'])
+                batch = []
+        if batch:
+            rendered += pre_render(batch, options['workers'])
+        self.stdout.write('{} QR images are rendered'.format(rendered))
@@ -0,0 +1,31 @@
+"""
+Management command to process logos of companies whose current logo is not processed.
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+
+from apps.auth_.images import process_company_logo
+from apps.auth_.models import Company, CompanyLogoVariant
+
+
+class Command(BaseCommand):
+    """
+    Processes logos of companies, by default only those whose current logo is not
+    processed. Variants keep the name of the logo they are made from, so the logo which is
+    not a source of the variants of the company is new (or its processing was lost).
+    """
+    help = 'Builds variants of logos of companies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Process logos which already have variants too')
+
+    def handle(self, *args, **options):
+        companies = Company.objects.exclude(image='')
+        if not options['all']:
+            current = CompanyLogoVariant.objects.filter(company_id=OuterRef('id'),
+                                                        source=OuterRef('image'))
+            companies = companies.annotate(processed=Exists(current)).filter(processed=False)
+        for company_id in companies.values_list('id', flat=True).distinct():
+            process_company_logo(company_id)
+            self.stdout.write('Logo of company {} is processed'.format(company_id))
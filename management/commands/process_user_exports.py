@@ -0,0 +1,38 @@
+"""
+Management command to build files of the scheduled exports of users.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+
+from apps.auth_.exports import run_export
+from apps.auth_.models import UserExport
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Builds files of the pending exports one by one, exports whose process crashed are
+    built again. Is run by cron.
+    """
+    help = 'Builds files of the scheduled exports of users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10,
+                            help='Maximum amount of exports to build')
+
+    def handle(self, *args, **options):
+        processed = 0
+        while processed < options['limit']:
+            export = UserExport.objects.claim()
+            if export is None:
+                break
+            try:
+                run_export(export)
+            except Exception as e:
+                logger.exception(e)
+                self.stderr.write('Export {} failed: {}'.format(export.id, e))
+            else:
+                self.stdout.write('Export {} is built: {} rows'.format(export.id, export.rows))
+            processed += 1
@@ -0,0 +1,39 @@
+"""
+Management command to provision employees of the company from CSV or JSONL roster.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.auth_.models import Company, MainUser
+from apps.auth_.provisioning import read_roster, PROVISIONING_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    """
+    Reads the roster line by line and creates or updates employees, their links with
+    the company and discounts by batches.
+    """
+    help = 'Provisions employees of the company from CSV or JSONL roster'
+
+    def add_arguments(self, parser):
+        parser.add_argument('company_id', type=int, help='Id of the company')
+        parser.add_argument('path', help='Path to the roster')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Format of the roster, by default by extension of the file')
+        parser.add_argument('--batch-size', type=int, default=PROVISIONING_BATCH_SIZE,
+                            help='Amount of rows processed in one transaction')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete links of the company with users absent in the roster')
+
+    def handle(self, *args, **options):
+        try:
+            company = Company.objects.get(id=options['company_id'])
+        except Company.DoesNotExist:
+            raise CommandError('Company {} does not exist'.format(options['company_id']))
+        file_format = options['format'] or \
+            ('csv' if options['path'].lower().endswith('.csv') else 'jsonl')
+        with open(options['path'], encoding='utf-8-sig', newline='') as file:
+            stats = MainUser.objects.bulk_provision(company, read_roster(file, file_format),
+                                                    batch_size=options['batch_size'],
+                                                    prune=options['prune'])
+        for key, value in stats.items():
+            self.stdout.write('{}: {}'.format(key, value))
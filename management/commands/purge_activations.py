@@ -0,0 +1,42 @@
+"""
+Management command to delete expired and completed activations.
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.auth_.models import Activation
+from apps.utils import constants
+
+
+class Command(BaseCommand):
+    """
+    Deletes activations which are expired or completed by small batches, so each delete
+    holds locks only for a short time. Is run by cron.
+    """
+    help = 'Deletes expired and completed activations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Amount of activations deleted by one query')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to wait between batches')
+        parser.add_argument('--keep-minutes', type=int, default=constants.ACTIVATION_TIME,
+                            help='Activations changed less than this time ago are kept')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        queryset = Activation.objects.filter(
+            Q(end_time__lt=now) | Q(is_active=False),
+            timestamp__lt=now - timedelta(minutes=options['keep_minutes']))
+        deleted = 0
+        while True:
+            ids = list(queryset.order_by().values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += Activation.objects.filter(id__in=ids).delete()[0]
+            time.sleep(options['sleep'])
+        self.stdout.write('Deleted {} activations'.format(deleted))
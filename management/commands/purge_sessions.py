@@ -0,0 +1,42 @@
+"""
+Management command to delete sessions which are revoked or can't be refreshed anymore.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from apps.auth_.models import UserSession
+from apps.auth_.sessions import get_revocation_window
+
+
+class Command(BaseCommand):
+    """
+    Deletes sessions which were revoked or were not refreshed during the refresh window
+    by small batches, so each delete holds locks only for a short time. Tokens of these
+    sessions can't be refreshed, revoked sessions are not needed for the filter of revoked
+    sessions anymore. Is run by cron.
+    """
+    help = 'Deletes revoked and expired sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Amount of sessions deleted by one query')
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Seconds to wait between batches')
+
+    def handle(self, *args, **options):
+        expired = timezone.now() - get_revocation_window()
+        queryset = UserSession.objects \
+            .annotate(last_used_at=Coalesce('refreshed_at', 'created_at')) \
+            .filter(Q(revoked_at__lt=expired) | Q(last_used_at__lt=expired))
+        deleted = 0
+        while True:
+            ids = list(queryset.order_by().values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += UserSession.objects.filter(id__in=ids).delete()[0]
+            time.sleep(options['sleep'])
+        self.stdout.write('Deleted {} sessions'.format(deleted))
@@ -0,0 +1,65 @@
+"""
+Management command to run workers which send sms from the queue.
+"""
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apps.auth_.sms_queue import run_worker, process_batch, release_stale, SMS_BATCH_SIZE
+
+
+def _worker(batch_size, poll_interval, stop_event):
+    """
+    Entry point of worker process, stops when stop_event is set
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(batch_size=batch_size, poll_interval=poll_interval,
+               should_stop=stop_event.is_set)
+
+
+class Command(BaseCommand):
+    """
+    Starts several processes which send sms from the queue until the command is stopped.
+    """
+    help = 'Sends sms from the queue'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Amount of worker processes')
+        parser.add_argument('--batch-size', type=int, default=SMS_BATCH_SIZE,
+                            help='Maximum amount of sms taken by worker at once')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='Send one batch in this process and exit')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            release_stale()
+            processed = process_batch(batch_size=options['batch_size'])
+            self.stdout.write('Processed {} sms'.format(processed))
+            return
+
+        # connections must not be shared with forked processes
+        connections.close_all()
+        stop_event = multiprocessing.Event()
+        processes = [
+            multiprocessing.Process(target=_worker, args=(options['batch_size'],
+                                                          options['poll_interval'],
+                                                          stop_event))
+            for _ in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        self.stdout.write('Started {} sms workers'.format(len(processes)))
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            stop_event.set()
+            for process in processes:
+                process.join()
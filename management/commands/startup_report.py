@@ -0,0 +1,83 @@
+"""
+Management command to measure import cost of the modules of auth_ app.
+"""
+import os
+import re
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+DEFAULT_MODULES = ('apps.auth_.models', 'apps.auth_.admin', 'apps.auth_.signals',
+                   'apps.auth_.serializers', 'apps.auth_.views', 'apps.auth_.urls')
+SCRIPT = '''
+import resource, time
+start = time.perf_counter()
+import django
+django.setup()
+import importlib
+for name in {modules!r}:
+    importlib.import_module(name)
+print(round((time.perf_counter() - start) * 1000, 1),
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def parse_importtime(output):
+    """
+    Parses output of python -X importtime
+    :param output: stderr of the interpreter
+    :type output: str
+    :return: self and cumulative microseconds and depth of nesting by name of module
+    :rtype: dict
+    """
+    modules = {}
+    for line in output.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return modules
+
+
+class Command(BaseCommand):
+    """
+    Starts a fresh interpreter with -X importtime, sets up django and imports modules of
+    auth_ app, then prints import cost of each module of the app and the heaviest packages.
+    """
+    help = 'Reports import time of the modules of auth_ app'
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', action='append', dest='modules',
+                            help='Module to import after setup, can be repeated')
+        parser.add_argument('--top', type=int, default=15,
+                            help='Amount of the heaviest packages to print')
+
+    def handle(self, *args, **options):
+        modules = options['modules'] or DEFAULT_MODULES
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', SCRIPT.format(modules=tuple(modules))],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            env=os.environ.copy())
+        if result.returncode:
+            self.stderr.write(result.stderr[-2000:])
+            return
+        total_ms, max_rss = result.stdout.split()
+        imported = parse_importtime(result.stderr)
+        self.stdout.write('Startup: {} ms, max RSS {} KB, {} modules'.format(
+            total_ms, max_rss, len(imported)))
+        self.stdout.write('\nModules of auth_ app (cumulative / self, ms):')
+        app_modules = sorted(((name, times) for name, times in imported.items()
+                              if name.startswith('apps.auth_')),
+                             key=lambda item: -item[1][1])
+        for name, (self_us, cumulative_us, _) in app_modules:
+            self.stdout.write('  {:<45} {:>9.1f} {:>9.1f}'.format(
+                name, cumulative_us / 1000, self_us / 1000))
+        self.stdout.write('\nHeaviest top-level packages (cumulative, ms):')
+        packages = sorted(((name, times) for name, times in imported.items()
+                           if times[2] == 0 and '.' not in name),
+                          key=lambda item: -item[1][1])
+        for name, (_, cumulative_us, _) in packages[:options['top']]:
+            self.stdout.write('  {:<45} {:>9.1f}'.format(name, cumulative_us / 1000))
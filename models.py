@@ -3,16 +3,18 @@ This file keeps definitions of user, activation and discounts with company.
 """
 from datetime import timedelta
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.contrib.auth.models import (BaseUserManager, AbstractBaseUser,
                                         PermissionsMixin)
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, F
+from django.db.models.base import DEFERRED
 from django.utils import timezone
 from apps.utils import constants, messages
+from apps.auth_.instrumentation import record_cache
 from apps.auth_.validators import phone_validator, full_name_validator
 from apps.utils.exceptions import CommonException
-from apps.utils.password import generate_sms_code
-from apps.utils.image_utils import resize_image_proportionally
-from apps.utils.sms import send_sms_code
 import uuid
 import logging
 
@@ -20,6 +22,10 @@ from apps.utils.upload import unique_path
 
 logger = logging.getLogger(__name__)
 
+# seconds after which running export is considered crashed and is built again
+USER_EXPORT_TIMEOUT = getattr(settings, 'USER_EXPORT_TIMEOUT', 60 * 60)
+USER_EXPORT_MAX_ATTEMPTS = getattr(settings, 'USER_EXPORT_MAX_ATTEMPTS', 3)
+
 
 def jwt_get_secret_key(user_model):
     """
@@ -49,6 +55,10 @@ class MainUserManager(BaseUserManager):
     create_superuser(self, username, password)
         create superuser with username, password for managing django admin
         (passwords are saved in encrypted way)
+    bulk_provision(self, company, rows, batch_size=1000, prune=False)
+        create or update employees of the company and their discounts by batches
+    get_or_create_by_phone(self, phone)
+        return active user of the phone (saved in normalized or legacy form) or create it
     """
 
     def create_user(self, username, phone=None, email=None,
@@ -96,6 +106,47 @@ class MainUserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def bulk_provision(self, company, rows, batch_size=1000, prune=False):
+        """
+        Creates or updates employees of the company, their positions and discounts
+        by batches without hashing passwords (users log in by sms code).
+        :param company: company of the employees
+        :type company: class Company
+        :param rows: rows with phone, full_name, position, is_employer and discounts
+        (see apps.auth_.provisioning.read_roster)
+        :type rows: iterable of dict
+        :param batch_size: amount of rows processed in one transaction
+        :type batch_size: int
+        :param prune: delete links of the company with users who are absent in rows
+        :type prune: bool
+        :return: counters of created, updated and deleted rows
+        :rtype: dict
+        """
+        from apps.auth_.provisioning import provision_employees
+        return provision_employees(company, rows, batch_size=batch_size, prune=prune)
+
+    def get_or_create_by_phone(self, phone):
+        """
+        Returns active user of the phone or creates it. Users who logged in before phones
+        were normalized are found by legacy forms of the phone (8701..., 7701...) and their
+        username and phone are rewritten to E.164, so they keep their discounts and QR code.
+        :param phone: phone in E.164
+        :type phone: str
+        :return: got or created user and boolean value which means if the user created or not
+        :rtype: tuple of class MainUser and bool
+        """
+        from apps.auth_.phones import get_legacy_phones
+        users = {user.username: user for user in self.filter(
+            username__in=get_legacy_phones(phone), is_active=True).order_by('id')}
+        user = users.get(phone) or next(iter(users.values()), None)
+        if user is None:
+            return self.get_or_create(username=phone, is_active=True,
+                                      defaults={'phone': phone, 'is_registered': False})
+        if user.username != phone or user.phone != phone:
+            user.username = user.phone = phone
+            user.save(update_fields=['username', 'phone'])
+        return user, False
+
 
 class MainUser(AbstractBaseUser, PermissionsMixin):
     """
@@ -156,7 +207,7 @@ class MainUser(AbstractBaseUser, PermissionsMixin):
                              validators=[phone_validator], verbose_name='Телефон')
     email = models.EmailField(max_length=50, blank=True, null=True, verbose_name='Почта')
     timestamp = models.DateTimeField(auto_now=True)
-    created_at = models.DateTimeField(auto_now_add=True, null=True,
+    created_at = models.DateTimeField(auto_now_add=True, null=True, db_index=True,
                                       verbose_name="Время создания")
     status = models.CharField(max_length=100, choices=constants.USER_STATUSES,
                               default=constants.FAN, verbose_name="Статус")
@@ -194,8 +245,50 @@ class ActivationManager(models.Manager):
              activation_type=constants.LOGIN)
         to check if there is created activation object for the certain user
         and if not create and send sms code
+    get_recent_id(self, phone, activation_type=constants.LOGIN)
+        returns id of the recent activation of the phone from the cache
+    forget_recent(self, phone, activation_type=constants.LOGIN)
+        removes recent activation of the phone from the cache
     """
 
+    @staticmethod
+    def get_cache_key(phone, activation_type):
+        """
+        Returns key of the recent activation of the phone in the cache
+        :param phone: phone of user
+        :type phone: str
+        :param activation_type: type of activation
+        :type activation_type: str
+        :return: key of the cache
+        :rtype: str
+        """
+        return 'activation:{}:{}'.format(activation_type, phone)
+
+    def get_recent_id(self, phone, activation_type=constants.LOGIN):
+        """
+        Returns id of activation which is generated for the phone less than
+        ACTIVATION_MIN minutes ago without querying the database
+        :param phone: phone of user
+        :type phone: str
+        :param activation_type: type of activation
+        :type activation_type: str
+        :return: id of activation or None
+        :rtype: int
+        """
+        activation_id = cache.get(self.get_cache_key(phone, activation_type))
+        record_cache('recent_activation', activation_id is not None)
+        return activation_id
+
+    def forget_recent(self, phone, activation_type=constants.LOGIN):
+        """
+        Removes recent activation of the phone from the cache when it is used
+        :param phone: phone of user
+        :type phone: str
+        :param activation_type: type of activation
+        :type activation_type: str
+        """
+        cache.delete(self.get_cache_key(phone, activation_type))
+
     def generate_sms(self, phone, user=None,
                      activation_type=constants.LOGIN):
         """
@@ -211,14 +304,14 @@ class ActivationManager(models.Manager):
         :return: created activation
         :rtype: class Activation
         """
-        activation = self.model(phone=phone, user=user)
-        activation.user = user
-        activation.activation_type = activation_type
-        activation.end_time = timezone.now() + timedelta(
-            minutes=constants.ACTIVATION_TIME)
-        activation.code = generate_sms_code()
-        activation.save()
-        activation.send_sms(iterate=False)
+        code, send = Activation.make_code(phone)
+        activation = self.create(phone=phone, user=user,
+                                 activation_type=activation_type,
+                                 end_time=timezone.now() + timedelta(
+                                     minutes=constants.ACTIVATION_TIME),
+                                 code=code)
+        if send:
+            SmsMessage.objects.enqueue(phone, code)
         return activation
 
     def generate(self, user=None, phone=None,
@@ -242,10 +335,12 @@ class ActivationManager(models.Manager):
                                       minutes=constants.ACTIVATION_MIN),
                                   is_active=True,
                                   activation_type=activation_type)
-            return activation
         except Activation.DoesNotExist:
             activation = self.generate_sms(phone=phone, user=user,
                                            activation_type=activation_type)
+        if user is None:
+            cache.set(self.get_cache_key(phone, activation_type), activation.id,
+                      constants.ACTIVATION_MIN * 60)
         return activation
 
 
@@ -285,8 +380,10 @@ class Activation(models.Model):
         checks that activation is active and entered code is correct
     complete(self, request=None)
         complete registration of user, sets appropriate values from activation to user object
+    make_code(phone)
+        generate sms code and tell if it must be sent
     send_sms(self, iterate=True)
-        send sms code to user's phone and iterate each sent sms if iterate param is true
+        queue sms code to user's phone and iterate each sent sms if iterate param is true
     __str__(self)
         prints phone
     """
@@ -303,6 +400,17 @@ class Activation(models.Model):
     iteration = models.PositiveIntegerField(default=0, verbose_name='Количество попыток')
     objects = ActivationManager()
 
+    class Meta:
+        indexes = [
+            # lookup of the recent activation in ActivationManager.generate
+            models.Index(fields=['phone', 'activation_type', 'timestamp'],
+                         name='auth_activation_lookup_idx', condition=Q(is_active=True)),
+            # purge of expired and completed activations
+            models.Index(fields=['end_time'], name='auth_activation_end_idx'),
+            models.Index(fields=['timestamp'], name='auth_activation_done_idx',
+                         condition=Q(is_active=False)),
+        ]
+
     def is_valid(self, raise_exception=False, data=None, check_iteration=False):
         """
         Checks if the activation is active, not expired,
@@ -337,45 +445,76 @@ class Activation(models.Model):
             return False, messages.MAX_ITERATION_EXCEED
         return True, None
 
+    @staticmethod
+    def make_code(phone):
+        """
+        Generates sms code. If in environment variables SMS_ON false or if entered phone
+        number is in the tuple then sms will not be sent, code will be 1111.
+        :param phone: phone of user
+        :type phone: str
+        :return: code and boolean value which means if the code must be sent
+        :rtype: tuple of str and bool
+        """
+        if not settings.SMS_ON or phone in ('+77787884230',):
+            return '1111', False
+        from apps.utils.password import generate_sms_code
+        return generate_sms_code(4), True
+
     def complete(self, request=None):
         """
         Function to complete registration, get user form the database or create and set
-        the values from the activation to the user.
+        the values from the activation to the user. Activation is deactivated by one
+        conditional update, so the same code can't be used by concurrent requests.
         :param request: send request from the view
         :type request: json
+        :raises: :class:`CommonException`: activation is already used, expired or
+        the code is changed
         :return: got or created user and boolean value which means if the user created or not
         :rtype: tuple of class MainUser and bool
         """
-        user, created = MainUser.objects.get_or_create(username=self.phone, is_active=True)
-        user.phone = self.phone
-        user.save()
-        if created:
-            user.is_registered = False
-            user.save()
+        now = timezone.now()
+        with transaction.atomic():
+            user, created = MainUser.objects.get_or_create_by_phone(self.phone)
+            completed = Activation.objects.filter(
+                pk=self.pk, is_active=True, code=self.code, end_time__gte=now
+            ).update(user=user, is_active=False, timestamp=now)
+            if not completed:
+                raise CommonException(detail=messages.CODE_INACTIVE)
         self.user = user
         self.is_active = False
-        self.save()
+        self.timestamp = now
+        Activation.objects.forget_recent(self.phone, self.activation_type)
         return self.user, created
 
     def send_sms(self, iterate=True):
         """
-        Function generates the code and send to entered phone. If in environment variables
-        SMS_ON false or if entered phone number is in the tuple then sms will not be sent,
-        code will be 1111. If iterate param is True, function will count each sent sms to
-        validate then.
+        Function generates the code and puts it to the queue of sms which are sent to
+        entered phone by sms_worker, so request doesn't wait for sms gateway.
+        Code is changed by one conditional update. If iterate param is True, the update
+        increments iteration only if activation is active and iteration is less than
+        MAX_ITERATION, so concurrent resends can't exceed the limit.
         :param iterate: shows should the function iterate each sent sms
         :type iterate: bool
+        :raises: :class:`CommonException`: activation is not active or iteration limit
+        is exceeded
         """
+        code, send = self.make_code(self.phone)
+        now = timezone.now()
+        queryset = Activation.objects.filter(pk=self.pk, is_active=True)
+        changes = {'code': code, 'timestamp': now}
+        if iterate:
+            queryset = queryset.filter(iteration__lt=constants.MAX_ITERATION)
+            changes['iteration'] = F('iteration') + 1
+        if not queryset.update(**changes):
+            self.refresh_from_db(fields=['is_active', 'iteration', 'end_time'])
+            self.is_valid(raise_exception=True, check_iteration=iterate)
+            raise CommonException(detail=messages.CODE_INACTIVE)
+        self.code = code
+        self.timestamp = now
         if iterate:
             self.iteration += 1
-            self.save()
-        if not settings.SMS_ON or self.phone in ('+77787884230',):
-            self.code = '1111'
-            self.save()
-        else:
-            self.code = generate_sms_code(4)
-            send_sms_code(self.phone, self.code)
-        self.save()
+        if send:
+            SmsMessage.objects.enqueue(self.phone, code)
 
     def __str__(self):
         """
@@ -406,13 +545,17 @@ class Company(models.Model):
         list of discounts of the company
     company_users.all: queryset of class UserCompany
         list of objects which keeps relationships between user and company, company_discounts
+    logo_variants.all: queryset of class CompanyLogoVariant
+        processed logos of different sizes and formats
 
     Methods
     -------
     __str__(self)
         returns name of the company
     save(self, force_insert=False, force_update=False, using=None, update_fields=None)
-        overriden save function to resize image proportionally
+        overriden save function to process changed logo in the background
+    get_logo_url(self, width, image_format=None)
+        returns url of the processed logo of the needed size
     """
     name = models.CharField(max_length=100, null=False, blank=False,
                             verbose_name='Компания')
@@ -435,28 +578,101 @@ class Company(models.Model):
         """
         return '{}'.format(self.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Remembers loaded name of the logo to detect its change in save without extra query
+        """
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_image = instance.__dict__.get('image', DEFERRED)
+        return instance
+
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         """
-        Override default save function in order to resize logo of the company proportionally.
-        Takes unchanged company (before save takes company by id) then compare with changed
-        version, if the changed version of the company object has image and image is changed,
-        then resize image.If there is no company (created) then just checks that image is not none
-        then if not resize it.
+        Override default save function in order to process logo of the company.
+        If the company is created with logo or the logo is changed (compared with the name
+        which was loaded from the database), then variants of different sizes are built
+        in the background after the transaction is committed.
 
         There are default params of save function.
         """
-        try:
-            previous = Company.objects.get(id=self.id)
-            super().save(force_insert=force_insert, force_update=force_update,
-                         using=using, update_fields=update_fields)
-            if self.image and previous.image != self.image:
-                resize_image_proportionally(self.image.path, self.image.width, self.image.height)
-        except Company.DoesNotExist:
-            super().save(force_insert=force_insert, force_update=force_update,
-                         using=using, update_fields=update_fields)
-            if self.image:
-                resize_image_proportionally(self.image.path, self.image.width,
-                                            self.image.height)
+        super().save(force_insert=force_insert, force_update=force_update,
+                     using=using, update_fields=update_fields)
+        if update_fields is not None and 'image' not in update_fields:
+            return
+        loaded_image = getattr(self, '_loaded_image', None)
+        if loaded_image is not DEFERRED and self.image and self.image.name != loaded_image:
+            from apps.auth_.images import schedule_logo_processing
+            schedule_logo_processing(self.id)
+        self._loaded_image = self.image.name
+
+    def get_logo_url(self, width, image_format=None):
+        """
+        Returns url of the smallest processed logo which is not narrower than width
+        :param width: needed width in pixels
+        :type width: int
+        :param image_format: format of the logo (for example WEBP), by default format of
+        the uploaded logo
+        :type image_format: str
+        :return: url of the logo or of the uploaded logo if it is not processed yet
+        :rtype: str
+        """
+        variants = [variant for variant in self.logo_variants.all()
+                    if image_format is None or variant.image_format == image_format]
+        variants.sort(key=lambda variant: variant.width)
+        for variant in variants:
+            if variant.width >= width:
+                return variant.url
+        if variants:
+            return variants[-1].url
+        return self.image.url if self.image else ''
+
+
+class CompanyLogoVariant(models.Model):
+    """
+    Processed logo of the company of certain width and format.
+
+    ...
+
+    Attributes
+    ----------
+    company: class Company
+        company of the logo
+    width: int
+        maximum width and height of the logo
+    image_format: str
+        format of the image (JPEG, PNG, WEBP)
+    path: str
+        path of the file in the storage, files are shared by logos with the same content
+    source: str
+        name of the uploaded logo which the variant is made from
+    content_hash: str
+        sha256 of the uploaded logo which the variant is made from
+
+    Methods
+    -------
+    url(self)
+        returns url of the file
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE,
+                                related_name='logo_variants', verbose_name='Компания')
+    width = models.PositiveIntegerField(verbose_name='Ширина')
+    image_format = models.CharField(max_length=10, verbose_name='Формат')
+    path = models.CharField(max_length=255)
+    source = models.CharField(max_length=255, default='')
+    content_hash = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('company', 'width', 'image_format')
+
+    @property
+    def url(self):
+        """
+        Returns url of the file in the default storage
+        :return: url of the file
+        :rtype: str
+        """
+        return default_storage.url(self.path)
 
 
 class CompanyDiscount(models.Model):
@@ -589,12 +805,322 @@ class FanDiscount(models.Model):
 
     def __str__(self):
         """
-        Prints all companies discounts. Go through list of  company discounts
-        and add to string compamy's name, description and discount
+        Prints all companies discounts: compamy's name, description and discount.
+        Labels are taken from the cached fan catalog.
         :return: all companies discounts
         :rtype: str
         """
-        res = ""
-        for d in self.company_discounts.all():
-            res += f"{d.__str__()}, "
-        return res
+        from apps.auth_.discounts import get_fan_discount_label
+        return get_fan_discount_label(self.pk)
+
+
+class UserExportManager(models.Manager):
+    """
+    Manager for exports of users.
+
+    ...
+
+    Methods
+    -------
+    schedule(self, queryset, file_format, user=None)
+        saves ids of the selected users to build the file later in the background
+    claim(self)
+        marks the next pending or stale running export as running and returns it
+    """
+
+    def schedule(self, queryset, file_format, user=None):
+        """
+        Creates pending export which keeps ids of the selected users.
+        The file is built later by the process_user_exports management command.
+        :param queryset: users which are selected in the admin
+        :type queryset: queryset of class MainUser
+        :param file_format: format of the file (csv or xlsx)
+        :type file_format: str
+        :param user: staff user who requested the export
+        :type user: class MainUser
+        :return: created export
+        :rtype: class UserExport
+        """
+        user_ids = queryset.order_by('id').values_list('id', flat=True)
+        return self.create(file_format=file_format, created_by=user,
+                           user_ids=','.join(map(str, user_ids)))
+
+    def claim(self):
+        """
+        Takes the oldest pending export or export which is running longer than
+        USER_EXPORT_TIMEOUT (its process crashed) and marks it as running. Rows locked by
+        other processes are skipped. Export which crashed USER_EXPORT_MAX_ATTEMPTS times
+        is marked as failed.
+        :return: claimed export or None if there is nothing to build
+        :rtype: class UserExport
+        """
+        while True:
+            now = timezone.now()
+            with transaction.atomic():
+                export = self.select_for_update(skip_locked=True).filter(
+                    Q(status=UserExport.PENDING) |
+                    Q(status=UserExport.RUNNING,
+                      started_at__lt=now - timedelta(seconds=USER_EXPORT_TIMEOUT))
+                ).order_by('id').first()
+                if export is None:
+                    return None
+                if export.attempts >= USER_EXPORT_MAX_ATTEMPTS:
+                    export.status = UserExport.FAILED
+                    export.finished_at = now
+                    export.save(update_fields=['status', 'finished_at'])
+                    continue
+                export.status = UserExport.RUNNING
+                export.started_at = now
+                export.attempts += 1
+                export.save(update_fields=['status', 'started_at', 'attempts'])
+                return export
+
+
+class UserExport(models.Model):
+    """
+    Export of users to file which is built in the background for big selections.
+
+    ...
+
+    Attributes
+    ----------
+    file_format: str
+        format of the file, csv or xlsx
+    status: str
+        pending, running, done or failed
+    user_ids: str
+        comma separated ids of the selected users
+    file: file
+        built file which admin downloads
+    rows: int
+        amount of exported users
+    attempts: int
+        how many times building of the file was started
+    created_by: class MainUser
+        staff user who requested the export
+    created_at: date
+        when the export is requested
+    started_at: date
+        when building of the file is started last time
+    finished_at: date
+        when the file is built
+
+    Methods
+    -------
+    get_queryset(self)
+        returns queryset of the selected users
+    """
+    CSV = 'csv'
+    XLSX = 'xlsx'
+    FORMATS = ((CSV, 'CSV'), (XLSX, 'XLSX'))
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, 'В очереди'), (RUNNING, 'Выполняется'),
+                (DONE, 'Готово'), (FAILED, 'Ошибка'))
+
+    file_format = models.CharField(max_length=10, choices=FORMATS, verbose_name='Формат')
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING,
+                              db_index=True, verbose_name='Статус')
+    user_ids = models.TextField(blank=True, default='')
+    file = models.FileField(upload_to='exports/', blank=True, verbose_name='Файл')
+    rows = models.PositiveIntegerField(default=0, verbose_name='Количество строк')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попытки')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                                   related_name='user_exports',
+                                   on_delete=models.SET_NULL, verbose_name='Пользователь')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Время создания")
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name='Время запуска')
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name='Время окончания')
+    objects = UserExportManager()
+
+    class Meta:
+        verbose_name = "Выгрузка пользователей"
+        verbose_name_plural = "Выгрузки пользователей"
+
+    def get_queryset(self):
+        """
+        Returns queryset of the users which were selected in the admin
+        :return: selected users
+        :rtype: queryset of class MainUser
+        """
+        user_ids = [int(user_id) for user_id in self.user_ids.split(',') if user_id]
+        return MainUser.objects.filter(id__in=user_ids).order_by('id')
+
+
+class SmsMessageManager(models.Manager):
+    """
+    Manager for queue of sms.
+
+    ...
+
+    Methods
+    -------
+    enqueue(self, phone, code)
+        puts sms code to the queue
+    """
+
+    def enqueue(self, phone, code):
+        """
+        Puts sms code to the queue, it will be sent by sms_worker management command
+        :param phone: phone of user
+        :type phone: str
+        :param code: sms code
+        :type code: str
+        :return: created message
+        :rtype: class SmsMessage
+        """
+        return self.create(phone=phone, code=code, next_attempt_at=timezone.now())
+
+
+class SmsMessage(models.Model):
+    """
+    Durable queue of sms codes which are sent by workers in the background.
+
+    ...
+
+    Attributes
+    ----------
+    phone: str
+        phone of user
+    code: str
+        sms code which is sent
+    status: str
+        pending (waits to be sent), sending (is taken by worker), sent or dead
+        (sending failed too many times)
+    attempts: int
+        amount of failed attempts to send
+    next_attempt_at: date
+        when the message can be sent next time
+    locked_at: date
+        when the message is taken by worker
+    last_error: str
+        error of the last failed attempt
+    created_at: date
+        when the message is put to the queue
+    sent_at: date
+        when the message is sent
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUSES = ((PENDING, 'В очереди'), (SENDING, 'Отправляется'),
+                (SENT, 'Отправлено'), (DEAD, 'Не отправлено'))
+
+    phone = models.CharField(max_length=20, verbose_name='Телефон')
+    code = models.CharField(max_length=50, verbose_name='Код')
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING,
+                              verbose_name='Статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Количество попыток')
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           verbose_name='Время следующей попытки')
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True, verbose_name='Ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Время создания")
+    sent_at = models.DateTimeField(blank=True, null=True, verbose_name='Время отправки')
+    objects = SmsMessageManager()
+
+    class Meta:
+        verbose_name = "SMS в очереди"
+        verbose_name_plural = "Очередь SMS"
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        """
+        Prints phone and status of the message
+        :return: phone and status
+        :rtype: str
+        """
+        return '{}: {}'.format(self.phone, self.status)
+
+
+class SearchNgram(models.Model):
+    """
+    N-gram lookup table for search in autocompletes on databases without trigram indexes.
+
+    ...
+
+    Attributes
+    ----------
+    kind: str
+        kind of the indexed object (user or discount)
+    object_id: int
+        id of the indexed object
+    gram: str
+        lowercased n-gram of the searched fields of the object
+    """
+    USER = 'user'
+    DISCOUNT = 'discount'
+    KINDS = ((USER, 'Пользователь'), (DISCOUNT, 'Скидка компании'))
+
+    kind = models.CharField(max_length=20, choices=KINDS)
+    object_id = models.PositiveIntegerField()
+    gram = models.CharField(max_length=10)
+
+    class Meta:
+        unique_together = ('kind', 'gram', 'object_id')
+        indexes = [
+            models.Index(fields=['kind', 'object_id']),
+        ]
+
+
+class UserSession(models.Model):
+    """
+    Session of the user on one device. Tokens of the session contain its sid and are signed
+    with its own secret, so the session is refreshed and revoked without touching
+    other devices of the user.
+
+    ...
+
+    Attributes
+    ----------
+    user: class MainUser
+        owner of the session
+    sid: UUID
+        identifier of the session in the token
+    secret: UUID
+        secret which tokens of the session are signed with, changed on each refresh
+    device: str
+        user agent of the device
+    push_token: str
+        push token of the device, it is deleted when the user logs out from the device
+    created_at: date
+        when the user logged in
+    refreshed_at: date
+        when the token was refreshed last time
+    revoked_at: date
+        when the user logged out from the device
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='sessions',
+                             on_delete=models.CASCADE, verbose_name='Пользователь')
+    sid = models.UUIDField(default=uuid.uuid4, unique=True)
+    secret = models.UUIDField(default=uuid.uuid4)
+    device = models.CharField(max_length=255, blank=True, default='',
+                              verbose_name='Устройство')
+    push_token = models.CharField(max_length=255, blank=True, default='',
+                                  verbose_name='Push токен')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Время входа")
+    refreshed_at = models.DateTimeField(blank=True, null=True,
+                                        verbose_name='Время обновления токена')
+    revoked_at = models.DateTimeField(blank=True, null=True, verbose_name='Время выхода')
+
+    class Meta:
+        verbose_name = "Сессия"
+        verbose_name_plural = "Сессии"
+        indexes = [
+            models.Index(fields=['revoked_at'], name='auth_session_revoked_idx',
+                         condition=Q(revoked_at__isnull=False)),
+        ]
+
+    def __str__(self):
+        """
+        Prints user and device of the session
+        :return: user and device
+        :rtype: str
+        """
+        return '{}: {}'.format(self.user_id, self.device)
@@ -0,0 +1,284 @@
+"""
+Keyset (seek) pagination helpers. Boundaries of visited pages are kept in the cache,
+so the next page is read by seeking after the last row of the previous page instead
+of skipping rows with OFFSET. Big lists of the admin are counted by the estimate of
+the planner instead of COUNT(*).
+"""
+import hashlib
+import json
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, Page
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+KEYSET_BOUNDARY_TIMEOUT = getattr(settings, 'KEYSET_BOUNDARY_TIMEOUT', 10 * 60)
+# lists which are estimated to have more rows are not counted exactly
+ESTIMATED_COUNT_THRESHOLD = getattr(settings, 'ESTIMATED_COUNT_THRESHOLD', 10000)
+
+
+def keyset_filter(ordering, boundary):
+    """
+    Returns condition of rows which go after the boundary in the given ordering.
+    For ordering ['-rank', 'id'] it is rank < r OR (rank = r AND id > i).
+    :param ordering: fields of ordering, descending fields start with '-'
+    :type ordering: list of str
+    :param boundary: values of the fields of the last row of the previous page
+    :type boundary: list
+    :return: condition for filter
+    :rtype: Q
+    """
+    conditions = []
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = '__lt' if field.startswith('-') else '__gt'
+        condition = Q(**{name + lookup: boundary[i]})
+        for previous, value in zip(ordering[:i], boundary[:i]):
+            condition &= Q(**{previous.lstrip('-'): value})
+        conditions.append(condition)
+    return reduce(or_, conditions)
+
+
+def get_boundary(obj, ordering):
+    """
+    Returns values of ordering fields of the row
+    :param obj: model instance (annotations are its attributes)
+    :param ordering: fields of ordering
+    :type ordering: list of str
+    :return: values of the fields
+    :rtype: list
+    """
+    return [getattr(obj, field.lstrip('-')) for field in ordering]
+
+
+def get_boundary_key(scope, page):
+    """
+    Returns cache key of the boundary after the page
+    :param scope: identifies list which is paginated (path, search query, filters)
+    :type scope: str
+    :param page: number of the page
+    :type page: int
+    :return: key of the cache
+    :rtype: str
+    """
+    return 'keyset:{}:{}'.format(hashlib.md5(scope.encode('utf-8')).hexdigest(), page)
+
+
+def get_keyset_page(queryset, ordering, scope, page, page_size):
+    """
+    Returns rows of the page. If boundary of the previous page is known, seeks after it,
+    otherwise falls back to OFFSET. One extra row is read to know if there is the next page,
+    so the rows are never counted.
+    :param queryset: ordered queryset
+    :param ordering: fields of the ordering of the queryset, last field must be unique
+    :type ordering: list of str
+    :param scope: identifies list which is paginated
+    :type scope: str
+    :param page: number of the page starting with 1
+    :type page: int
+    :param page_size: amount of rows in the page
+    :type page_size: int
+    :return: rows of the page and True if there is the next page
+    :rtype: tuple
+    """
+    boundary = cache.get(get_boundary_key(scope, page - 1)) if page > 1 else None
+    if boundary is not None:
+        rows = list(queryset.filter(keyset_filter(ordering, boundary))[:page_size + 1])
+    else:
+        offset = (page - 1) * page_size
+        rows = list(queryset[offset:offset + page_size + 1])
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    if has_next:
+        cache.set(get_boundary_key(scope, page), get_boundary(rows[-1], ordering),
+                  KEYSET_BOUNDARY_TIMEOUT)
+    return rows, has_next
+
+
+class KeysetPage:
+    """
+    Page which knows only if there is the next page, without total amount of rows.
+    """
+
+    def __init__(self, number, object_list, has_next):
+        self.number = number
+        self.object_list = object_list
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+
+class KeysetAutocompleteMixin:
+    """
+    Mixin of autocomplete views which paginates results by keyset instead of
+    counting them and skipping rows with OFFSET.
+
+    ...
+
+    Attributes
+    ----------
+    keyset_ordering: list of str
+        ordering of the queryset, last field must be unique
+    keyset_max_rows: int
+        maximum amount of results of one query, None means no limit
+
+    Methods
+    -------
+    paginate_queryset(self, queryset, page_size)
+        returns rows of the requested page
+    """
+    keyset_ordering = ('id', )
+    keyset_max_rows = None
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        Returns rows of the requested page in the format of django's MultipleObjectMixin
+        :param queryset: ordered queryset
+        :param page_size: amount of rows in the page
+        :return: paginator (None), page, rows and True if there is the next page
+        :rtype: tuple
+        """
+        try:
+            page = max(int(self.request.GET.get(self.page_kwarg) or 1), 1)
+        except ValueError:
+            page = 1
+        if self.keyset_max_rows is not None and (page - 1) * page_size >= self.keyset_max_rows:
+            return None, KeysetPage(page, [], False), [], False
+        scope = '{}:{}'.format(self.request.path, self.q)
+        rows, has_next = get_keyset_page(queryset, list(self.keyset_ordering), scope,
+                                         page, page_size)
+        if self.keyset_max_rows is not None and page * page_size >= self.keyset_max_rows:
+            rows = rows[:max(self.keyset_max_rows - (page - 1) * page_size, 0)]
+            has_next = False
+        return None, KeysetPage(page, rows, has_next), rows, has_next
+
+
+def estimate_count(queryset):
+    """
+    Returns amount of rows of the queryset which is estimated by the planner of PostgreSQL
+    :param queryset: queryset
+    :return: estimated amount or None if the database can't estimate it
+    :rtype: int
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator which counts big lists by the estimate of the planner and reads the next
+    page by seeking after the previous one when the list is in the keyset ordering.
+
+    ...
+
+    Attributes
+    ----------
+    scope: str
+        identifies list which is paginated
+    ordering: list of str
+        keyset ordering, last field must be unique
+
+    Methods
+    -------
+    count(self)
+        returns estimated amount of rows or exact amount for small lists
+    page(self, number)
+        returns the page
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 scope='', ordering=('id', )):
+        super().__init__(object_list, per_page, orphans, allow_empty_first_page)
+        self.scope = scope
+        self.ordering = list(ordering)
+
+    @cached_property
+    def count(self):
+        """
+        Returns estimated amount of rows, if the estimate is less than
+        ESTIMATED_COUNT_THRESHOLD, rows are counted exactly
+        :rtype: int
+        """
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+            return estimate
+        return super().count
+
+    def is_keyset_ordered(self):
+        """
+        Checks that the list is ordered by the keyset ordering (admin can be sorted by
+        other columns). Fields after the unique last field don't change the order.
+        :rtype: bool
+        """
+        order_by = [{'pk': 'id', '-pk': '-id'}.get(field, field)
+                    for field in self.object_list.query.order_by]
+        return order_by[:len(self.ordering)] == self.ordering
+
+    def page(self, number):
+        """
+        Returns the page. Page after the visited one is read by seeking, others by OFFSET.
+        Number of the page is not checked with the estimated count, so the last pages are
+        available even if the estimate is less than the real amount.
+        :param number: number of the page starting with 1
+        :rtype: class Page
+        """
+        try:
+            number = max(int(number), 1)
+        except (TypeError, ValueError):
+            number = 1
+        if not self.is_keyset_ordered():
+            offset = (number - 1) * self.per_page
+            return Page(self.object_list[offset:offset + self.per_page], number, self)
+        rows, _ = get_keyset_page(self.object_list, self.ordering, self.scope,
+                                  number, self.per_page)
+        return Page(rows, number, self)
+
+
+class KeysetAdminMixin:
+    """
+    Mixin of model admins which paginates the list by keyset and doesn't count
+    all rows of the table.
+
+    ...
+
+    Attributes
+    ----------
+    keyset_ordering: list of str
+        ordering of the list, last field must be unique
+
+    Methods
+    -------
+    get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True)
+        returns keyset paginator of the list
+    """
+    keyset_ordering = ('id', )
+    show_full_result_count = False
+
+    def get_paginator(self, request, queryset, per_page, orphans=0,
+                      allow_empty_first_page=True):
+        """
+        Returns keyset paginator, boundaries of pages are kept for the path and filters
+        :return: paginator
+        :rtype: class KeysetPaginator
+        """
+        params = request.GET.copy()
+        params.pop('p', None)
+        scope = '{}?{}'.format(request.path, params.urlencode())
+        return KeysetPaginator(queryset, per_page, orphans, allow_empty_first_page,
+                               scope=scope, ordering=self.keyset_ordering)
@@ -0,0 +1,106 @@
+"""
+Validation and normalization of phones. Phones are canonicalized to E.164 once and results
+are memoized, so repeated logins of the same phone don't parse it again. Metadata of
+phonenumbers is loaded on first use and only for the regions which are served.
+Kazakhstan and Russia share country code +7 and both were accepted before, so both are
+served by default, other regions must be added to PHONE_REGIONS.
+"""
+import re
+from functools import lru_cache
+
+from django.conf import settings
+
+PHONE_REGIONS = tuple(getattr(settings, 'PHONE_REGIONS', ('KZ', 'RU')))
+PHONE_CACHE_SIZE = getattr(settings, 'PHONE_CACHE_SIZE', 100000)
+
+_SEPARATORS_RE = re.compile(r'[\s()\-.]')
+_PLAUSIBLE_RE = re.compile(r'^\+?\d{6,15}$')
+
+
+def _clean(phone):
+    """
+    Removes separators, so the same phone written differently has one cache entry
+    :param phone: phone as it is entered
+    :type phone: str
+    :return: digits with optional leading plus or None if it can't be a phone
+    :rtype: str
+    """
+    if not phone:
+        return None
+    phone = _SEPARATORS_RE.sub('', str(phone))
+    return phone if _PLAUSIBLE_RE.match(phone) else None
+
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _normalize(phone):
+    """
+    Parses cleaned phone. Number must be a valid mobile number of one of the served regions.
+    :param phone: cleaned phone
+    :type phone: str
+    :return: phone in E.164 or None if it is invalid
+    :rtype: str
+    """
+    import phonenumbers
+    mobile_types = (phonenumbers.PhoneNumberType.MOBILE,
+                    phonenumbers.PhoneNumberType.FIXED_LINE_OR_MOBILE)
+    for region in PHONE_REGIONS:
+        try:
+            number = phonenumbers.parse(phone, region)
+        except phonenumbers.NumberParseException:
+            continue
+        if phonenumbers.is_valid_number_for_region(number, region) and \
+                phonenumbers.number_type(number) in mobile_types:
+            return phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
+    return None
+
+
+def normalize_phone(phone):
+    """
+    Returns phone in E.164 (for example +77011234567)
+    :param phone: phone as it is entered
+    :type phone: str
+    :return: normalized phone or None if phone is invalid
+    :rtype: str
+    """
+    phone = _clean(phone)
+    if phone is None:
+        return None
+    return _normalize(phone)
+
+
+def is_valid_phone(phone):
+    """
+    Checks that the phone is a valid mobile phone of one of the served regions
+    :param phone: phone as it is entered
+    :type phone: str
+    :rtype: bool
+    """
+    return normalize_phone(phone) is not None
+
+
+def normalize_phones(phones):
+    """
+    Normalizes many phones, each distinct phone is parsed once
+    :param phones: phones as they are entered
+    :type phones: iterable of str
+    :return: normalized phones (None for invalid ones) in the same order
+    :rtype: list of str
+    """
+    phones = list(phones)
+    normalized = {phone: normalize_phone(phone) for phone in set(phones)}
+    return [normalized[phone] for phone in phones]
+
+
+def get_legacy_phones(phone):
+    """
+    Returns forms in which the normalized phone could be saved before logins were normalized
+    (for example +77011234567, 77011234567 and 87011234567)
+    :param phone: phone in E.164
+    :type phone: str
+    :return: normalized phone and its legacy forms
+    :rtype: list of str
+    """
+    phones = [phone, phone.lstrip('+')]
+    if phone.startswith('+7'):
+        phones.append('8' + phone[2:])
+    return phones
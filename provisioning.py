@@ -0,0 +1,288 @@
+"""
+Bulk provisioning of employees of partner companies from CSV or JSONL rosters.
+Users are upserted by phone normalized to E.164, links with the company and discounts are
+diffed against the existing roster, so re-syncs write only changed rows.
+"""
+import csv
+import json
+import re
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from apps.auth_.discounts import invalidate_user_discounts
+from apps.auth_.models import MainUser, UserCompany, CompanyDiscount
+from apps.auth_.phones import normalize_phones
+from apps.auth_.search import use_trigram, index_users
+from apps.auth_.user_cache import invalidate_user_on_commit
+from apps.utils import constants
+
+PROVISIONING_BATCH_SIZE = 1000
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'да')
+
+
+def parse_bool(value):
+    """
+    Parses boolean value of the roster
+    :param value: bool or string
+    :return: parsed value
+    :rtype: bool
+    """
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in TRUE_VALUES
+
+
+def parse_discounts(value):
+    """
+    Parses uuids of discounts, in CSV they are separated by ';', ',' or spaces
+    :param value: list of uuids or string
+    :return: uuids of discounts in canonical form or None if column is absent
+    :rtype: set of str
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = re.split(r'[;,\s]+', value)
+    discounts = set()
+    for item in value:
+        try:
+            discounts.add(str(uuid.UUID(str(item).strip())))
+        except ValueError:
+            if str(item).strip():
+                discounts.add(str(item).strip())
+    return discounts
+
+
+def read_roster(file, file_format):
+    """
+    Reads rows of the roster one by one.
+    Columns: phone, full_name, position, is_employer, discounts (uuids of CompanyDiscount).
+    :param file: opened text file
+    :param file_format: csv or jsonl
+    :type file_format: str
+    :return: generator of rows
+    """
+    if file_format == 'csv':
+        rows = csv.DictReader(file)
+    else:
+        rows = (json.loads(line) for line in file if line.strip())
+    for row in rows:
+        yield {
+            'phone': (row.get('phone') or '').strip() or None,
+            'full_name': (row.get('full_name') or '').strip() or None,
+            'position': (row.get('position') or '').strip() or None,
+            'is_employer': parse_bool(row.get('is_employer', True)),
+            'discounts': parse_discounts(row.get('discounts')),
+        }
+
+
+def iter_batches(rows, batch_size):
+    """
+    Splits rows to batches
+    :param rows: iterable of rows
+    :param batch_size: size of batch
+    :type batch_size: int
+    :return: generator of lists of rows
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def upsert_users(rows, stats):
+    """
+    Creates absent users and updates changed ones. Users get unusable password,
+    because they log in by sms code, so passwords are not hashed.
+    :param rows: rows of the batch, phones are unique
+    :type rows: list of dict
+    :param stats: counters of changes
+    :type stats: dict
+    :return: ids of users by phone
+    :rtype: dict
+    """
+    phones = [row['phone'] for row in rows]
+    existing = {user.username: user for user in MainUser.objects.filter(username__in=phones)
+                .only('id', 'username', 'phone', 'full_name', 'status')}
+    created, changed = [], []
+    for row in rows:
+        user = existing.get(row['phone'])
+        if user is None:
+            created.append(MainUser(username=row['phone'], phone=row['phone'],
+                                    full_name=row['full_name'], status=constants.EMPLOYEE,
+                                    password=make_password(None)))
+            continue
+        full_name = row['full_name'] or user.full_name
+        if user.full_name != full_name or user.status != constants.EMPLOYEE:
+            user.full_name = full_name
+            user.status = constants.EMPLOYEE
+            changed.append(user)
+    MainUser.objects.bulk_create(created, ignore_conflicts=True)
+    MainUser.objects.bulk_update(changed, ['full_name', 'status'])
+    for user in changed:
+        invalidate_user_on_commit(user.id)
+    invalidate_user_discounts(user.id for user in changed)
+    stats['created_users'] += len(created)
+    stats['updated_users'] += len(changed)
+    user_ids = dict(MainUser.objects.filter(username__in=phones).values_list('username', 'id'))
+    if not use_trigram() and (created or changed):
+        index_users(MainUser.objects.filter(
+            username__in=[user.username for user in created + changed]))
+    return user_ids
+
+
+def upsert_user_companies(company, rows, user_ids, stats):
+    """
+    Creates absent links of users with the company and updates changed position and
+    isEmployer
+    :param company: company of the roster
+    :type company: class Company
+    :param rows: rows of the batch
+    :type rows: list of dict
+    :param user_ids: ids of users by phone
+    :type user_ids: dict
+    :param stats: counters of changes
+    :type stats: dict
+    :return: ids of links by user id
+    :rtype: dict
+    """
+    existing = {}
+    for user_company in UserCompany.objects.filter(company=company,
+                                                   user_id__in=user_ids.values()) \
+            .only('id', 'user_id', 'position', 'isEmployer').order_by('id'):
+        existing.setdefault(user_company.user_id, user_company)
+    created, changed = [], []
+    for row in rows:
+        user_id = user_ids[row['phone']]
+        user_company = existing.get(user_id)
+        if user_company is None:
+            created.append(UserCompany(user_id=user_id, company=company,
+                                       position=row['position'],
+                                       isEmployer=row['is_employer']))
+        elif user_company.position != row['position'] or \
+                user_company.isEmployer != row['is_employer']:
+            user_company.position = row['position']
+            user_company.isEmployer = row['is_employer']
+            changed.append(user_company)
+    UserCompany.objects.bulk_create(created)
+    UserCompany.objects.bulk_update(changed, ['position', 'isEmployer'])
+    invalidate_user_discounts(user_company.user_id for user_company in created + changed)
+    stats['created_links'] += len(created)
+    stats['updated_links'] += len(changed)
+    link_ids = {}
+    for user_id, link_id in UserCompany.objects.filter(
+            company=company, user_id__in=user_ids.values()).order_by('id') \
+            .values_list('user_id', 'id'):
+        link_ids.setdefault(user_id, link_id)
+    return link_ids
+
+
+def sync_discounts(rows, user_ids, link_ids, stats):
+    """
+    Makes discounts of the links equal to discounts of the roster. Rows without discounts
+    column keep their discounts.
+    :param rows: rows of the batch
+    :type rows: list of dict
+    :param user_ids: ids of users by phone
+    :type user_ids: dict
+    :param link_ids: ids of links by user id
+    :type link_ids: dict
+    :param stats: counters of changes
+    :type stats: dict
+    """
+    rows = [row for row in rows if row['discounts'] is not None]
+    if not rows:
+        return
+    uuids = set().union(*(row['discounts'] for row in rows))
+    valid_uuids = set()
+    for value in uuids:
+        try:
+            valid_uuids.add(uuid.UUID(value))
+        except ValueError:
+            pass
+    discount_ids = {str(discount_uuid): discount_id for discount_uuid, discount_id in
+                    CompanyDiscount.objects.filter(uuid__in=valid_uuids)
+                    .values_list('uuid', 'id')}
+    wanted = {(link_ids[user_ids[row['phone']]], discount_ids[discount_uuid])
+              for row in rows for discount_uuid in row['discounts']
+              if discount_uuid in discount_ids}
+    through = UserCompany.company_discount.through
+    existing = {(link_id, discount_id): pk for pk, link_id, discount_id in
+                through.objects.filter(usercompany_id__in=[link_ids[user_ids[row['phone']]]
+                                                           for row in rows])
+                .values_list('id', 'usercompany_id', 'companydiscount_id')}
+    added = wanted - existing.keys()
+    removed_pairs = existing.keys() - wanted
+    removed = [existing[pair] for pair in removed_pairs]
+    through.objects.bulk_create([through(usercompany_id=link_id, companydiscount_id=discount_id)
+                                 for link_id, discount_id in added], ignore_conflicts=True)
+    through.objects.filter(id__in=removed).delete()
+    user_id_of_link = {link_id: user_id for user_id, link_id in link_ids.items()}
+    invalidate_user_discounts(user_id_of_link[link_id] for link_id, _ in added | removed_pairs)
+    stats['unknown_discounts'] += len(uuids - discount_ids.keys())
+    stats['added_discounts'] += len(added)
+    stats['removed_discounts'] += len(removed)
+
+
+def prune_user_companies(company, user_ids, batch_size):
+    """
+    Deletes links of the company with users who are absent in the roster
+    :param company: company of the roster
+    :type company: class Company
+    :param user_ids: ids of all users of the roster
+    :type user_ids: set of int
+    :param batch_size: amount of links deleted by one query
+    :type batch_size: int
+    :return: amount of deleted links
+    :rtype: int
+    """
+    stale = [(link_id, user_id) for link_id, user_id in
+             UserCompany.objects.filter(company=company).values_list('id', 'user_id')
+             if user_id not in user_ids]
+    for i in range(0, len(stale), batch_size):
+        UserCompany.objects.filter(id__in=[link_id for link_id, _ in
+                                           stale[i:i + batch_size]]).delete()
+    invalidate_user_discounts(user_id for _, user_id in stale)
+    return len(stale)
+
+
+def provision_employees(company, rows, batch_size=PROVISIONING_BATCH_SIZE, prune=False):
+    """
+    Provisions employees of the company from the roster by batches
+    :param company: company of the roster
+    :type company: class Company
+    :param rows: rows of the roster (see read_roster)
+    :type rows: iterable of dict
+    :param batch_size: amount of rows processed in one transaction
+    :type batch_size: int
+    :param prune: delete links of the company with users who are absent in the roster
+    :type prune: bool
+    :return: counters of changes
+    :rtype: dict
+    """
+    stats = dict.fromkeys(('rows', 'skipped', 'created_users', 'updated_users',
+                           'created_links', 'updated_links', 'added_discounts',
+                           'removed_discounts', 'unknown_discounts', 'pruned_links'), 0)
+    seen_user_ids = set()
+    for batch in iter_batches(rows, batch_size):
+        stats['rows'] += len(batch)
+        for row, phone in zip(batch, normalize_phones(row['phone'] for row in batch)):
+            row['phone'] = phone
+        # the last row of the same phone wins
+        unique = {row['phone']: row for row in batch if row['phone']}
+        stats['skipped'] += len(batch) - len(unique)
+        rows_of_batch = list(unique.values())
+        with transaction.atomic():
+            user_ids = upsert_users(rows_of_batch, stats)
+            link_ids = upsert_user_companies(company, rows_of_batch, user_ids, stats)
+            sync_discounts(rows_of_batch, user_ids, link_ids, stats)
+        seen_user_ids.update(user_ids.values())
+    if prune:
+        stats['pruned_links'] = prune_user_companies(company, seen_user_ids, batch_size)
+    return stats
@@ -0,0 +1,287 @@
+"""
+QR codes of users. Code of the user never changes, so its image is rendered once
+(in a pool of processes, because rendering is CPU bound), kept in the storage and served
+with immutable caching headers. Code of the user is cached, so the QR screen doesn't
+query the database.
+"""
+import logging
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import checks
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+from apps.auth_.instrumentation import record_cache
+
+logger = logging.getLogger(__name__)
+
+# scheme and host of the scan page which is encoded in QR, for example https://example.com,
+# without it host of the request is used and images can't be rendered outside of requests
+# (pregenerate_qr)
+QR_BASE_URL = getattr(settings, 'QR_BASE_URL', '')
+QR_RENDER_ASYNC = getattr(settings, 'QR_RENDER_ASYNC', True)
+QR_RENDER_WORKERS = getattr(settings, 'QR_RENDER_WORKERS', 2)
+QR_CODE_CACHE_TIMEOUT = getattr(settings, 'QR_CODE_CACHE_TIMEOUT', 24 * 60 * 60)
+QR_BOX_SIZE = 10
+QR_BORDER = 2
+# is a part of ETag, must be changed when rendering is changed
+QR_RENDER_VERSION = 2
+
+_pool = None
+
+
+def get_qr_model():
+    """
+    Returns model of QR codes of users (it is defined outside of this app)
+    :rtype: class QrUserImage
+    """
+    return get_user_model()._meta.get_field('qrcode').related_model
+
+
+def get_render_pool():
+    """
+    Returns pool of processes which render QR images, created on first use
+    :rtype: ProcessPoolExecutor
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=QR_RENDER_WORKERS)
+    return _pool
+
+
+def get_code_cache_key(user_id):
+    """
+    Returns key of the QR code of the user in the cache
+    :param user_id: id of the user
+    :rtype: str
+    """
+    return 'qr_code:{}'.format(user_id)
+
+
+def get_image_path(code):
+    """
+    Returns path of the QR image in the storage
+    :param code: QR code of the user
+    :type code: str
+    :rtype: str
+    """
+    return 'qr/{}/{}.png'.format(QR_RENDER_VERSION, code)
+
+
+def get_etag(code):
+    """
+    Returns strong ETag of the QR image, image depends only on the code and version
+    of rendering
+    :param code: QR code of the user
+    :type code: str
+    :rtype: str
+    """
+    return '"qr-{}-{}"'.format(QR_RENDER_VERSION, code)
+
+
+def has_base_url():
+    """
+    Checks that QR_BASE_URL contains scheme and host
+    :rtype: bool
+    """
+    return QR_BASE_URL.startswith(('http://', 'https://'))
+
+
+def check_base_url(app_configs, **kwargs):
+    """
+    System check which warns at startup that QR_BASE_URL is not set
+    :return: list of warnings
+    """
+    if has_base_url():
+        return []
+    return [checks.Warning('QR_BASE_URL is not set, QR codes encode host of the request '
+                           'and pregenerate_qr can\'t render images',
+                           hint='Set QR_BASE_URL to scheme and host of the site, '
+                                'for example https://example.com',
+                           id='auth_.W001')]
+
+
+def get_scan_url(code, request=None):
+    """
+    Returns absolute url of the scan page which is encoded in QR, scanners can't open
+    relative urls. Without QR_BASE_URL the url is built from the host of the request.
+    :param code: QR code of the user
+    :type code: str
+    :param request: current request, None outside of requests
+    :raises: :class:`ImproperlyConfigured`: QR_BASE_URL is not set and there is no request
+    :rtype: str
+    """
+    path = reverse('auth_:user-info', kwargs={'code': code})
+    if has_base_url():
+        return QR_BASE_URL.rstrip('/') + path
+    if request is None:
+        raise ImproperlyConfigured('QR_BASE_URL must be set to scheme and host of the site, '
+                                   'for example https://example.com')
+    return request.build_absolute_uri(path)
+
+
+def render_qr(data):
+    """
+    Renders QR image. Is called in processes of the pool, so it must not use the database.
+    :param data: encoded text
+    :type data: str
+    :return: PNG image
+    :rtype: bytes
+    """
+    import qrcode
+    qr = qrcode.QRCode(box_size=QR_BOX_SIZE, border=QR_BORDER)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = BytesIO()
+    qr.make_image().save(buffer)
+    return buffer.getvalue()
+
+
+def save_image(code, content):
+    """
+    Saves rendered QR image to the storage
+    :param code: QR code of the user
+    :type code: str
+    :param content: PNG image
+    :type content: bytes
+    """
+    path = get_image_path(code)
+    if not default_storage.exists(path):
+        default_storage.save(path, ContentFile(content))
+
+
+def get_image(code, request=None):
+    """
+    Returns QR image from the storage, renders it if it is absent
+    :param code: QR code of the user
+    :type code: str
+    :param request: current request
+    :return: PNG image
+    :rtype: bytes
+    """
+    path = get_image_path(code)
+    if default_storage.exists(path):
+        with default_storage.open(path) as file:
+            return file.read()
+    content = render_qr(get_scan_url(code, request))
+    save_image(code, content)
+    return content
+
+
+def schedule_rendering(code, request=None):
+    """
+    Renders QR image in the pool of processes and saves it
+    :param code: QR code of the user
+    :type code: str
+    :param request: current request
+    """
+    def save(future):
+        try:
+            save_image(code, future.result())
+        except Exception as e:
+            logger.exception(e)
+
+    if QR_RENDER_ASYNC:
+        get_render_pool().submit(render_qr, get_scan_url(code, request)).add_done_callback(save)
+
+
+def pre_render(codes, workers=QR_RENDER_WORKERS):
+    """
+    Renders QR images of the codes which have no images in the pool of processes
+    :param codes: QR codes of users
+    :type codes: list of str
+    :param workers: amount of processes
+    :type workers: int
+    :return: amount of rendered images
+    :rtype: int
+    """
+    codes = [code for code in codes if not default_storage.exists(get_image_path(code))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for code, content in zip(codes, pool.map(render_qr, map(get_scan_url, codes),
+                                                 chunksize=32)):
+            save_image(code, content)
+    return len(codes)
+
+
+def get_user_code(user, request=None):
+    """
+    Returns QR code of the user, creates it on the first call. Users have only one
+    QR code, so concurrent first calls get the same row.
+    :param user: user
+    :type user: class MainUser
+    :param request: current request
+    :return: QR code
+    :rtype: str
+    """
+    key = get_code_cache_key(user.pk)
+    code = cache.get(key)
+    record_cache('qr_code', code is not None)
+    if code is not None:
+        return code
+    qrcode, created = get_qr_model().objects.get_or_create(
+        user_id=user.pk, defaults={'code': str(uuid.uuid4())})
+    code = str(qrcode.code)
+    if created:
+        schedule_rendering(code, request)
+    cache.set(key, code, QR_CODE_CACHE_TIMEOUT)
+    return code
+
+
+def forget_user_code(user_id):
+    """
+    Removes QR code of the user from the cache
+    :param user_id: id of the user
+    """
+    cache.delete(get_code_cache_key(user_id))
+
+
+def get_code_user_id(code):
+    """
+    Returns id of the user by QR code, the code of the user never changes, so the id is cached
+    :param code: QR code of the user
+    :type code: str
+    :return: id of the user or None if there is no such code
+    :rtype: int
+    """
+    key = 'qr_user:{}'.format(code)
+    user_id = cache.get(key)
+    record_cache('qr_user', user_id is not None)
+    if user_id is None:
+        user_id = get_qr_model().objects.filter(code=code) \
+            .values_list('user_id', flat=True).first()
+        if user_id is not None:
+            cache.set(key, user_id, QR_CODE_CACHE_TIMEOUT)
+    return user_id
+
+
+def forget_code(code):
+    """
+    Removes user of the QR code from the cache
+    :param code: QR code
+    """
+    cache.delete('qr_user:{}'.format(code))
+
+
+def create_missing_codes(batch_size=1000):
+    """
+    Creates QR codes of users who have no codes
+    :param batch_size: amount of codes created by one query
+    :type batch_size: int
+    :return: amount of created codes
+    :rtype: int
+    """
+    qr_model = get_qr_model()
+    user_ids = list(get_user_model().objects.filter(qrcode__isnull=True)
+                    .values_list('id', flat=True))
+    for i in range(0, len(user_ids), batch_size):
+        codes = [qr_model(user_id=user_id, code=str(uuid.uuid4()))
+                 for user_id in user_ids[i:i + batch_size]]
+        qr_model.objects.bulk_create(codes, ignore_conflicts=True)
+    return len(user_ids)
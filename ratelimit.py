@@ -0,0 +1,139 @@
+"""
+Rate limiting of activations by phone and client ip and of lookups of QR codes by client ip,
+counters are kept in the cache.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+
+from apps.utils import codes, constants
+from apps.utils.exceptions import CommonException
+
+TOO_MANY_REQUESTS = 'Слишком много запросов, попробуйте позже'
+
+# limit and window (in seconds) for each scope and activation type
+DEFAULT_ACTIVATION_RATE_LIMITS = {
+    'phone': (5, 10 * 60),
+    'ip': (30, 10 * 60),
+}
+ACTIVATION_RATE_LIMITS = getattr(settings, 'ACTIVATION_RATE_LIMITS', {
+    constants.LOGIN: DEFAULT_ACTIVATION_RATE_LIMITS,
+})
+# limit of looked up QR codes and window (in seconds) for each client ip
+LOOKUP_RATE_LIMIT = getattr(settings, 'LOOKUP_RATE_LIMIT', (1000, 60))
+# META key with client ip, for example HTTP_X_REAL_IP or HTTP_X_FORWARDED_FOR behind proxy
+RATELIMIT_IP_META_KEY = getattr(settings, 'RATELIMIT_IP_META_KEY', 'REMOTE_ADDR')
+# amount of own proxies which append ip of their peer to X-Forwarded-For
+RATELIMIT_TRUSTED_PROXIES = getattr(settings, 'RATELIMIT_TRUSTED_PROXIES', 1)
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding window limiter. Keeps counters of the current and previous fixed windows and
+    estimates amount of hits in the last window by weighting the previous counter.
+    Counters are incremented atomically in the cache.
+
+    ...
+
+    Methods
+    -------
+    hit(self, key, amount=1)
+        counts the hits and returns True if the limit is not exceeded
+    """
+
+    def __init__(self, scope, limit, window):
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+
+    def get_cache_key(self, key, window_number):
+        """
+        Returns key of the counter of the fixed window
+        :param key: phone, ip etc.
+        :param window_number: number of the window since epoch
+        :return: key of the cache
+        :rtype: str
+        """
+        return 'ratelimit:{}:{}:{}'.format(self.scope, key, window_number)
+
+    def hit(self, key, amount=1):
+        """
+        Counts the hits. Rejected hits are counted too, so clients which keep sending
+        requests stay blocked.
+        :param key: phone, ip etc.
+        :type key: str
+        :param amount: amount of hits, for example amount of codes in the request
+        :type amount: int
+        :return: True if the hits are allowed
+        :rtype: bool
+        """
+        now = time.time()
+        window_number, elapsed = divmod(now, self.window)
+        current_key = self.get_cache_key(key, int(window_number))
+        cache.add(current_key, 0, self.window * 2)
+        try:
+            current = cache.incr(current_key, amount)
+        except ValueError:
+            # counter is evicted between add and incr
+            cache.set(current_key, amount, self.window * 2)
+            current = amount
+        previous = cache.get(self.get_cache_key(key, int(window_number) - 1), 0)
+        estimated = previous * (1 - elapsed / self.window) + current
+        return estimated <= self.limit
+
+
+def get_client_ip(request):
+    """
+    Returns ip of the client. If ip is taken from X-Forwarded-For header, left ips are set
+    by the client and can be forged, so the ip added by the farthest of
+    RATELIMIT_TRUSTED_PROXIES proxies is used.
+    :param request: request of the view
+    :return: ip of the client
+    :rtype: str
+    """
+    ip = request.META.get(RATELIMIT_IP_META_KEY) or request.META.get('REMOTE_ADDR', '')
+    ips = [value.strip() for value in ip.split(',') if value.strip()]
+    if not ips:
+        return ''
+    return ips[-min(max(RATELIMIT_TRUSTED_PROXIES, 1), len(ips))]
+
+
+def check_activation_rate(activation_type, phone=None, ip=None):
+    """
+    Checks limits of activations for the phone and the ip
+    :param activation_type: type of activation
+    :type activation_type: str
+    :param phone: phone of user
+    :type phone: str
+    :param ip: ip of the client
+    :type ip: str
+    :raises: :class:`CommonException`: limit of phone or ip is exceeded
+    """
+    limits = ACTIVATION_RATE_LIMITS.get(activation_type, DEFAULT_ACTIVATION_RATE_LIMITS)
+    for scope, key in (('ip', ip), ('phone', phone)):
+        if not key or scope not in limits:
+            continue
+        limit, window = limits[scope]
+        limiter = SlidingWindowLimiter('activation:{}:{}'.format(activation_type, scope),
+                                       limit, window)
+        if not limiter.hit(key):
+            raise CommonException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                  code=codes.BAD_REQUEST, detail=TOO_MANY_REQUESTS)
+
+
+def check_lookup_rate(ip, amount):
+    """
+    Checks limit of QR codes looked up by the ip. Each code is counted, so codes can't be
+    enumerated by big batches.
+    :param ip: ip of the client
+    :type ip: str
+    :param amount: amount of codes in the request
+    :type amount: int
+    :raises: :class:`CommonException`: limit of the ip is exceeded
+    """
+    limit, window = LOOKUP_RATE_LIMIT
+    if not SlidingWindowLimiter('lookup:ip', limit, window).hit(ip, amount):
+        raise CommonException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                              code=codes.BAD_REQUEST, detail=TOO_MANY_REQUESTS)
@@ -0,0 +1,162 @@
+"""
+Search of users and discounts for autocompletes. On PostgreSQL icontains filters are
+served by trigram indexes and results are ranked by trigram similarity, on other
+databases candidates are taken from the n-gram lookup table.
+"""
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, Count, Case, When, Value, IntegerField
+from django.db.models.functions import Greatest
+
+from apps.auth_.models import MainUser, CompanyDiscount, SearchNgram
+
+SEARCH_NGRAM_SIZE = 3
+SEARCH_USE_TRIGRAM = getattr(settings, 'SEARCH_USE_TRIGRAM', True)
+SEARCH_ORDERING = ('-rank', 'id')
+
+USER_SEARCH_FIELDS = ('phone', 'full_name', 'username')
+DISCOUNT_SEARCH_FIELDS = ('company__name', 'description')
+
+
+def use_trigram():
+    """
+    Returns True if trigram indexes of PostgreSQL are used
+    :rtype: bool
+    """
+    return SEARCH_USE_TRIGRAM and connection.vendor == 'postgresql'
+
+
+def get_ngrams(value, size=SEARCH_NGRAM_SIZE):
+    """
+    Returns lowercased n-grams of the value
+    :param value: text
+    :type value: str
+    :param size: length of n-gram
+    :type size: int
+    :return: n-grams, empty set if value is shorter than n-gram
+    :rtype: set of str
+    """
+    value = (value or '').lower()
+    return {value[i:i + size] for i in range(len(value) - size + 1)}
+
+
+def search(queryset, kind, fields, q):
+    """
+    Filters queryset by q in any of the fields and ranks results.
+    :param queryset: queryset to search in
+    :param kind: kind of objects in the n-gram table
+    :type kind: str
+    :param fields: searched fields
+    :type fields: tuple of str
+    :param q: entered text
+    :type q: str
+    :return: queryset annotated with rank and ordered by SEARCH_ORDERING
+    :rtype: queryset
+    """
+    if not q:
+        return queryset.annotate(rank=Value(0, output_field=IntegerField())) \
+            .order_by(*SEARCH_ORDERING)
+    contains = reduce(or_, [Q(**{field + '__icontains': q}) for field in fields])
+    if use_trigram():
+        from django.contrib.postgres.search import TrigramSimilarity
+        rank = Greatest(*[TrigramSimilarity(field, q) for field in fields])
+        return queryset.filter(contains).annotate(rank=rank).order_by(*SEARCH_ORDERING)
+    grams = get_ngrams(q)
+    if grams:
+        candidates = SearchNgram.objects.filter(kind=kind, gram__in=grams) \
+            .values('object_id').annotate(matched=Count('id')) \
+            .filter(matched=len(grams)).values('object_id')
+        queryset = queryset.filter(id__in=candidates)
+    prefix = reduce(or_, [Q(**{field + '__istartswith': q}) for field in fields])
+    rank = Case(When(prefix, then=Value(2)), default=Value(1), output_field=IntegerField())
+    return queryset.filter(contains).annotate(rank=rank).order_by(*SEARCH_ORDERING)
+
+
+def search_users(q):
+    """
+    Searches users by phone, full name or username
+    :param q: entered text
+    :type q: str
+    :return: ranked queryset of users
+    :rtype: queryset of class MainUser
+    """
+    return search(MainUser.objects.all(), SearchNgram.USER, USER_SEARCH_FIELDS, q)
+
+
+def search_discounts(q):
+    """
+    Searches discounts by name of the company or description
+    :param q: entered text
+    :type q: str
+    :return: ranked queryset of discounts
+    :rtype: queryset of class CompanyDiscount
+    """
+    return search(CompanyDiscount.objects.all(), SearchNgram.DISCOUNT,
+                  DISCOUNT_SEARCH_FIELDS, q)
+
+
+def get_object_ngrams(obj, fields):
+    """
+    Returns n-grams of each field of the object, n-grams don't cross borders of fields
+    :param obj: model instance
+    :param fields: searched fields, related fields are separated by '__'
+    :type fields: tuple of str
+    :return: n-grams
+    :rtype: set of str
+    """
+    grams = set()
+    for field in fields:
+        value = obj
+        for name in field.split('__'):
+            value = getattr(value, name, None) if value is not None else None
+        grams |= get_ngrams(value)
+    return grams
+
+
+def index_objects(kind, objects, fields):
+    """
+    Replaces n-grams of the objects in the lookup table
+    :param kind: kind of objects
+    :type kind: str
+    :param objects: model instances
+    :param fields: searched fields
+    :type fields: tuple of str
+    """
+    objects = list(objects)
+    SearchNgram.objects.filter(kind=kind, object_id__in=[obj.id for obj in objects]).delete()
+    SearchNgram.objects.bulk_create(
+        [SearchNgram(kind=kind, object_id=obj.id, gram=gram)
+         for obj in objects for gram in get_object_ngrams(obj, fields)],
+        batch_size=1000)
+
+
+def index_users(users):
+    """
+    Replaces n-grams of the users in the lookup table
+    :param users: users
+    :type users: iterable of class MainUser
+    """
+    index_objects(SearchNgram.USER, users, USER_SEARCH_FIELDS)
+
+
+def index_discounts(discounts):
+    """
+    Replaces n-grams of the discounts in the lookup table, companies must be selected
+    :param discounts: discounts
+    :type discounts: iterable of class CompanyDiscount
+    """
+    index_objects(SearchNgram.DISCOUNT, discounts, DISCOUNT_SEARCH_FIELDS)
+
+
+def remove_from_index(kind, object_id):
+    """
+    Removes n-grams of deleted object
+    :param kind: kind of the object
+    :type kind: str
+    :param object_id: id of the object
+    :type object_id: int
+    """
+    SearchNgram.objects.filter(kind=kind, object_id=object_id).delete()
@@ -5,15 +5,18 @@ from calendar import timegm
 from datetime import timedelta, datetime
 from django.contrib.auth import get_user_model
 from apps.auth_.models import Activation, MainUser
+from apps.auth_.phones import normalize_phone
+from apps.auth_.sessions import rotate_session_secret
+from apps.auth_.token import (get_secret_key, encode_with_secret, rotate_secret,
+                              get_refreshed_token, remember_refreshed_token,
+                              REFRESH_GRACE_WAIT)
 from apps.auth_.validators import phone_validator
 from apps.utils.exceptions import CommonException
 from apps.utils import codes, messages
 from rest_framework_jwt.settings import api_settings
-from rest_framework_jwt.utils import jwt_get_secret_key
 from rest_framework_jwt.serializers import VerificationBaseSerializer, \
-    jwt_payload_handler, jwt_encode_handler
+    jwt_payload_handler
 import jwt
-import uuid
 import logging
 
 from rest_framework import serializers
@@ -22,6 +25,8 @@ User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+LOOKUP_MAX_CODES = 100
+
 
 class ActivationSerializer(serializers.ModelSerializer):
     """
@@ -36,17 +41,36 @@ class ActivationSerializer(serializers.ModelSerializer):
 
 class ActivationCodeSerializer(serializers.Serializer):
     """
-    Serializer to accept code for activating account
+    Serializer to accept code for activating account and push token of the device
     """
     code = serializers.CharField(max_length=4)
+    push_token = serializers.CharField(max_length=255, required=False, allow_blank=True)
 
 
 class PhoneSerializer(serializers.Serializer):
     """
-    Serializer to accept phone of user
+    Serializer to accept phone of user. Phone is normalized to E.164, so the same user
+    is found however the phone is written (provisioned employees are kept in E.164 too).
     """
     phone = serializers.CharField(max_length=30, validators=[phone_validator])
 
+    def validate_phone(self, value):
+        """
+        Returns the phone in E.164
+        :param value: valid phone as it is entered
+        :type value: str
+        :rtype: str
+        """
+        return normalize_phone(value)
+
+
+class QrCodesSerializer(serializers.Serializer):
+    """
+    Serializer to accept QR codes of users which are scanned by partner's terminal
+    """
+    codes = serializers.ListField(child=serializers.CharField(max_length=50),
+                                  min_length=1, max_length=LOOKUP_MAX_CODES)
+
 
 class RegistrationSerializer(serializers.ModelSerializer):
     """
@@ -107,8 +131,12 @@ class UserProfileSerializer(serializers.Serializer):
 
 class CustomRefreshJSONWebTokenSerializer(VerificationBaseSerializer):
     """
-    Refresh an access token.
+    Refresh an access token. Secret of the session of the token (or of the user for tokens
+    without session) is changed by compare and set, concurrent refreshes of the same token
+    get the token issued by the first one.
     """
+    # secret which the refreshed token is signed with
+    token_secret = None
 
     def jwt_decode_handler(self, token):
         try:
@@ -117,8 +145,8 @@ class CustomRefreshJSONWebTokenSerializer(VerificationBaseSerializer):
             }
             # get user from token, BEFORE verification, to get user secret key
             unverified_payload = jwt.decode(token, None, False)
-            secret_key = jwt_get_secret_key(unverified_payload)
-            return jwt.decode(
+            secret_key = get_secret_key(unverified_payload)
+            payload = jwt.decode(
                 token,
                 api_settings.JWT_PUBLIC_KEY or secret_key,
                 api_settings.JWT_VERIFY,
@@ -128,6 +156,9 @@ class CustomRefreshJSONWebTokenSerializer(VerificationBaseSerializer):
                 issuer=api_settings.JWT_ISSUER,
                 algorithms=[api_settings.JWT_ALGORITHM]
             )
+            if api_settings.JWT_GET_USER_SECRET_KEY:
+                self.token_secret = secret_key
+            return payload
         except jwt.InvalidSignatureError as e:
             logger.error(e)
             raise CommonException(code=codes.TOKEN_EXPIRED, detail=str(e))
@@ -152,11 +183,12 @@ class CustomRefreshJSONWebTokenSerializer(VerificationBaseSerializer):
 
     def validate(self, attrs):
         token = attrs['token']
+        issued_token = get_refreshed_token(token)
+        if issued_token is not None:
+            return {'token': issued_token, 'user': None}
 
         payload = self._check_payload(token=token)
         user = self._check_user(payload=payload)
-        user.jwt_secret = uuid.uuid4()
-        user.save()
         # Get and check 'orig_iat'
         orig_iat = payload.get('orig_iat')
 
@@ -176,10 +208,29 @@ class CustomRefreshJSONWebTokenSerializer(VerificationBaseSerializer):
             raise CommonException(code=codes.SERVER_ERROR,
                                   detail=messages.ORIG_IAD_FIELD_IS_REQUIRED)
 
+        sid = payload.get('sid')
+        if sid is not None:
+            new_secret = rotate_session_secret(sid, self.token_secret)
+        else:
+            new_secret = rotate_secret(user.pk, self.token_secret or user.jwt_secret)
+        if new_secret is None:
+            # concurrent refresh of the same token has changed the secret
+            issued_token = get_refreshed_token(token, wait=REFRESH_GRACE_WAIT)
+            if issued_token is None:
+                raise CommonException(code=codes.TOKEN_EXPIRED,
+                                      detail=messages.SIGNATURE_HAS_EXPIRED)
+            return {'token': issued_token, 'user': user}
+        if sid is None:
+            user.jwt_secret = new_secret
+
         new_payload = jwt_payload_handler(user)
         new_payload['orig_iat'] = now_timestamp
+        if sid is not None:
+            new_payload['sid'] = sid
+        new_token = encode_with_secret(new_payload, new_secret)
+        remember_refreshed_token(token, new_token)
 
         return {
-            'token': jwt_encode_handler(new_payload),
+            'token': new_token,
             'user': user
         }
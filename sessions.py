@@ -0,0 +1,285 @@
+"""
+Sessions of users on devices. Revoked sessions are kept in a bloom filter in the cache,
+which is rebuilt from the table when it is lost, so checking a token needs no query:
+sid which is absent in the filter is surely not revoked, only rare false positives are
+checked in the database.
+"""
+import hashlib
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_jwt.settings import api_settings
+
+from apps.auth_.instrumentation import record_cache
+from apps.auth_.models import UserSession
+
+SESSION_CACHE_TIMEOUT = getattr(settings, 'SESSION_CACHE_TIMEOUT', 60 * 60)
+# 2^20 bits (128 KB) keep false positives about 1% for 100 000 revoked sessions
+SESSION_BLOOM_BITS = getattr(settings, 'SESSION_BLOOM_BITS', 2 ** 20)
+SESSION_BLOOM_HASHES = getattr(settings, 'SESSION_BLOOM_HASHES', 7)
+SESSION_BLOOM_KEY = 'auth_sessions:revoked'
+SESSION_BLOOM_VERSION_KEY = 'auth_sessions:revoked:version'
+SESSION_BLOOM_LOCK_KEY = 'auth_sessions:revoked:lock'
+SESSION_BLOOM_LOCK_TIMEOUT = 10
+SESSION_BLOOM_LOCK_WAIT = 1
+# field of push tokens of users (related name push_tokens) which keeps the token of device
+SESSION_PUSH_TOKEN_FIELD = getattr(settings, 'SESSION_PUSH_TOKEN_FIELD', 'token')
+
+# version and filter of revoked sessions which are loaded by this process
+_local_filter = None
+
+
+class BloomFilter:
+    """
+    Set of strings which can answer 'surely absent' or 'maybe present'.
+
+    ...
+
+    Methods
+    -------
+    add(self, value)
+        adds the value to the set
+    __contains__(self, value)
+        checks if the value may be in the set
+    """
+
+    def __init__(self, bits=SESSION_BLOOM_BITS, hashes=SESSION_BLOOM_HASHES, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray(bits // 8)
+
+    def _positions(self, value):
+        digest = hashlib.sha256(str(value).encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        """
+        Adds the value to the set
+        :param value: value
+        """
+        for position in self._positions(value):
+            self.data[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self.data[position // 8] & (1 << (position % 8))
+                   for position in self._positions(value))
+
+
+def get_revocation_window():
+    """
+    Returns how long revoked sessions are kept in the filter, older tokens can't be
+    refreshed anyway
+    :rtype: timedelta
+    """
+    delta = api_settings.JWT_REFRESH_EXPIRATION_DELTA
+    return delta if isinstance(delta, timedelta) else timedelta(seconds=delta)
+
+
+def build_revoked_filter():
+    """
+    Builds the filter from sessions which are revoked during the revocation window
+    :rtype: BloomFilter
+    """
+    bloom = BloomFilter()
+    for sid in UserSession.objects.filter(
+            revoked_at__gte=timezone.now() - get_revocation_window()) \
+            .values_list('sid', flat=True).iterator():
+        bloom.add(sid)
+    return bloom
+
+
+def save_revoked_filter(bloom):
+    """
+    Saves the filter with the new version, processes reload it when they see the version
+    :param bloom: filter of revoked sessions
+    :type bloom: BloomFilter
+    """
+    version = uuid.uuid4().hex
+    cache.set(SESSION_BLOOM_KEY, {'version': version, 'data': bytes(bloom.data)}, None)
+    cache.set(SESSION_BLOOM_VERSION_KEY, version, None)
+
+
+def acquire_lock():
+    """
+    Takes the lock of changes of the filter
+    :return: True if the lock is taken
+    :rtype: bool
+    """
+    deadline = time.monotonic() + SESSION_BLOOM_LOCK_WAIT
+    while not cache.add(SESSION_BLOOM_LOCK_KEY, 1, SESSION_BLOOM_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def get_revoked_filter():
+    """
+    Returns the filter of revoked sessions. The filter is kept in the process until its
+    version in the cache is changed, so usually only the version is read.
+    :return: filter or None if it is lost and is being rebuilt by other process
+    :rtype: BloomFilter
+    """
+    global _local_filter
+    version = cache.get(SESSION_BLOOM_VERSION_KEY)
+    local = _local_filter
+    if version is not None and local is not None and local[0] == version:
+        return local[1]
+    stored = cache.get(SESSION_BLOOM_KEY)
+    record_cache('revoked_sessions', stored is not None)
+    if stored is not None:
+        bloom = BloomFilter(data=stored['data'])
+        _local_filter = (stored['version'], bloom)
+        return bloom
+    if not cache.add(SESSION_BLOOM_LOCK_KEY, 1, SESSION_BLOOM_LOCK_TIMEOUT):
+        return None
+    try:
+        bloom = build_revoked_filter()
+        save_revoked_filter(bloom)
+    finally:
+        cache.delete(SESSION_BLOOM_LOCK_KEY)
+    return bloom
+
+
+def is_revoked(sid):
+    """
+    Checks if the session is revoked. Query is made only if the filter can't answer surely
+    or the filter is being rebuilt.
+    :param sid: sid of the session
+    :rtype: bool
+    """
+    bloom = get_revoked_filter()
+    if bloom is not None and str(sid) not in bloom:
+        return False
+    return UserSession.objects.filter(sid=sid, revoked_at__isnull=False).exists()
+
+
+def get_cache_key(sid):
+    """
+    Returns key of the session in the cache
+    :param sid: sid of the session
+    :rtype: str
+    """
+    return 'auth_session:{}'.format(sid)
+
+
+def get_session_secret(sid):
+    """
+    Returns owner and secret of the session from the shared cache or the database.
+    Secret is changed on each refresh, so it is not kept in the cache of the process,
+    which other processes can't evict.
+    :param sid: sid of the session
+    :return: id of the user and secret or None if there is no such session
+    :rtype: tuple
+    """
+    key = get_cache_key(sid)
+    value = cache.get(key)
+    record_cache('session', value is not None)
+    if value is None:
+        value = UserSession.objects.filter(sid=sid, revoked_at__isnull=True) \
+            .values_list('user_id', 'secret').first()
+        if value is None:
+            return None
+        cache.set(key, value, SESSION_CACHE_TIMEOUT)
+    return value
+
+
+def forget_session(sid):
+    """
+    Removes the session from the cache now and once more after commit of the current
+    transaction, so the row which is read before the commit doesn't stay in the cache
+    :param sid: sid of the session
+    """
+    key = get_cache_key(sid)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def create_session(user, device='', push_token=''):
+    """
+    Creates session of the user on the device
+    :param user: user who logs in
+    :type user: class MainUser
+    :param device: user agent of the device
+    :type device: str
+    :param push_token: push token of the device
+    :type push_token: str
+    :rtype: class UserSession
+    """
+    return UserSession.objects.create(user=user, device=(device or '')[:255],
+                                      push_token=(push_token or '')[:255])
+
+
+def rotate_session_secret(sid, old_secret):
+    """
+    Changes secret of the session only if it is still the secret which the refreshed token
+    is signed with (compare and set)
+    :param sid: sid of the session
+    :param old_secret: secret of the refreshed token, None if tokens are signed with
+    the common key
+    :return: new secret or None if the secret is already changed or the session is revoked
+    :rtype: UUID
+    """
+    new_secret = uuid.uuid4()
+    sessions = UserSession.objects.filter(sid=sid, revoked_at__isnull=True)
+    if old_secret is not None:
+        sessions = sessions.filter(secret=old_secret)
+    updated = sessions.update(secret=new_secret, refreshed_at=timezone.now())
+    forget_session(sid)
+    return new_secret if updated else None
+
+
+def revoke_session(sid):
+    """
+    Revokes the session and adds it to the filter. If the filter can't be changed under
+    the lock, it is removed and is rebuilt from the table by the next check.
+    :param sid: sid of the session
+    :return: True if the session was active
+    :rtype: bool
+    """
+    revoked = UserSession.objects.filter(sid=sid, revoked_at__isnull=True) \
+        .update(revoked_at=timezone.now())
+    forget_session(sid)
+    if not acquire_lock():
+        cache.delete(SESSION_BLOOM_KEY)
+        cache.set(SESSION_BLOOM_VERSION_KEY, uuid.uuid4().hex, None)
+        return bool(revoked)
+    try:
+        stored = cache.get(SESSION_BLOOM_KEY)
+        bloom = BloomFilter(data=stored['data']) if stored is not None \
+            else build_revoked_filter()
+        bloom.add(str(sid))
+        save_revoked_filter(bloom)
+    finally:
+        cache.delete(SESSION_BLOOM_LOCK_KEY)
+    return bool(revoked)
+
+
+def delete_push_tokens(user, sid=None, push_token=None):
+    """
+    Deletes push tokens of the device which logs out, so it doesn't get pushes of the user.
+    Token of the device is taken from the request or from the session. All tokens of
+    the user are deleted if the user has no other active sessions or the token is issued
+    without session.
+    :param user: user who logs out
+    :type user: class MainUser
+    :param sid: sid of the revoked session
+    :param push_token: push token of the device from the request
+    :type push_token: str
+    """
+    if sid is None or not user.sessions.filter(revoked_at__isnull=True).exists():
+        user.push_tokens.all().delete()
+        return
+    tokens = {push_token} | set(UserSession.objects.filter(sid=sid)
+                                .values_list('push_token', flat=True))
+    tokens.discard(None)
+    tokens.discard('')
+    if tokens:
+        user.push_tokens.filter(**{SESSION_PUSH_TOKEN_FIELD + '__in': tokens}).delete()
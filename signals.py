@@ -0,0 +1,143 @@
+"""
+Signal handlers of auth_ app which keep caches consistent with the database.
+"""
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from apps.auth_.discounts import invalidate_fan_catalog, invalidate_user_discounts
+from apps.auth_.models import (MainUser, Company, CompanyDiscount, FanDiscount, UserCompany,
+                               SearchNgram)
+from apps.auth_.qr import get_qr_model, forget_user_code, forget_code
+from apps.auth_.search import (use_trigram, index_users, index_discounts, remove_from_index,
+                               USER_SEARCH_FIELDS)
+from apps.auth_.user_cache import invalidate_user_on_commit, USER_PROJECTION_FIELDS
+
+
+@receiver(post_save, sender=MainUser)
+def invalidate_saved_user(sender, instance, update_fields=None, **kwargs):
+    """
+    Removes the user from the cache if cached fields (jwt secret, activity etc.) could be
+    changed. Saves of other fields only (for example last_login) keep the cache.
+    """
+    if update_fields and not set(update_fields) & set(USER_PROJECTION_FIELDS):
+        return
+    invalidate_user_on_commit(instance.pk)
+
+
+@receiver(post_delete, sender=MainUser)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    """
+    Removes deleted user from the cache
+    """
+    invalidate_user_on_commit(instance.pk)
+
+
+@receiver(post_save, sender=MainUser)
+def index_saved_user(sender, instance, update_fields=None, **kwargs):
+    """
+    Updates n-grams of the user if searched fields could be changed
+    """
+    if use_trigram():
+        return
+    if update_fields and not set(update_fields) & set(USER_SEARCH_FIELDS):
+        return
+    index_users([instance])
+
+
+@receiver(post_delete, sender=MainUser)
+def unindex_deleted_user(sender, instance, **kwargs):
+    """
+    Removes n-grams of deleted user
+    """
+    if not use_trigram():
+        remove_from_index(SearchNgram.USER, instance.pk)
+
+
+@receiver(post_save, sender=CompanyDiscount)
+def index_saved_discount(sender, instance, **kwargs):
+    """
+    Updates n-grams of the discount
+    """
+    if not use_trigram():
+        index_discounts([instance])
+
+
+@receiver(post_delete, sender=CompanyDiscount)
+def unindex_deleted_discount(sender, instance, **kwargs):
+    """
+    Removes n-grams of deleted discount
+    """
+    if not use_trigram():
+        remove_from_index(SearchNgram.DISCOUNT, instance.pk)
+
+
+@receiver(post_save, sender=Company)
+def index_company_discounts(sender, instance, **kwargs):
+    """
+    Updates n-grams of the discounts of the company, because name of the company is searched
+    """
+    if not use_trigram():
+        index_discounts(instance.company_discounts.select_related('company'))
+
+
+@receiver(post_save, sender=FanDiscount)
+@receiver(post_delete, sender=FanDiscount)
+@receiver(post_save, sender=CompanyDiscount)
+@receiver(post_delete, sender=CompanyDiscount)
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+@receiver(m2m_changed, sender=FanDiscount.company_discounts.through)
+def invalidate_fan_catalog_on_change(sender, action=None, **kwargs):
+    """
+    Makes new version of the fan catalog when fan discounts, discounts or companies
+    are changed
+    """
+    if action is None or action.startswith('post_'):
+        invalidate_fan_catalog()
+
+
+@receiver(post_delete, sender=get_qr_model())
+def forget_deleted_qrcode(sender, instance, **kwargs):
+    """
+    Removes deleted QR code of the user from the cache
+    """
+    forget_user_code(instance.user_id)
+    forget_code(str(instance.code))
+
+
+@receiver(post_save, sender=MainUser)
+@receiver(post_delete, sender=MainUser)
+def invalidate_user_scan_page(sender, instance, update_fields=None, **kwargs):
+    """
+    Makes new version of the scan page of the user, saves of technical fields only
+    (last login, jwt secret) keep it
+    """
+    if update_fields and set(update_fields) <= {'last_login', 'jwt_secret', 'password'}:
+        return
+    invalidate_user_discounts([instance.pk])
+
+
+@receiver(post_save, sender=UserCompany)
+@receiver(post_delete, sender=UserCompany)
+def invalidate_user_company(sender, instance, **kwargs):
+    """
+    Makes new version of the scan page of the user when his company is changed
+    """
+    invalidate_user_discounts([instance.user_id])
+
+
+@receiver(m2m_changed, sender=UserCompany.company_discount.through)
+def invalidate_user_company_discounts(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Makes new versions of the scan pages of the users whose discounts are changed
+    """
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_user_discounts([instance.user_id])
+    elif pk_set:
+        invalidate_user_discounts(UserCompany.objects.filter(id__in=pk_set)
+                                  .values_list('user_id', flat=True))
+    else:
+        # links of the discount are cleared, version of the catalog is a part of all versions
+        invalidate_fan_catalog()
@@ -0,0 +1,466 @@
+"""
+Providers which deliver sms codes. Provider is chosen by SMS_PROVIDER setting,
+in-memory provider is used to send sms offline (tests, local development).
+Messages of a batch are sent concurrently, so one worker doesn't wait for the gateway
+once per message. Hedged provider sends by several providers: when the primary one is
+slower than usual, the same code is sent by the next one, providers which keep failing
+are skipped by circuit breakers.
+"""
+import abc
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SMS_PROVIDER = 'apps.auth_.sms_providers.HedgedSmsProvider'
+# providers of hedged provider in order of priority, each is a path of the class or
+# dict with BACKEND (path) and OPTIONS (arguments of the class)
+SMS_PROVIDERS = getattr(settings, 'SMS_PROVIDERS',
+                        ['apps.auth_.sms_providers.GatewaySmsProvider'])
+# seconds, total time to send one sms by all providers
+SMS_SEND_TIMEOUT = getattr(settings, 'SMS_SEND_TIMEOUT', 10)
+# next provider is started when the current one is slower than this percentile of its
+# latency, the delay is kept between min and max
+SMS_HEDGE_PERCENTILE = getattr(settings, 'SMS_HEDGE_PERCENTILE', 95)
+SMS_HEDGE_MIN_DELAY = getattr(settings, 'SMS_HEDGE_MIN_DELAY', 0.05)
+SMS_HEDGE_MAX_DELAY = getattr(settings, 'SMS_HEDGE_MAX_DELAY', 2.0)
+SMS_LATENCY_WINDOW = 200
+SMS_LATENCY_MIN_SAMPLES = 20
+# provider is skipped for SMS_BREAKER_RESET seconds after this amount of failures in a row
+SMS_BREAKER_FAILURES = getattr(settings, 'SMS_BREAKER_FAILURES', 5)
+SMS_BREAKER_RESET = getattr(settings, 'SMS_BREAKER_RESET', 30)
+# seconds to remember delivered messages, longer than all retries of the queue
+SMS_DEDUPE_TIMEOUT = getattr(settings, 'SMS_DEDUPE_TIMEOUT', 24 * 60 * 60)
+# amount of messages of a batch which are sent at the same time by one worker
+SMS_SEND_CONCURRENCY = getattr(settings, 'SMS_SEND_CONCURRENCY', 20)
+
+_provider = None
+_provider_lock = threading.Lock()
+_send_pool = None
+
+
+class BaseSmsProvider(abc.ABC):
+    """
+    Base class of sms provider. Provider without send can't be instantiated, so
+    misconfigured SMS_PROVIDER fails when the provider is created.
+
+    ...
+
+    Methods
+    -------
+    send(self, phone, code, message_id=None)
+        sends sms code to the phone, raises exception if sms is not sent
+    send_batch(self, messages)
+        sends several messages and returns error of each message
+    """
+    name = 'base'
+
+    @abc.abstractmethod
+    def send(self, phone, code, message_id=None):
+        """
+        Sends sms code to the phone
+        :param phone: phone of user
+        :type phone: str
+        :param code: sms code
+        :type code: str
+        :param message_id: id of the message of the queue, all sends of the message
+        are one sms for the user
+        :type message_id: int
+        :raises: :class:`Exception`: sms is not sent
+        """
+
+    def send_batch(self, messages):
+        """
+        Sends several messages concurrently. Providers which have batch api override this
+        function.
+        :param messages: messages of the queue
+        :type messages: list of class SmsMessage
+        :return: pairs of message and error (None if message is sent) in the same order
+        :rtype: list of tuples
+        """
+        if len(messages) < 2 or SMS_SEND_CONCURRENCY < 2:
+            return [(message, self._send_message(message)) for message in messages]
+        return list(zip(messages, get_send_pool().map(self._send_message, messages)))
+
+    def _send_message(self, message):
+        """
+        Sends one message of the queue
+        :param message: message of the queue
+        :type message: class SmsMessage
+        :return: error or None if message is sent
+        :rtype: str
+        """
+        try:
+            self.send(message.phone, message.code, message_id=message.id)
+        except Exception as e:
+            logger.warning('Sms to %s is not sent by %s: %s', message.phone, self.name, e)
+            return str(e) or e.__class__.__name__
+        return None
+
+
+class GatewaySmsProvider(BaseSmsProvider):
+    """
+    Sends sms by the sms gateway of the project (apps.utils.sms).
+    """
+    name = 'gateway'
+
+    def send(self, phone, code, message_id=None):
+        from apps.utils.sms import send_sms_code
+        send_sms_code(phone, code)
+
+
+class InMemorySmsProvider(BaseSmsProvider):
+    """
+    Keeps sent sms in memory instead of sending them. Can fail first sends to test retries
+    and wait before each send to simulate slow gateway.
+
+    ...
+
+    Attributes
+    ----------
+    outbox: list
+        sent pairs of phone and code
+    fail_times: int
+        amount of next sends which will fail
+    latency: float
+        seconds which each send takes
+    max_in_flight: int
+        the biggest amount of sends which were waiting at the same time
+    """
+    name = 'memory'
+
+    def __init__(self, fail_times=0, latency=0):
+        self.outbox = []
+        self.fail_times = fail_times
+        self.latency = latency
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def send(self, phone, code, message_id=None):
+        with self._lock:
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise ConnectionError('Fake sms provider failure')
+            self.outbox.append((phone, code))
+
+
+class HttpSmsProvider(BaseSmsProvider):
+    """
+    Sends sms by http api of the gateway. Connections are kept alive in the pool of
+    the session and reused by all sends of the process.
+
+    ...
+
+    Attributes
+    ----------
+    url: str
+        url of the api which accepts phone and text in json
+    params: dict
+        additional fields of the request (login, sender, etc.)
+    text: str
+        template of the text of sms with {code}
+    timeout: float
+        seconds to wait for the response
+    """
+
+    def __init__(self, url, name='http', params=None, text='{code}', timeout=5,
+                 pool_size=SMS_SEND_CONCURRENCY):
+        import requests
+        self.url = url
+        self.name = name
+        self.params = params or {}
+        self.text = text
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send(self, phone, code, message_id=None):
+        data = dict(self.params, phone=phone, text=self.text.format(code=code))
+        headers = {'Idempotency-Key': get_dedupe_key(message_id)} if message_id else {}
+        response = self.session.post(self.url, json=data, timeout=self.timeout,
+                                     headers=headers)
+        response.raise_for_status()
+
+
+class LatencyTracker:
+    """
+    Keeps latencies of last sends of the provider.
+
+    ...
+
+    Methods
+    -------
+    observe(self, seconds)
+        adds latency of the send
+    percentile(self, percent)
+        returns percentile of the kept latencies
+    """
+
+    def __init__(self, window=SMS_LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """
+        Adds latency of the send
+        :param seconds: duration of the send
+        :type seconds: float
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percent):
+        """
+        Returns percentile of the kept latencies
+        :param percent: percent from 0 to 100
+        :type percent: float
+        :return: latency or None if there are too few sends
+        :rtype: float
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < SMS_LATENCY_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+class CircuitBreaker:
+    """
+    Stops sends by the provider after several failures in a row. After reset timeout one
+    trial send is allowed, the breaker is closed if it succeeds.
+
+    ...
+
+    Methods
+    -------
+    allow(self)
+        checks if the provider can be used now
+    record_success(self)
+        closes the breaker
+    record_failure(self)
+        counts the failure and opens the breaker after too many
+    """
+
+    def __init__(self, failures=SMS_BREAKER_FAILURES, reset_timeout=SMS_BREAKER_RESET):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._failed = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Checks if the provider can be used now
+        :rtype: bool
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        """
+        Closes the breaker
+        """
+        with self._lock:
+            self._failed = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        """
+        Counts the failure, opens the breaker after too many failures or failed trial
+        """
+        with self._lock:
+            self._failed += 1
+            if self._trial or self._failed >= self.failures:
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+class HedgedSmsProvider(BaseSmsProvider):
+    """
+    Sends sms by the first available provider of SMS_PROVIDERS. If it fails, the next one
+    is used at once, if it is slower than its usual latency, the next one is started too
+    and the first sent sms wins. All providers send the same code, delivery of the message
+    of the queue is remembered by its id (also when it succeeds after the timeout), so
+    retries of the queue don't send it again.
+
+    ...
+
+    Attributes
+    ----------
+    providers: list of class BaseSmsProvider
+        providers in order of priority
+    trackers: list of class LatencyTracker
+        latencies of each provider
+    breakers: list of class CircuitBreaker
+        circuit breaker of each provider
+    """
+    name = 'hedged'
+
+    def __init__(self, providers=None):
+        self.providers = providers if providers is not None else \
+            [build_sms_provider(config) for config in SMS_PROVIDERS]
+        self.trackers = [LatencyTracker() for _ in self.providers]
+        self.breakers = [CircuitBreaker() for _ in self.providers]
+        self._pool = ThreadPoolExecutor(max_workers=SMS_SEND_CONCURRENCY * 2,
+                                        thread_name_prefix='sms-hedge')
+
+    def get_hedge_delay(self, index):
+        """
+        Returns how long to wait for the provider before the next one is started
+        :param index: index of the provider
+        :type index: int
+        :rtype: float
+        """
+        latency = self.trackers[index].percentile(SMS_HEDGE_PERCENTILE)
+        if latency is None:
+            return SMS_HEDGE_MAX_DELAY
+        return min(max(latency, SMS_HEDGE_MIN_DELAY), SMS_HEDGE_MAX_DELAY)
+
+    def _attempt(self, index, phone, code, message_id=None):
+        """
+        Sends sms by one provider and records its latency and result. Delivery of
+        the message is remembered here, so the send which succeeds after the caller
+        gave up prevents the retry of the queue too.
+        :param index: index of the provider
+        :type index: int
+        :return: error or None if sms is sent
+        :rtype: str
+        """
+        provider = self.providers[index]
+        started = time.monotonic()
+        try:
+            provider.send(phone, code, message_id=message_id)
+        except Exception as e:
+            self.breakers[index].record_failure()
+            logger.warning('Sms to %s is not sent by %s: %s', phone, provider.name, e)
+            return '{}: {}'.format(provider.name, str(e) or e.__class__.__name__)
+        if message_id is not None:
+            cache.set(get_dedupe_key(message_id), 1, SMS_DEDUPE_TIMEOUT)
+        self.trackers[index].observe(time.monotonic() - started)
+        self.breakers[index].record_success()
+        return None
+
+    def send(self, phone, code, message_id=None):
+        if message_id is not None and cache.get(get_dedupe_key(message_id)) is not None:
+            return
+        candidates = iter([index for index, breaker in enumerate(self.breakers)
+                           if breaker.allow()])
+        deadline = time.monotonic() + SMS_SEND_TIMEOUT
+        pending = {}
+        errors = []
+
+        def start_next():
+            index = next(candidates, None)
+            if index is None:
+                return None
+            pending[self._pool.submit(self._attempt, index, phone, code, message_id)] = index
+            return time.monotonic() + self.get_hedge_delay(index)
+
+        hedge_at = start_next()
+        while pending:
+            wake_at = min(hedge_at, deadline) if hedge_at is not None else deadline
+            done, _ = wait(list(pending), timeout=max(wake_at - time.monotonic(), 0),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                error = future.result()
+                if error is None:
+                    return
+                errors.append(error)
+            if time.monotonic() >= deadline:
+                errors.append('timeout')
+                break
+            if not pending or not done:
+                # failover after failure or hedge after the usual latency is exceeded
+                hedge_at = start_next()
+        if not errors:
+            errors.append('all providers are unavailable')
+        raise ConnectionError('; '.join(errors))
+
+
+def get_dedupe_key(message_id):
+    """
+    Returns key of delivery of the message of the queue, all sends of the message by
+    hedging and retries have the same key
+    :param message_id: id of the message of the queue
+    :type message_id: int
+    :rtype: str
+    """
+    return 'sms_sent:{}'.format(message_id)
+
+
+def build_sms_provider(config):
+    """
+    Creates provider from the item of SMS_PROVIDERS setting
+    :param config: path of the class or dict with BACKEND and OPTIONS
+    :type config: str or dict
+    :rtype: class BaseSmsProvider
+    """
+    if isinstance(config, str):
+        return import_string(config)()
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+def get_sms_provider():
+    """
+    Returns provider which is set in SMS_PROVIDER setting (created once per process)
+    :return: sms provider
+    :rtype: class BaseSmsProvider
+    """
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                path = getattr(settings, 'SMS_PROVIDER', DEFAULT_SMS_PROVIDER)
+                _provider = import_string(path)()
+    return _provider
+
+
+def get_send_pool():
+    """
+    Returns pool of threads which send messages of batches (created once per process)
+    :rtype: class ThreadPoolExecutor
+    """
+    global _send_pool
+    if _send_pool is None:
+        with _provider_lock:
+            if _send_pool is None:
+                _send_pool = ThreadPoolExecutor(max_workers=SMS_SEND_CONCURRENCY,
+                                                thread_name_prefix='sms')
+    return _send_pool
+
+
+def set_sms_provider(provider):
+    """
+    Replaces provider of the process, None means provider will be created from settings again
+    :param provider: sms provider
+    :type provider: class BaseSmsProvider
+    """
+    global _provider
+    _provider = provider
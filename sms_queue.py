@@ -0,0 +1,129 @@
+"""
+Processing of the durable queue of sms: workers take messages by batches, send them
+by the provider, retry failed messages with exponential backoff and mark messages
+as dead after too many attempts.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.auth_.models import SmsMessage
+from apps.auth_.sms_providers import get_sms_provider
+
+logger = logging.getLogger(__name__)
+
+SMS_BATCH_SIZE = getattr(settings, 'SMS_BATCH_SIZE', 50)
+SMS_MAX_ATTEMPTS = getattr(settings, 'SMS_MAX_ATTEMPTS', 5)
+# seconds, delay before n-th retry is SMS_RETRY_BACKOFF * 2 ** (n - 1)
+SMS_RETRY_BACKOFF = getattr(settings, 'SMS_RETRY_BACKOFF', 5)
+SMS_RETRY_MAX_BACKOFF = getattr(settings, 'SMS_RETRY_MAX_BACKOFF', 600)
+# messages taken by worker which died are returned to the queue after this time
+SMS_LOCK_TIMEOUT = getattr(settings, 'SMS_LOCK_TIMEOUT', 120)
+
+
+def get_backoff(attempts):
+    """
+    Returns delay before the next attempt to send message
+    :param attempts: amount of failed attempts
+    :type attempts: int
+    :return: delay
+    :rtype: timedelta
+    """
+    seconds = min(SMS_RETRY_BACKOFF * 2 ** (attempts - 1), SMS_RETRY_MAX_BACKOFF)
+    return timedelta(seconds=seconds)
+
+
+def release_stale():
+    """
+    Returns to the queue messages which were taken by worker too long ago
+    :return: amount of returned messages
+    :rtype: int
+    """
+    return SmsMessage.objects.filter(
+        status=SmsMessage.SENDING,
+        locked_at__lt=timezone.now() - timedelta(seconds=SMS_LOCK_TIMEOUT)
+    ).update(status=SmsMessage.PENDING, locked_at=None)
+
+
+def claim_batch(batch_size=SMS_BATCH_SIZE):
+    """
+    Takes messages which are ready to be sent. Rows locked by other workers are skipped,
+    so several workers never take the same message.
+    :param batch_size: maximum amount of messages
+    :type batch_size: int
+    :return: taken messages
+    :rtype: list of class SmsMessage
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(SmsMessage.objects.select_for_update(skip_locked=True)
+                   .filter(status=SmsMessage.PENDING, next_attempt_at__lte=now)
+                   .order_by('next_attempt_at')
+                   .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        SmsMessage.objects.filter(id__in=ids).update(status=SmsMessage.SENDING, locked_at=now)
+    return list(SmsMessage.objects.filter(id__in=ids))
+
+
+def process_batch(provider=None, batch_size=SMS_BATCH_SIZE):
+    """
+    Sends one batch of messages and saves results
+    :param provider: sms provider, by default provider from settings
+    :type provider: class BaseSmsProvider
+    :param batch_size: maximum amount of messages
+    :type batch_size: int
+    :return: amount of processed messages
+    :rtype: int
+    """
+    messages = claim_batch(batch_size)
+    if not messages:
+        return 0
+    provider = provider or get_sms_provider()
+    now = timezone.now()
+    sent_ids = []
+    for message, error in provider.send_batch(messages):
+        if error is None:
+            sent_ids.append(message.id)
+            continue
+        message.attempts += 1
+        message.last_error = error
+        message.locked_at = None
+        if message.attempts >= SMS_MAX_ATTEMPTS:
+            message.status = SmsMessage.DEAD
+            logger.error('Sms to %s is dead after %s attempts: %s',
+                         message.phone, message.attempts, error)
+        else:
+            message.status = SmsMessage.PENDING
+            message.next_attempt_at = now + get_backoff(message.attempts)
+        message.save(update_fields=['attempts', 'last_error', 'locked_at',
+                                    'status', 'next_attempt_at'])
+    if sent_ids:
+        SmsMessage.objects.filter(id__in=sent_ids).update(
+            status=SmsMessage.SENT, sent_at=now, locked_at=None)
+    return len(messages)
+
+
+def run_worker(batch_size=SMS_BATCH_SIZE, poll_interval=1.0, should_stop=None):
+    """
+    Sends messages until should_stop returns True. Sleeps when the queue is empty.
+    :param batch_size: maximum amount of messages in one batch
+    :type batch_size: int
+    :param poll_interval: seconds to sleep when there are no messages
+    :type poll_interval: float
+    :param should_stop: function which returns True when worker must stop
+    """
+    should_stop = should_stop or (lambda: False)
+    while not should_stop():
+        try:
+            release_stale()
+            processed = process_batch(batch_size=batch_size)
+        except Exception as e:
+            logger.exception(e)
+            processed = 0
+        if processed < batch_size:
+            time.sleep(poll_interval)
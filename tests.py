@@ -1,14 +1,56 @@
 """
 Tests for auth_ app.
 """
+import io
+import json
+import shutil
+import tempfile
+import time
+import uuid
+import jwt
+from unittest import mock
 from datetime import timedelta
+from django.contrib import admin
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
-from apps.auth_.models import Activation
-from apps.auth_.token import get_token
+from apps.auth_.admin import CompanyDiscountAutocomplete, MainUserAdmin
+from apps.auth_.benchmarks import percentile, find_regressions
+from apps.auth_.management.commands.startup_report import parse_importtime
+from apps.auth_.discounts import (resolve_discounts, resolve_discounts_bulk,
+                                  bump_fan_catalog_version, bump_version, get_user_version_key)
+from apps.auth_.exports import export_response
+from apps.auth_.images import drop_variants, build_variants, process_company_logo
+from apps.auth_.instrumentation import registry, MetricsRegistry
+from apps.auth_.models import (Activation, Company, CompanyDiscount,
+                               UserCompany, FanDiscount, SmsMessage, UserSession,
+                               CompanyLogoVariant, UserExport, USER_EXPORT_TIMEOUT,
+                               USER_EXPORT_MAX_ATTEMPTS)
+from apps.auth_.sms_providers import (BaseSmsProvider, InMemorySmsProvider,
+                                      HedgedSmsProvider, SMS_BREAKER_FAILURES,
+                                      SMS_LATENCY_MIN_SAMPLES)
+from apps.auth_.sms_queue import process_batch, SMS_MAX_ATTEMPTS
+from apps.auth_.paginators import get_keyset_page, KeysetPaginator
+from apps.auth_.phones import normalize_phone, normalize_phones
+from apps.auth_.provisioning import read_roster
+from apps.auth_ import qr
+from apps.auth_.ratelimit import SlidingWindowLimiter, get_client_ip
+from apps.auth_.search import search_users, SEARCH_ORDERING
+from apps.auth_.serializers import CustomRefreshJSONWebTokenSerializer, PhoneSerializer
+from apps.auth_.sessions import (is_revoked, revoke_session, get_revocation_window,
+                                 SESSION_BLOOM_KEY, SESSION_BLOOM_LOCK_KEY,
+                                 SESSION_BLOOM_VERSION_KEY)
+from apps.auth_.token import get_token, get_token_sid, jwt_decode_handler
+from apps.auth_.user_cache import get_jwt_secret, get_cached_user
 from apps.utils import codes, constants
+from apps.utils.exceptions import CommonException
 from rest_framework.test import APIClient
 
 
@@ -183,6 +225,9 @@ class ActivationTestCase(BaseTestCase):
     test_activate_time_expired(self)
     test_resend_ok(self)
     test_resend_iteration_limit(self)
+    test_send_sms_iteration_limit(self)
+    test_complete_once(self)
+    test_purge(self)
     """
     def get_or_create_activation(self, phone, code, activation_type):
         """
@@ -256,3 +301,1154 @@ class ActivationTestCase(BaseTestCase):
         activation.save()
         reverse('auth_:activation-resend', kwargs={'pk': activation.id})
         # self.get(url, BAD_REQUEST, codes.BAD_REQUEST)
+
+    def test_send_sms_iteration_limit(self):
+        """
+        Resend increments iteration in the database and stops at the limit
+        even if the instance is stale
+        """
+        activation = self.get_or_create_activation(TEST_PHONE, TEST_CODE, constants.LOGIN)
+        Activation.objects.filter(id=activation.id).update(
+            iteration=constants.MAX_ITERATION - 1)
+        activation.send_sms()
+        self.assertEqual(Activation.objects.get(id=activation.id).iteration,
+                         constants.MAX_ITERATION)
+        with self.assertRaises(CommonException):
+            activation.send_sms()
+
+    def test_complete_once(self):
+        """
+        Activation can be completed only once
+        """
+        activation = self.get_or_create_activation(TEST_PHONE, TEST_CODE, constants.LOGIN)
+        stale = Activation.objects.get(id=activation.id)
+        user, _ = activation.complete()
+        self.assertEqual(Activation.objects.get(id=activation.id).user, user)
+        with self.assertRaises(CommonException):
+            stale.complete()
+
+    def test_purge(self):
+        """
+        Expired and completed activations are deleted after they are kept for activation time
+        """
+        old = timezone.now() - timedelta(minutes=constants.ACTIVATION_TIME + 1)
+        expired = self.get_or_create_activation('+77011234501', TEST_CODE, constants.LOGIN)
+        completed = self.get_or_create_activation('+77011234502', TEST_CODE, constants.LOGIN)
+        live = self.get_or_create_activation(TEST_PHONE, TEST_CODE, constants.LOGIN)
+        Activation.objects.filter(id=expired.id).update(end_time=old, timestamp=old)
+        Activation.objects.filter(id=completed.id).update(is_active=False, timestamp=old)
+        call_command('purge_activations', sleep=0, stdout=io.StringIO())
+        self.assertEqual(list(Activation.objects.values_list('id', flat=True)), [live.id])
+
+
+class DiscountResolutionTestCase(BaseTestCase):
+    """
+    Test class for resolving discounts which are shown on the QR scan page
+
+    ...
+
+    Methods
+    -------
+    setUp(self)
+        create companies with discounts, employee and fan discounts
+    test_employee_discounts(self)
+    test_fan_discounts(self)
+    test_bulk(self)
+    test_lookup_view(self)
+    test_fan_catalog_version(self)
+    """
+    COMPANIES_COUNT = 5
+    DISCOUNTS_COUNT = 4
+
+    def setUp(self):
+        """
+        Create companies with discounts, link all of them to the employee and to the fans
+        """
+        cache.clear()
+        self.user = self.get_or_create_user()
+        self.user.status = constants.EMPLOYEE
+        self.user.save()
+        employer = Company.objects.create(name='Employer')
+        user_company = UserCompany.objects.create(user=self.user, company=employer,
+                                                  isEmployer=True, position='Manager')
+        fan_discount = FanDiscount.objects.create()
+        for i in range(self.COMPANIES_COUNT):
+            company = Company.objects.create(name='Company {}'.format(i))
+            for j in range(self.DISCOUNTS_COUNT):
+                discount = CompanyDiscount.objects.create(company=company, percent=j,
+                                                          description='Discount')
+                user_company.company_discount.add(discount)
+                fan_discount.company_discounts.add(discount)
+
+    def check_discounts(self, company_discounts):
+        """
+        Checks that discounts without percent and amount are skipped and others are grouped
+        :param company_discounts: discounts grouped by companies
+        :type company_discounts: dict
+        """
+        self.assertEqual(len(company_discounts), self.COMPANIES_COUNT)
+        for discounts in company_discounts.values():
+            self.assertEqual(len(discounts), self.DISCOUNTS_COUNT - 1)
+
+    def test_employee_discounts(self):
+        """
+        Employee discounts and employer are resolved by a fixed number of queries
+        """
+        with self.assertNumQueries(2):
+            data = resolve_discounts(self.user)
+        self.check_discounts(data['company_discounts'])
+        self.assertEqual(data['company_name'], 'Employer')
+        self.assertEqual(data['company_position'], 'Manager')
+
+    def test_fan_discounts(self):
+        """
+        Fan discounts are resolved by one query and then are read from the cache
+        """
+        self.user.status = constants.FAN
+        with self.assertNumQueries(1):
+            data = resolve_discounts(self.user)
+        self.check_discounts(data['company_discounts'])
+        self.assertEqual(data['company_name'], '')
+        with self.assertNumQueries(0):
+            self.check_discounts(resolve_discounts(self.user)['company_discounts'])
+
+    def test_bulk(self):
+        """
+        Many employees and fans are resolved by a fixed number of queries
+        """
+        employees = [self.user]
+        for i in range(3):
+            user = self.get_or_create_user('+7701000000{}'.format(i))
+            user.status = constants.EMPLOYEE
+            user.save()
+            UserCompany.objects.create(user=user, company=Company.objects.first(),
+                                       isEmployer=True, position='Cashier')
+            employees.append(user)
+        fan = self.get_or_create_user('+77020000000')
+        statuses = {user.id: user.status for user in employees + [fan]}
+        with self.assertNumQueries(3):
+            data = resolve_discounts_bulk(statuses)
+        self.assertEqual(len(data[self.user.id]['company_discounts']), self.COMPANIES_COUNT)
+        self.assertEqual(data[self.user.id]['company_name'], 'Employer')
+        self.assertEqual(data[employees[1].id]['company_position'], 'Cashier')
+        self.assertEqual(data[employees[1].id]['company_discounts'], [])
+        self.assertEqual(len(data[fan.id]['company_discounts']), self.COMPANIES_COUNT)
+
+    def test_lookup_view(self):
+        """
+        Known, unknown and repeated codes are resolved by a fixed number of queries,
+        looked up codes are limited by client ip
+        """
+        qr_model = qr.get_qr_model()
+        employee_code = str(qr_model.objects.create(user=self.user, code=str(uuid.uuid4())).code)
+        fan = self.get_or_create_user('+77020000000')
+        fan_code = str(qr_model.objects.create(user=fan, code=str(uuid.uuid4())).code)
+        unknown_code = str(uuid.uuid4())
+        url = reverse('auth_:user-lookup')
+        params = {'codes': [employee_code, unknown_code, employee_code, fan_code]}
+        c.post(url, params, format='json')
+        with self.assertNumQueries(3):
+            response = c.post(url, params, format='json')
+        self.common_test(response, STATUS_OK, codes.OK)
+        users = response.json()['users']
+        self.assertEqual(set(users), {employee_code, unknown_code, fan_code})
+        self.assertIsNone(users[unknown_code])
+        self.assertEqual(users[employee_code]['company_name'], 'Employer')
+        self.assertEqual(len(users[fan_code]['company_discounts']), self.COMPANIES_COUNT)
+        with mock.patch('apps.auth_.ratelimit.LOOKUP_RATE_LIMIT', (5, 60)):
+            response = c.post(url, params, format='json')
+        self.assertEqual(response.status_code, 429)
+
+    def test_fan_catalog_version(self):
+        """
+        New version of the catalog is rebuilt with changed discounts
+        """
+        self.user.status = constants.FAN
+        resolve_discounts(self.user)
+        company = Company.objects.create(name='New company')
+        FanDiscount.objects.get().company_discounts.add(
+            CompanyDiscount.objects.create(company=company, percent=10))
+        bump_fan_catalog_version()
+        data = resolve_discounts(self.user)
+        self.assertEqual(len(data['company_discounts']), self.COMPANIES_COUNT + 1)
+        self.assertIn('New company', str(FanDiscount.objects.get()))
+
+
+class UserCacheTestCase(BaseTestCase):
+    """
+    Test class for cache of users which is used in authentication
+
+    ...
+
+    Methods
+    -------
+    test_cached_secret(self)
+    test_rotated_secret(self)
+    test_concurrent_refresh(self)
+    """
+    def test_cached_secret(self):
+        """
+        Second lookup of the user doesn't query the database
+        """
+        user = self.get_or_create_user()
+        self.assertEqual(get_jwt_secret(user.id), user.jwt_secret)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_user(user.id).phone, user.phone)
+
+    def test_rotated_secret(self):
+        """
+        Rotated jwt secret and deactivation are seen immediately
+        """
+        user = self.get_or_create_user()
+        get_jwt_secret(user.id)
+        user.jwt_secret = uuid.uuid4()
+        user.is_active = False
+        user.save()
+        self.assertEqual(get_jwt_secret(user.id), user.jwt_secret)
+        self.assertFalse(get_cached_user(user.id).is_active)
+
+    def refresh(self, token):
+        """
+        Refreshes the token
+        :param token: jwt token
+        :return: new token
+        """
+        serializer = CustomRefreshJSONWebTokenSerializer(data={'token': token})
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['token']
+
+    def test_concurrent_refresh(self):
+        """
+        Repeated refresh of the same token gets the same token and rotates secret of the
+        session once,
+        after the grace period the old token can't be refreshed
+        """
+        cache.clear()
+        user = self.get_or_create_user()
+        token = get_token(user)
+        session = UserSession.objects.get(sid=get_token_sid(token))
+        new_token = self.refresh(token)
+        secret = UserSession.objects.get(pk=session.pk).secret
+        self.assertNotEqual(secret, session.secret)
+        self.assertEqual(self.refresh(token), new_token)
+        self.assertEqual(UserSession.objects.get(pk=session.pk).secret, secret)
+        cache.clear()
+        with self.assertRaises(CommonException):
+            self.refresh(token)
+        self.assertNotEqual(self.refresh(new_token), new_token)
+
+
+class SessionTestCase(BaseTestCase):
+    """
+    Test class for sessions of users on devices
+
+    ...
+
+    Methods
+    -------
+    test_revoke_one_device(self)
+    test_lost_filter(self)
+    test_purge(self)
+    """
+    def test_revoke_one_device(self):
+        """
+        Revoked session is rejected while the other device keeps working, check of active
+        session makes no query
+        """
+        cache.clear()
+        user = self.get_or_create_user()
+        revoked_token = get_token(user, device='phone')
+        token = get_token(user, device='tablet')
+        revoked_sid = get_token_sid(revoked_token)
+        sid = get_token_sid(token)
+        self.assertTrue(revoke_session(revoked_sid))
+        self.assertTrue(is_revoked(revoked_sid))
+        self.assertFalse(is_revoked(sid))
+        with self.assertRaises(jwt.InvalidTokenError):
+            jwt_decode_handler(revoked_token)
+        self.assertEqual(jwt_decode_handler(token)['sid'], sid)
+        with self.assertNumQueries(0):
+            jwt_decode_handler(token)
+        self.assertTrue(user.sessions.filter(revoked_at__isnull=True).exists())
+
+    def test_lost_filter(self):
+        """
+        While the lost filter is rebuilt by other process, sessions are checked by one
+        query instead of building the filter again
+        """
+        cache.clear()
+        user = self.get_or_create_user()
+        revoked_sid = get_token_sid(get_token(user))
+        sid = get_token_sid(get_token(user))
+        revoke_session(revoked_sid)
+        cache.delete(SESSION_BLOOM_KEY)
+        cache.delete(SESSION_BLOOM_VERSION_KEY)
+        cache.add(SESSION_BLOOM_LOCK_KEY, 1)
+        self.assertTrue(is_revoked(revoked_sid))
+        with self.assertNumQueries(1):
+            self.assertFalse(is_revoked(sid))
+
+    def test_purge(self):
+        """
+        Revoked and not refreshed sessions are deleted after the refresh window
+        """
+        user = self.get_or_create_user()
+        old = timezone.now() - get_revocation_window() - timedelta(minutes=1)
+        revoked_sid = get_token_sid(get_token(user))
+        expired_sid = get_token_sid(get_token(user))
+        sid = get_token_sid(get_token(user))
+        UserSession.objects.filter(sid=revoked_sid).update(revoked_at=old)
+        UserSession.objects.filter(sid=expired_sid).update(created_at=old)
+        call_command('purge_sessions', sleep=0, stdout=io.StringIO())
+        self.assertEqual([str(session_sid) for session_sid in
+                          UserSession.objects.values_list('sid', flat=True)], [sid])
+
+
+class InstrumentationTestCase(BaseTestCase):
+    """
+    Test class for metrics of views
+
+    ...
+
+    Methods
+    -------
+    test_request_metrics(self)
+    test_shared_metrics(self)
+    """
+    def test_request_metrics(self):
+        """
+        Latency, queries and cache lookups of the view are exposed in Prometheus format
+        """
+        registry.reset()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='JWT ' + self.create_token())
+        client.get(reverse('auth_:user-get'))
+        metrics = registry.render()
+        self.assertIn('auth_request_duration_seconds_count{view="auth_:user-get"} 1',
+                      metrics)
+        self.assertIn('auth_requests_total{view="auth_:user-get",status="200"} 1', metrics)
+        self.assertIn('auth_cache_requests_total{cache="user_shared",result=', metrics)
+
+    def test_shared_metrics(self):
+        """
+        Metrics observed by different processes are summed up in the shared cache
+        """
+        registry.reset()
+        worker = MetricsRegistry()
+        stats = {'queries': 2, 'db_time': 0.5, 'cache_hits': 0, 'cache_misses': 0}
+        registry.observe_request('auth_:user-get', 200, 0.01, stats)
+        worker.observe_request('auth_:user-get', 200, 0.02, stats)
+        worker.flush()
+        metrics = registry.render()
+        self.assertIn('auth_requests_total{view="auth_:user-get",status="200"} 2', metrics)
+        self.assertIn('auth_request_queries_bucket{view="auth_:user-get",le="2"} 2', metrics)
+        self.assertIn('auth_request_db_seconds_total{view="auth_:user-get"} 1.0', metrics)
+        self.assertEqual(worker.render(), metrics)
+
+
+class UserDetailTestCase(BaseTestCase):
+    """
+    Test class for the scan page of the user
+
+    ...
+
+    Methods
+    -------
+    setUp(self)
+        create user with QR code
+    test_not_modified(self)
+    """
+    def setUp(self):
+        """
+        Create user with QR code
+        """
+        cache.clear()
+        self.user = self.get_or_create_user()
+        self.code = str(uuid.uuid4())
+        qr.get_qr_model().objects.create(user=self.user, code=self.code)
+        self.url = reverse('auth_:user-info', kwargs={'code': self.code})
+
+    def test_not_modified(self):
+        """
+        Terminal which scans the same user again gets 304 without queries until discounts
+        of the user are changed
+        """
+        client = APIClient()
+        response = client.get(self.url)
+        self.assertEqual(response.status_code, STATUS_OK)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        bump_version(get_user_version_key(self.user.id))
+        response = client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, STATUS_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class QrTestCase(BaseTestCase):
+    """
+    Test class for QR codes of users
+
+    ...
+
+    Methods
+    -------
+    test_get_qr(self)
+    test_request_host(self)
+    test_not_modified(self)
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_get_qr(self):
+        """
+        QR code is created once and then is read from the cache
+        """
+        user = self.get_or_create_user()
+        with mock.patch.object(qr, 'QR_RENDER_ASYNC', False), \
+                mock.patch.object(qr, 'QR_BASE_URL', 'https://example.com/'):
+            code = qr.get_user_code(user)
+            self.assertTrue(qr.get_scan_url(code).startswith('https://example.com/'))
+        with self.assertNumQueries(0):
+            self.assertEqual(qr.get_user_code(user), code)
+        cache.clear()
+        self.assertEqual(qr.get_user_code(user), code)
+        self.assertEqual(qr.get_qr_model().objects.filter(user=user).count(), 1)
+
+    def test_request_host(self):
+        """
+        Without QR_BASE_URL host of the request is encoded and the check warns at startup
+        """
+        request = RequestFactory().get('/')
+        with mock.patch.object(qr, 'QR_BASE_URL', ''):
+            self.assertTrue(qr.get_scan_url('code', request).startswith('http://testserver/'))
+            self.assertEqual([warning.id for warning in qr.check_base_url(None)],
+                             ['auth_.W001'])
+
+    def test_not_modified(self):
+        """
+        Client which has the image gets 304 without touching the database
+        """
+        code = str(uuid.uuid4())
+        url = reverse('auth_:qr-image', kwargs={'code': code})
+        with self.assertNumQueries(0):
+            response = c.get(url, HTTP_IF_NONE_MATCH=qr.get_etag(code))
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(c.get(url).status_code, 404)
+
+
+class SmsQueueTestCase(BaseTestCase):
+    """
+    Test class for queue of sms
+
+    ...
+
+    Methods
+    -------
+    test_send(self)
+    test_retry(self)
+    test_dead(self)
+    test_concurrent_batch(self)
+    """
+    def test_send(self):
+        """
+        Queued sms is sent by the provider
+        """
+        provider = InMemorySmsProvider()
+        SmsMessage.objects.enqueue(TEST_PHONE, TEST_CODE)
+        self.assertEqual(process_batch(provider=provider), 1)
+        self.assertEqual(provider.outbox, [(TEST_PHONE, TEST_CODE)])
+        self.assertEqual(SmsMessage.objects.get().status, SmsMessage.SENT)
+
+    def test_retry(self):
+        """
+        Failed sms is returned to the queue with delay
+        """
+        provider = InMemorySmsProvider(fail_times=1)
+        SmsMessage.objects.enqueue(TEST_PHONE, TEST_CODE)
+        process_batch(provider=provider)
+        message = SmsMessage.objects.get()
+        self.assertEqual(message.status, SmsMessage.PENDING)
+        self.assertEqual(message.attempts, 1)
+        self.assertGreater(message.next_attempt_at, timezone.now())
+        self.assertEqual(process_batch(provider=provider), 0)
+
+    def test_dead(self):
+        """
+        Sms which failed too many times is not sent anymore
+        """
+        provider = InMemorySmsProvider(fail_times=SMS_MAX_ATTEMPTS)
+        message = SmsMessage.objects.enqueue(TEST_PHONE, TEST_CODE)
+        for _ in range(SMS_MAX_ATTEMPTS):
+            SmsMessage.objects.filter(id=message.id).update(next_attempt_at=timezone.now())
+            process_batch(provider=provider)
+        self.assertEqual(SmsMessage.objects.get().status, SmsMessage.DEAD)
+        self.assertEqual(provider.outbox, [])
+
+    def test_concurrent_batch(self):
+        """
+        Messages of a batch wait for the slow gateway at the same time
+        """
+        provider = InMemorySmsProvider(latency=0.1)
+        for i in range(10):
+            SmsMessage.objects.enqueue('+7701000000{}'.format(i), TEST_CODE)
+        self.assertEqual(process_batch(provider=provider), 10)
+        self.assertGreater(provider.max_in_flight, 1)
+        self.assertEqual(len(provider.outbox), 10)
+        self.assertFalse(SmsMessage.objects.exclude(status=SmsMessage.SENT).exists())
+
+
+class HedgedSmsTestCase(TestCase):
+    """
+    Test class for sending sms by several providers
+
+    ...
+
+    Methods
+    -------
+    setUp(self)
+        create slow primary and fast secondary providers
+    test_hedge(self)
+    test_late_success(self)
+    test_failover(self)
+    test_abstract_provider(self)
+    """
+    def setUp(self):
+        """
+        Create slow primary and fast secondary providers
+        """
+        cache.clear()
+        self.primary = InMemorySmsProvider(latency=0.5)
+        self.secondary = InMemorySmsProvider()
+        self.provider = HedgedSmsProvider([self.primary, self.secondary])
+        for _ in range(SMS_LATENCY_MIN_SAMPLES):
+            self.provider.trackers[0].observe(0.05)
+
+    def test_hedge(self):
+        """
+        Secondary provider sends the code when the primary one is slower than usual,
+        the delivered code is not sent again
+        """
+        started = time.monotonic()
+        self.provider.send(TEST_PHONE, TEST_CODE, message_id=1)
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(self.secondary.outbox, [(TEST_PHONE, TEST_CODE)])
+        self.provider.send(TEST_PHONE, TEST_CODE, message_id=1)
+        self.assertEqual(self.secondary.outbox, [(TEST_PHONE, TEST_CODE)])
+        # resend which draws the same code is another message
+        self.provider.send(TEST_PHONE, TEST_CODE, message_id=2)
+        self.assertEqual(len(self.secondary.outbox), 2)
+
+    def test_late_success(self):
+        """
+        Send which succeeds after the timeout is remembered, retry doesn't send it again
+        """
+        provider = HedgedSmsProvider([self.primary])
+        with mock.patch('apps.auth_.sms_providers.SMS_SEND_TIMEOUT', 0.1):
+            with self.assertRaises(ConnectionError):
+                provider.send(TEST_PHONE, TEST_CODE, message_id=3)
+        time.sleep(0.6)
+        provider.send(TEST_PHONE, TEST_CODE, message_id=3)
+        self.assertEqual(self.primary.outbox, [(TEST_PHONE, TEST_CODE)])
+
+    def test_failover(self):
+        """
+        Failed provider is replaced by the next one at once and is skipped when its
+        circuit breaker is open
+        """
+        self.primary.latency = 0
+        self.primary.fail_times = SMS_BREAKER_FAILURES + 1
+        for i in range(SMS_BREAKER_FAILURES + 1):
+            self.provider.send(TEST_PHONE, str(i))
+        self.assertEqual(len(self.secondary.outbox), SMS_BREAKER_FAILURES + 1)
+        self.assertEqual(self.primary.fail_times, 1)
+        self.assertFalse(self.provider.breakers[0].allow())
+
+    def test_abstract_provider(self):
+        """
+        Provider without send fails when it is created
+        """
+        class IncompleteSmsProvider(BaseSmsProvider):
+            name = 'incomplete'
+
+        with self.assertRaises(TypeError):
+            IncompleteSmsProvider()
+
+
+class AdminChangelistTestCase(TestCase):
+    """
+    Test class for amount of queries of the lists in the admin
+
+    ...
+
+    Methods
+    -------
+    setUp(self)
+        log in as superuser
+    count_queries(self, model_name)
+        opens the list and returns amount of queries
+    create_rows(self, count)
+        creates relations of users and companies, discounts and fan discounts
+    test_constant_queries(self)
+    test_discount_autocomplete(self)
+    """
+    def setUp(self):
+        """
+        Log in as superuser
+        """
+        cache.clear()
+        self.admin = User.objects.create_superuser('admin', TEST_PASSWORD)
+        self.client.force_login(self.admin)
+
+    def count_queries(self, model_name):
+        """
+        Opens the list of the model in the admin
+        :param model_name: name of the model
+        :type model_name: str
+        :return: amount of queries
+        :rtype: int
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:auth__{}_changelist'.format(model_name)))
+        self.assertEqual(response.status_code, STATUS_OK)
+        return len(queries)
+
+    @staticmethod
+    def create_rows(count):
+        """
+        Creates relations of users and companies, discounts and fan discounts
+        :param count: amount of rows of each model
+        :type count: int
+        """
+        start = UserCompany.objects.count()
+        users = User.objects.bulk_create([User(username='+7700{:07d}'.format(start + i))
+                                          for i in range(count)])
+        companies = Company.objects.bulk_create([Company(name='Company {}'.format(start + i))
+                                                 for i in range(count)])
+        UserCompany.objects.bulk_create([UserCompany(user=user, company=company)
+                                         for user, company in zip(users, companies)])
+        discounts = CompanyDiscount.objects.bulk_create([
+            CompanyDiscount(company=company, percent=10, description='Discount')
+            for company in companies])
+        fan_discounts = FanDiscount.objects.bulk_create([FanDiscount() for _ in range(count)])
+        FanDiscount.company_discounts.through.objects.bulk_create([
+            FanDiscount.company_discounts.through(fandiscount=fan_discount,
+                                                  companydiscount=discount)
+            for fan_discount, discount in zip(fan_discounts, discounts)])
+        bump_fan_catalog_version()
+
+    def test_constant_queries(self):
+        """
+        Lists with 100 rows make as many queries as lists with one row
+        """
+        model_names = ('usercompany', 'companydiscount', 'fandiscount')
+        self.create_rows(1)
+        counts = {name: self.count_queries(name) for name in model_names}
+        self.create_rows(99)
+        for name in model_names:
+            self.assertEqual(self.count_queries(name), counts[name], name)
+
+    def test_discount_autocomplete(self):
+        """
+        Short query is answered from the cache until discounts are changed
+        """
+        self.create_rows(3)
+        view = CompanyDiscountAutocomplete.as_view()
+        request = RequestFactory().get('/', {'q': 'co'})
+        request.user = self.admin
+        first = view(request)
+        with self.assertNumQueries(0):
+            second = view(request)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(len(json.loads(first.content.decode())['results']), 3)
+        CompanyDiscount.objects.create(company=Company.objects.first(), percent=5,
+                                       description='New')
+        bump_fan_catalog_version()
+        self.assertEqual(len(json.loads(view(request).content.decode())['results']), 4)
+
+
+class UserExportTestCase(TestCase):
+    """
+    Test class for exports of users
+
+    ...
+
+    Methods
+    -------
+    setUp(self)
+        create users
+    test_export_response(self)
+    test_admin_actions(self)
+    test_background(self)
+    test_process_exports(self)
+    test_reclaim(self)
+    """
+    def setUp(self):
+        """
+        Create users
+        """
+        for i in range(3):
+            User.objects.create(username='+7701000000{}'.format(i), full_name='Test User',
+                                email='user{}@example.com'.format(i))
+        self.admin = MainUserAdmin(User, admin.site)
+        self.request = RequestFactory().get('/')
+
+    def test_export_response(self):
+        """
+        CSV is streamed with header and one line per user
+        """
+        response = export_response(User.objects.order_by('id'), UserExport.CSV)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertIn('user0@example.com', lines[1])
+
+    def test_admin_actions(self):
+        """
+        Small selections are exported in the response of the action
+        """
+        response = self.admin.export_csv(self.request, User.objects.all())
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        response = self.admin.export_xlsx(self.request, User.objects.all())
+        self.assertTrue(response['Content-Disposition'].endswith('.xlsx"'))
+
+    def test_background(self):
+        """
+        Selections above the threshold are scheduled with ids of the selected users
+        """
+        self.request.user = User.objects.create(username='staff', is_staff=True)
+        users = User.objects.exclude(username='staff')
+        with mock.patch('apps.auth_.admin.EXPORT_BACKGROUND_THRESHOLD', 2), \
+                mock.patch.object(MainUserAdmin, 'message_user'):
+            self.assertIsNone(self.admin.export_csv(self.request, users))
+        export = UserExport.objects.get()
+        self.assertEqual(export.status, UserExport.PENDING)
+        self.assertEqual(list(export.get_queryset()), list(users.order_by('id')))
+
+    def test_process_exports(self):
+        """
+        Scheduled export is built by the command
+        """
+        export = UserExport.objects.schedule(User.objects.all(), UserExport.CSV)
+        call_command('process_user_exports', stdout=io.StringIO())
+        export.refresh_from_db()
+        self.assertEqual(export.status, UserExport.DONE)
+        self.assertEqual((export.rows, export.attempts), (3, 1))
+        export.file.delete(save=False)
+
+    def test_reclaim(self):
+        """
+        Export which runs longer than the timeout is claimed again until attempts are over
+        """
+        export = UserExport.objects.schedule(User.objects.all(), UserExport.CSV)
+        self.assertEqual(UserExport.objects.claim(), export)
+        self.assertIsNone(UserExport.objects.claim())
+        stale = timezone.now() - timedelta(seconds=USER_EXPORT_TIMEOUT + 1)
+        UserExport.objects.filter(id=export.id).update(started_at=stale)
+        self.assertEqual(UserExport.objects.claim().attempts, 2)
+        UserExport.objects.filter(id=export.id).update(started_at=stale,
+                                                       attempts=USER_EXPORT_MAX_ATTEMPTS)
+        self.assertIsNone(UserExport.objects.claim())
+        self.assertEqual(UserExport.objects.get().status, UserExport.FAILED)
+
+
+class RateLimitTestCase(BaseTestCase):
+    """
+    Test class for rate limiting of activations
+
+    ...
+
+    Methods
+    -------
+    test_limit(self)
+    test_create_limit(self)
+    test_forwarded_ip(self)
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_limit(self):
+        """
+        Hits above the limit are rejected, other keys are not affected
+        """
+        limiter = SlidingWindowLimiter('test', 3, 60)
+        self.assertTrue(all(limiter.hit(TEST_PHONE) for _ in range(3)))
+        self.assertFalse(limiter.hit(TEST_PHONE))
+        self.assertTrue(limiter.hit('+77777777778'))
+
+    def test_create_limit(self):
+        """
+        Repeated requests of the same phone return the same activation without new sms
+        """
+        url = reverse('auth_:activation-list')
+        first = c.post(url, {'phone': TEST_PHONE}, format='json')
+        second = c.post(url, {'phone': TEST_PHONE}, format='json')
+        self.assertEqual(first.status_code, STATUS_OK)
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(Activation.objects.filter(phone=TEST_PHONE).count(), 1)
+
+    def test_forwarded_ip(self):
+        """
+        Ips forged by the client in X-Forwarded-For are skipped
+        """
+        request = RequestFactory().get('/', HTTP_X_FORWARDED_FOR='1.1.1.1, 2.2.2.2, 3.3.3.3',
+                                       REMOTE_ADDR='10.0.0.1')
+        with mock.patch('apps.auth_.ratelimit.RATELIMIT_IP_META_KEY', 'HTTP_X_FORWARDED_FOR'):
+            self.assertEqual(get_client_ip(request), '3.3.3.3')
+            with mock.patch('apps.auth_.ratelimit.RATELIMIT_TRUSTED_PROXIES', 2):
+                self.assertEqual(get_client_ip(request), '2.2.2.2')
+            with mock.patch('apps.auth_.ratelimit.RATELIMIT_TRUSTED_PROXIES', 5):
+                self.assertEqual(get_client_ip(request), '1.1.1.1')
+
+
+class SearchTestCase(BaseTestCase):
+    """
+    Test class for search in autocompletes
+
+    ...
+
+    Methods
+    -------
+    test_search_users(self)
+    test_keyset_pages(self)
+    test_admin_paginator(self)
+    """
+    USERS_COUNT = 25
+
+    def setUp(self):
+        cache.clear()
+        for i in range(self.USERS_COUNT):
+            User.objects.create(username='+7701000{:04d}'.format(i),
+                                phone='+7701000{:04d}'.format(i),
+                                full_name='Test User')
+
+    def test_search_users(self):
+        """
+        Users are found by part of phone and full name
+        """
+        self.assertEqual(list(search_users('0000013').values_list('username', flat=True)),
+                         ['+77010000013'])
+        self.assertEqual(search_users('user').count(), self.USERS_COUNT)
+
+    def test_keyset_pages(self):
+        """
+        Pages read by keyset contain all results without duplicates
+        """
+        queryset = search_users('user')
+        ids = []
+        page, has_next = 1, True
+        while has_next:
+            rows, has_next = get_keyset_page(queryset, list(SEARCH_ORDERING), 'test',
+                                             page, 10)
+            ids += [row.id for row in rows]
+            page += 1
+        self.assertEqual(page - 1, 3)
+        self.assertEqual(sorted(ids), sorted(queryset.values_list('id', flat=True)))
+
+    def test_admin_paginator(self):
+        """
+        Page after the visited one is read by seeking on (username, id) without OFFSET,
+        small lists are counted exactly
+        """
+        queryset = User.objects.order_by('username', 'id')
+        paginator = KeysetPaginator(queryset, 10, scope='test', ordering=('username', 'id'))
+        self.assertEqual(paginator.count, self.USERS_COUNT)
+        first = paginator.page(1)
+        with CaptureQueriesContext(connection) as queries:
+            second = list(paginator.page(2).object_list)
+        self.assertNotIn('OFFSET', queries[0]['sql'].upper())
+        self.assertEqual([user.id for user in list(first.object_list) + second],
+                         list(queryset.values_list('id', flat=True)[:20]))
+
+
+class CompanyLogoTestCase(TestCase):
+    """
+    Test class for processing of logos of companies
+
+    ...
+
+    Methods
+    -------
+    setUp(self)
+        use temporary storage
+    upload_logo(self, name)
+        save JPEG logo to the storage
+    test_process(self)
+    test_changed_during_processing(self)
+    test_changed_logo(self)
+    """
+    def setUp(self):
+        """
+        Use temporary storage
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        storage_settings = override_settings(MEDIA_ROOT=media_root)
+        storage_settings.enable()
+        self.addCleanup(storage_settings.disable)
+
+    def upload_logo(self, name):
+        """
+        Saves big JPEG logo to the storage
+        :param name: name of the logo
+        :return: name of the saved logo
+        """
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', (2048, 1024), 'red').save(buffer, 'JPEG')
+        return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_process(self):
+        """
+        Logo is decoded to JPEG and WebP variants which are shared by the same content,
+        the uploaded logo stays the source of the next processing
+        """
+        from PIL import Image
+        first = Company.objects.create(name='First', image=self.upload_logo('logos/a.jpg'))
+        second = Company.objects.create(name='Second', image=self.upload_logo('logos/b.jpg'))
+        process_company_logo(first.id)
+        process_company_logo(second.id)
+        variants = {(variant.width, variant.image_format): variant.path
+                    for variant in first.logo_variants.all()}
+        self.assertEqual(set(variants), {(width, image_format) for width in (512, 256, 128)
+                                         for image_format in ('JPEG', 'WEBP')})
+        self.assertEqual(variants, {(variant.width, variant.image_format): variant.path
+                                    for variant in second.logo_variants.all()})
+        with default_storage.open(variants[(512, 'WEBP')]) as file:
+            image = Image.open(file)
+            self.assertEqual((image.format, image.size), ('WEBP', (512, 256)))
+        process_company_logo(first.id)
+        first.refresh_from_db()
+        self.assertEqual(first.image.name, 'logos/a.jpg')
+        self.assertEqual({variant.path for variant in first.logo_variants.all()},
+                         set(variants.values()))
+        self.assertEqual(first.get_logo_url(200, 'WEBP'),
+                         default_storage.url(variants[(256, 'WEBP')]))
+
+    def test_changed_during_processing(self):
+        """
+        Variants of the logo which is changed while it is processed are dropped
+        """
+        company = Company.objects.create(name='Company', image=self.upload_logo('logos/a.jpg'))
+
+        def build_and_change(company_id, name):
+            variants = build_variants(company_id, name)
+            Company.objects.filter(id=company_id).update(image='logos/new.jpg')
+            return variants
+
+        with mock.patch('apps.auth_.images.build_variants', side_effect=build_and_change):
+            process_company_logo(company.id)
+        self.assertFalse(company.logo_variants.exists())
+
+    def test_changed_logo(self):
+        """
+        Variants of the previous logo are not served, the company is picked up
+        by process_logos until its current logo is processed
+        """
+        processed = Company.objects.create(name='Processed', image='logos/a.png')
+        changed = Company.objects.create(name='Changed', image='logos/b.png')
+        for company in (processed, changed):
+            CompanyLogoVariant.objects.create(company=company, width=512, image_format='PNG',
+                                              path='logo_variants/a/512.png',
+                                              source=company.image.name, content_hash='a')
+        Company.objects.filter(id=changed.id).update(image='logos/new.png')
+        with mock.patch('apps.auth_.management.commands.process_logos.'
+                        'process_company_logo') as process:
+            call_command('process_logos', stdout=io.StringIO())
+        process.assert_called_once_with(changed.id)
+        drop_variants(changed.id)
+        changed.refresh_from_db()
+        self.assertTrue(changed.get_logo_url(256).endswith('logos/new.png'))
+
+
+class BenchmarkTestCase(TestCase):
+    """
+    Test class for comparison of benchmark results
+
+    ...
+
+    Methods
+    -------
+    test_percentile(self)
+    test_find_regressions(self)
+    """
+    def test_percentile(self):
+        """
+        Percentile is the nearest rank of sorted values
+        """
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_find_regressions(self):
+        """
+        Latency and allocations may grow by the threshold, queries may not grow,
+        new scenarios are skipped
+        """
+        baseline = {'scan': {'p95': 10, 'allocated_kb': 100, 'queries': 3}}
+        results = {'scan': {'p95': 11.9, 'allocated_kb': 119, 'queries': 3},
+                   'new': {'p95': 1000, 'allocated_kb': 1000, 'queries': 100}}
+        self.assertEqual(find_regressions(results, baseline, 0.2), [])
+        results['scan'] = {'p95': 13, 'allocated_kb': 100, 'queries': 4}
+        regressions = find_regressions(results, baseline, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('scan: queries 4 > 3'))
+        self.assertIn('p95', regressions[1])
+
+
+class StartupReportTestCase(TestCase):
+    """
+    Test class for the report of import time
+
+    ...
+
+    Methods
+    -------
+    test_parse_importtime(self)
+    """
+    IMPORTTIME_OUTPUT = (
+        'import time: self [us] | cumulative | imported package\n'
+        'import time:       312 |        312 |   _io\n'
+        'import time:       905 |       1217 | io\n'
+        'import time:        88 |         88 |     apps.auth_.phones\n'
+        'import time:      1205 |       4810 |   apps.auth_.models\n'
+        'Traceback of unrelated output\n'
+    )
+
+    def test_parse_importtime(self):
+        """
+        Self and cumulative microseconds and depth are read from -X importtime output,
+        other lines are skipped
+        """
+        self.assertEqual(parse_importtime(self.IMPORTTIME_OUTPUT), {
+            '_io': (312, 312, 1),
+            'io': (905, 1217, 0),
+            'apps.auth_.phones': (88, 88, 2),
+            'apps.auth_.models': (1205, 4810, 1),
+        })
+
+
+class PhoneTestCase(TestCase):
+    """
+    Test class for normalization of phones
+
+    ...
+
+    Methods
+    -------
+    test_normalize(self)
+    test_normalize_many(self)
+    test_login_phone(self)
+    test_legacy_login(self)
+    test_normalize_users(self)
+    """
+    def test_normalize(self):
+        """
+        Differently written phones are normalized to E.164, invalid ones are rejected
+        """
+        self.assertEqual(normalize_phone('+7 (701) 123-45-67'), '+77011234567')
+        self.assertEqual(normalize_phone('87011234567'), '+77011234567')
+        self.assertIsNone(normalize_phone('12345'))
+        self.assertIsNone(normalize_phone('phone'))
+        self.assertIsNone(normalize_phone(None))
+
+    def test_normalize_many(self):
+        """
+        Batch keeps order of phones
+        """
+        self.assertEqual(normalize_phones(['+77011234567', '', '8 701 123 45 67']),
+                         ['+77011234567', None, '+77011234567'])
+
+    def test_login_phone(self):
+        """
+        Phone of login is normalized like phones of provisioned employees, russian numbers
+        are accepted as before
+        """
+        serializer = PhoneSerializer(data={'phone': '8 701 123 45 67'})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(serializer.validated_data['phone'], '+77011234567')
+        self.assertEqual(normalize_phone('+7 916 123-45-67'), '+79161234567')
+
+    def test_legacy_login(self):
+        """
+        User saved with the phone as it was entered keeps the account on the next login
+        """
+        user = User.objects.create(username='87011234567', phone='87011234567')
+        found, created = User.objects.get_or_create_by_phone('+77011234567')
+        self.assertFalse(created)
+        self.assertEqual(found.pk, user.pk)
+        self.assertEqual(User.objects.get(pk=user.pk).username, '+77011234567')
+
+    def test_normalize_users(self):
+        """
+        Stored phones are normalized, users whose phone is taken by another user are kept
+        """
+        legacy = User.objects.create(username='8 701 123 45 67', phone='8 701 123 45 67')
+        User.objects.create(username='+77011234568', phone='+77011234568')
+        duplicate = User.objects.create(username='87011234568', phone='87011234568')
+        out = io.StringIO()
+        call_command('normalize_user_phones', sleep=0, stdout=out)
+        self.assertEqual(User.objects.get(pk=legacy.pk).username, '+77011234567')
+        self.assertEqual(User.objects.get(pk=duplicate.pk).username, '87011234568')
+        self.assertIn(str(duplicate.pk), out.getvalue())
+
+
+class ProvisioningTestCase(BaseTestCase):
+    """
+    Test class for bulk provisioning of employees
+
+    ...
+
+    Methods
+    -------
+    test_provision(self)
+    test_resync(self)
+    """
+    def setUp(self):
+        self.company = Company.objects.create(name='Partner')
+        self.discount = CompanyDiscount.objects.create(company=self.company, percent=10)
+        self.rows = [{'phone': '+7 (701) 000-00-{:02d}'.format(i), 'full_name': 'Test',
+                      'position': 'Cashier', 'is_employer': 'true',
+                      'discounts': str(self.discount.uuid)} for i in range(10)]
+
+    def provision(self, rows, **kwargs):
+        """
+        Provisions employees from the rows in CSV format
+        :param rows: rows of the roster
+        :return: counters of changes
+        """
+        lines = ['phone,full_name,position,is_employer,discounts'] + [
+            '"{phone}",{full_name},{position},{is_employer},{discounts}'.format(**row)
+            for row in rows]
+        return User.objects.bulk_provision(self.company,
+                                           read_roster(io.StringIO('\n'.join(lines)), 'csv'),
+                                           batch_size=4, **kwargs)
+
+    def test_provision(self):
+        """
+        Users, links and discounts are created with normalized phones
+        """
+        stats = self.provision(self.rows)
+        self.assertEqual(stats['created_users'], 10)
+        self.assertEqual(stats['added_discounts'], 10)
+        user = User.objects.get(username='+77010000003')
+        self.assertEqual(user.status, constants.EMPLOYEE)
+        self.assertFalse(user.has_usable_password())
+        self.assertEqual(list(user.user_companies.get().company_discount.all()),
+                         [self.discount])
+
+    def test_resync(self):
+        """
+        Re-sync changes only changed rows and prunes absent employees
+        """
+        self.provision(self.rows)
+        self.rows[0]['position'] = 'Manager'
+        stats = self.provision(self.rows[:-1], prune=True)
+        self.assertEqual(stats['created_users'], 0)
+        self.assertEqual(stats['updated_users'], 0)
+        self.assertEqual(stats['updated_links'], 1)
+        self.assertEqual(stats['added_discounts'], 0)
+        self.assertEqual(stats['pruned_links'], 1)
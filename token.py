@@ -1,24 +1,45 @@
 """
-File to return user their token
+File to return user their token, encode and decode tokens with cached secret of the user
 """
+import hashlib
+import time
+import uuid
 from calendar import timegm
 from datetime import datetime
 
+import jwt
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from rest_framework_jwt.settings import api_settings
 
+from apps.auth_.sessions import create_session, get_session_secret, is_revoked
+from apps.auth_.user_cache import get_jwt_secret, invalidate_user_on_commit
 
-def get_token(user):
+# seconds, concurrent refresh of the same token gets the token issued by the first one
+REFRESH_GRACE_PERIOD = getattr(settings, 'JWT_REFRESH_GRACE_PERIOD', 30)
+# seconds to wait for the token of the concurrent refresh which is not saved yet
+REFRESH_GRACE_WAIT = 0.5
+
+
+def get_token(user, device='', push_token=''):
     """
-    Return jwt token to user when aauthenticated
+    Return jwt token to user when aauthenticated. Each login gets its own session,
+    token contains sid of the session and is signed with its secret.
     :param user: user instance
     :type user: class MainUser
+    :param device: user agent of the device
+    :type device: str
+    :param push_token: push token of the device
+    :type push_token: str
     :return: jwt token
     :rtype: str
     """
     jwt_payload_handler = api_settings.JWT_PAYLOAD_HANDLER
-    jwt_encode_handler = api_settings.JWT_ENCODE_HANDLER
+    session = create_session(user, device, push_token)
     payload = jwt_payload_handler(user)
-    token = jwt_encode_handler(payload)
+    payload['sid'] = str(session.sid)
+    token = encode_with_secret(payload, session.secret)
     if api_settings.JWT_ALLOW_REFRESH:
         """
         TODO (Nurymzhan) These lines added for refresh token, without orig_iat field
@@ -29,3 +50,158 @@ def get_token(user):
             datetime.utcnow().utctimetuple()
         )
     return token
+
+
+def get_token_sid(token):
+    """
+    Returns sid of the session of the verified token
+    :param token: jwt token
+    :return: sid or None for tokens which are issued without session
+    :rtype: str
+    """
+    return jwt.decode(token, None, False).get('sid')
+
+
+def get_secret_key(payload):
+    """
+    Returns key to sign token. If secret key of the user is used, takes it from the cache
+    instead of loading the user from the database. Tokens of sessions are signed with
+    secrets of the sessions, revoked sessions are rejected.
+    Set JWT_AUTH['JWT_ENCODE_HANDLER'] and JWT_AUTH['JWT_DECODE_HANDLER'] to the functions
+    below to use it.
+    :param payload: payload of the token
+    :type payload: dict
+    :raises: :class:`jwt.InvalidTokenError`: user or session of the token doesn't exist
+    or the session is revoked
+    :return: secret key
+    :rtype: str
+    """
+    sid = payload.get('sid')
+    if sid is not None:
+        if is_revoked(sid):
+            raise jwt.InvalidTokenError('Session is revoked')
+        if not api_settings.JWT_GET_USER_SECRET_KEY:
+            return api_settings.JWT_SECRET_KEY
+        session = get_session_secret(sid)
+        if session is None or session[0] != payload.get('user_id'):
+            raise jwt.InvalidTokenError('Session does not exist')
+        return str(session[1])
+    if not api_settings.JWT_GET_USER_SECRET_KEY:
+        return api_settings.JWT_SECRET_KEY
+    secret = get_jwt_secret(payload.get('user_id'))
+    if secret is None:
+        raise jwt.InvalidTokenError('User does not exist')
+    return str(secret)
+
+
+def jwt_encode_handler(payload):
+    """
+    Encodes payload to the token
+    :param payload: payload of the token
+    :type payload: dict
+    :return: jwt token
+    :rtype: str
+    """
+    key = api_settings.JWT_PRIVATE_KEY or get_secret_key(payload)
+    return jwt.encode(payload, key, api_settings.JWT_ALGORITHM).decode('utf-8')
+
+
+def jwt_decode_handler(token):
+    """
+    Verifies the token and returns its payload
+    :param token: jwt token
+    :type token: str
+    :return: payload of the token
+    :rtype: dict
+    """
+    options = {
+        'verify_exp': api_settings.JWT_VERIFY_EXPIRATION,
+    }
+    # get user from token, BEFORE verification, to get user secret key
+    unverified_payload = jwt.decode(token, None, False)
+    secret_key = get_secret_key(unverified_payload)
+    return jwt.decode(
+        token,
+        api_settings.JWT_PUBLIC_KEY or secret_key,
+        api_settings.JWT_VERIFY,
+        options=options,
+        leeway=api_settings.JWT_LEEWAY,
+        audience=api_settings.JWT_AUDIENCE,
+        issuer=api_settings.JWT_ISSUER,
+        algorithms=[api_settings.JWT_ALGORITHM]
+    )
+
+
+def encode_with_secret(payload, secret):
+    """
+    Encodes payload with the given secret of the user, so the new secret is not looked up
+    right after it is changed
+    :param payload: payload of the token
+    :type payload: dict
+    :param secret: jwt secret of the user or of the session
+    :type secret: UUID
+    :return: jwt token
+    :rtype: str
+    """
+    if not api_settings.JWT_GET_USER_SECRET_KEY:
+        return jwt_encode_handler(payload)
+    key = api_settings.JWT_PRIVATE_KEY or str(secret)
+    return jwt.encode(payload, key, api_settings.JWT_ALGORITHM).decode('utf-8')
+
+
+def rotate_secret(user_id, old_secret):
+    """
+    Changes jwt secret of the user only if it is still the secret which the refreshed
+    token is signed with (compare and set), so only one of concurrent refreshes wins
+    :param user_id: id of the user
+    :type user_id: int
+    :param old_secret: secret of the refreshed token
+    :type old_secret: UUID or str
+    :return: new secret or None if the secret is already changed
+    :rtype: UUID
+    """
+    new_secret = uuid.uuid4()
+    updated = get_user_model().objects.filter(pk=user_id, jwt_secret=old_secret) \
+        .update(jwt_secret=new_secret)
+    invalidate_user_on_commit(user_id)
+    return new_secret if updated else None
+
+
+def get_refresh_grace_key(token):
+    """
+    Returns key of the token issued by refresh of the given token
+    :param token: refreshed token
+    :type token: str
+    :rtype: str
+    """
+    return 'jwt_refresh:{}'.format(hashlib.sha256(token.encode('utf-8')).hexdigest())
+
+
+def remember_refreshed_token(token, new_token):
+    """
+    Keeps the issued token for the concurrent refreshes of the same token
+    :param token: refreshed token
+    :type token: str
+    :param new_token: issued token
+    :type new_token: str
+    """
+    cache.set(get_refresh_grace_key(token), new_token, REFRESH_GRACE_PERIOD)
+
+
+def get_refreshed_token(token, wait=0):
+    """
+    Returns token which is issued by recent refresh of the given token
+    :param token: refreshed token
+    :type token: str
+    :param wait: seconds to wait for the token if it is not saved yet
+    :type wait: float
+    :return: issued token or None
+    :rtype: str
+    """
+    key = get_refresh_grace_key(token)
+    deadline = time.monotonic() + wait
+    while True:
+        new_token = cache.get(key)
+        if new_token is not None or time.monotonic() >= deadline:
+            return new_token
+        time.sleep(0.05)
@@ -5,8 +5,8 @@ from django.conf.urls import url
 from rest_framework.routers import DefaultRouter
 
 from apps.auth_.views import (UserViewSet, ActivationViewSet,
-                              TokenView, RefreshTokenView)
-from apps.auth_.views.user import UserDetail
+                              TokenView, RefreshTokenView, MetricsView)
+from apps.auth_.views.user import UserDetail, QrImage, UserLookup
 
 jwt_token = TokenView.as_view()
 refresh_jwt_token = RefreshTokenView.as_view()
@@ -14,9 +14,12 @@ refresh_jwt_token = RefreshTokenView.as_view()
 app_name = 'auth_'
 
 urlpatterns = [
-    url(r'^api-token-auth/', jwt_token),
-    url(r'^api-token-refresh/', refresh_jwt_token),
-    url(r'^user/info/(?P<code>[\w-]+)', UserDetail.as_view()),
+    url(r'^api-token-auth/', jwt_token, name='token-auth'),
+    url(r'^api-token-refresh/', refresh_jwt_token, name='token-refresh'),
+    url(r'^user/info/(?P<code>[\w-]+)', UserDetail.as_view(), name='user-info'),
+    url(r'^user/lookup/$', UserLookup.as_view(), name='user-lookup'),
+    url(r'^user/qr/(?P<code>[\w-]+)\.png$', QrImage.as_view(), name='qr-image'),
+    url(r'^metrics/$', MetricsView.as_view(), name='metrics'),
 ]
 
 router = DefaultRouter()
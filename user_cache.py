@@ -0,0 +1,103 @@
+"""
+Cache of users for authentication in the shared django cache. Keeps jwt secret and slim
+projection of the user, so authenticated requests don't load the user from the database.
+Jwt secret and activity must be seen by all processes as soon as they are changed, so
+users are not kept in the memory of the process, which other processes can't evict.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from apps.auth_.instrumentation import record_cache
+
+USER_CACHE_TIMEOUT = getattr(settings, 'USER_CACHE_TIMEOUT', 60 * 60)
+USER_PROJECTION_FIELDS = ('id', 'username', 'phone', 'email', 'full_name', 'avatar_url',
+                          'status', 'is_active', 'is_staff', 'is_admin', 'is_superuser',
+                          'is_registered', 'birth_date', 'jwt_secret')
+
+
+def get_cache_key(user_id):
+    """
+    Returns key of the user in the shared cache
+    :param user_id: id of the user
+    :return: key of the cache
+    :rtype: str
+    """
+    return 'auth_user:{}'.format(user_id)
+
+
+def get_user_projection(user_id):
+    """
+    Returns fields of the user which are needed for authentication.
+    Looks up shared cache and then the database.
+    :param user_id: id of the user
+    :type user_id: int
+    :return: values of USER_PROJECTION_FIELDS or None if there is no such user
+    :rtype: dict
+    """
+    key = get_cache_key(user_id)
+    projection = cache.get(key)
+    record_cache('user_shared', projection is not None)
+    if projection is None:
+        projection = get_user_model().objects.filter(pk=user_id) \
+            .values(*USER_PROJECTION_FIELDS).first()
+        if projection is None:
+            return None
+        cache.set(key, projection, USER_CACHE_TIMEOUT)
+    return projection
+
+
+def get_jwt_secret(user_id):
+    """
+    Returns jwt secret of the user
+    :param user_id: id of the user
+    :type user_id: int
+    :return: jwt secret or None if there is no such user
+    :rtype: UUID
+    """
+    projection = get_user_projection(user_id)
+    if projection is None:
+        return None
+    return projection['jwt_secret']
+
+
+def get_cached_user(user_id):
+    """
+    Returns user instance built from the cached projection. Other fields are deferred
+    and are loaded from the database only if they are accessed.
+    :param user_id: id of the user
+    :type user_id: int
+    :return: user or None if there is no such user
+    :rtype: class MainUser
+    """
+    projection = get_user_projection(user_id)
+    if projection is None:
+        return None
+    user_model = get_user_model()
+    fields = [field.attname for field in user_model._meta.concrete_fields
+              if field.attname in projection]
+    return user_model.from_db(DEFAULT_DB_ALIAS, fields,
+                              [projection[field] for field in fields])
+
+
+def invalidate_user(user_id):
+    """
+    Removes the user from the cache. Must be called when jwt secret or cached fields
+    of the user are changed.
+    :param user_id: id of the user
+    :type user_id: int
+    """
+    cache.delete(get_cache_key(user_id))
+
+
+def invalidate_user_on_commit(user_id):
+    """
+    Removes the user from the cache now and once more after commit of the current
+    transaction, so the row which is read by concurrent request before the commit
+    doesn't stay in the cache.
+    :param user_id: id of the user
+    :type user_id: int
+    """
+    invalidate_user(user_id)
+    transaction.on_commit(lambda: invalidate_user(user_id))
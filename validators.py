@@ -1,19 +1,20 @@
 """
 Validators needed to auth_ app
 """
+from apps.auth_.phones import is_valid_phone
 from apps.utils import messages
-from apps.utils.string_utils import valid_phone
 from django.core.exceptions import ValidationError
 
 
 def phone_validator(phone):
     """
     Validator for phone number. Checks the phone that the number exists and correct mobile operator.
+    Results are memoized, see apps.auth_.phones.
     :param phone: phone number of user
     :type phone: str
     :raises: :class:`ValidationError`: phone number is invalid
     """
-    if not valid_phone(phone):
+    if not is_valid_phone(phone):
         raise ValidationError(messages.PHONE_INVALID)
 
 
@@ -1,3 +1,4 @@
 from .user import UserViewSet, User  # noqa
 from .activation import ActivationViewSet  # noqa
 from .token import TokenView, RefreshTokenView  # noqa
+from .metrics import MetricsView  # noqa
@@ -3,7 +3,9 @@ File to keep viewsets for activation.
 """
 from django.utils.decorators import method_decorator
 
+from apps.auth_.instrumentation import instrument
 from apps.auth_.models import Activation
+from apps.auth_.ratelimit import check_activation_rate, get_client_ip
 from apps.auth_.serializers import ActivationCodeSerializer, PhoneSerializer, \
     ActivationSerializer, UserSerializer
 from apps.auth_.token import get_token
@@ -16,6 +18,7 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
 
+@method_decorator(instrument(), name='dispatch')
 @method_decorator(response_wrapper(), name='dispatch')
 class ActivationViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     """
@@ -59,9 +62,12 @@ class ActivationViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         """
         serializer = PhoneSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        activation = Activation.objects.generate(
-            phone=serializer.validated_data['phone'],
-            activation_type=LOGIN)
+        phone = serializer.validated_data['phone']
+        check_activation_rate(LOGIN, phone=phone, ip=get_client_ip(request))
+        activation_id = Activation.objects.get_recent_id(phone, LOGIN)
+        if activation_id is not None:
+            return Response({'activation': {'id': activation_id, 'phone': phone}})
+        activation = Activation.objects.generate(phone=phone, activation_type=LOGIN)
         return Response({'activation': ActivationSerializer(activation).data})
 
     @action(methods=['post'], detail=True, permission_classes=[AllowAny])
@@ -78,8 +84,8 @@ class ActivationViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         activation.is_valid(raise_exception=True,
                             data=serializer.validated_data)
         user, created = activation.complete(request=request)
-        user.save()
-        token = get_token(user)
+        token = get_token(user, device=request.META.get('HTTP_USER_AGENT', ''),
+                          push_token=serializer.validated_data.get('push_token', ''))
         return Response({'token': token,
                          'user': UserSerializer(user).data,
                          'new_user': created})
@@ -92,7 +98,9 @@ class ActivationViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         :param pk: id of Activation object
         :return: activation with pk and changed data
         """
+        check_activation_rate(LOGIN, ip=get_client_ip(request))
         activation = self.get_object()
         activation.is_valid(raise_exception=True, check_iteration=True)
+        check_activation_rate(activation.activation_type, phone=activation.phone)
         activation.send_sms()
         return Response({'activation': ActivationSerializer(activation).data})
@@ -0,0 +1,42 @@
+"""
+View which exposes metrics of all processes of the service for Prometheus.
+"""
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views import View
+
+from apps.auth_.instrumentation import registry
+
+# token of the scraper, without it metrics are available only for staff
+METRICS_TOKEN = getattr(settings, 'METRICS_TOKEN', None)
+
+
+class MetricsView(View):
+    """
+    Returns metrics of views and caches in Prometheus text format.
+
+    ...
+
+    Methods
+    -------
+    get(self, request)
+        returns metrics if scraper's token is valid or user is staff
+    """
+
+    def has_access(self, request):
+        """
+        Checks bearer token of the scraper or staff status of the user
+        :param request: django request
+        :rtype: bool
+        """
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        if METRICS_TOKEN and header.startswith('Bearer '):
+            return constant_time_compare(header[len('Bearer '):], METRICS_TOKEN)
+        return request.user.is_authenticated and request.user.is_staff
+
+    def get(self, request):
+        if not self.has_access(request):
+            return HttpResponseForbidden()
+        return HttpResponse(registry.render(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -6,6 +6,7 @@ from django.utils.decorators import method_decorator
 from rest_framework.response import Response
 from rest_framework_jwt.views import ObtainJSONWebToken, \
     jwt_response_payload_handler, RefreshJSONWebToken
+from apps.auth_.instrumentation import instrument
 from apps.auth_.serializers import CustomRefreshJSONWebTokenSerializer
 
 from apps.utils import messages
@@ -16,6 +17,7 @@ from django.utils.translation import gettext as _
 User = get_user_model()
 
 
+@method_decorator(instrument(), name='dispatch')
 @method_decorator(response_wrapper(), name='dispatch')
 class TokenView(ObtainJSONWebToken):
     def post(self, request, *args, **kwargs):
@@ -30,6 +32,7 @@ class TokenView(ObtainJSONWebToken):
         raise CommonException(detail=_(messages.BAD_DATA))
 
 
+@method_decorator(instrument(), name='dispatch')
 @method_decorator(response_wrapper(), name='dispatch')
 class RefreshTokenView(RefreshJSONWebToken):
     serializer_class = CustomRefreshJSONWebTokenSerializer
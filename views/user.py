@@ -1,25 +1,38 @@
 """
 File of viewsets for user login, change profile, logout, user detail
 """
-import uuid
-
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import patch_cache_control, get_conditional_response
+from django.utils.http import parse_etags, http_date
 from django.utils.decorators import method_decorator
+from django.views import View
 from rest_framework import viewsets, generics
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.response import Response
 
-from apps.auth_.models import FanDiscount
-from apps.auth_.serializers import (RegistrationSerializer,
+from apps.auth_.discounts import (resolve_discounts, resolve_discounts_bulk,
+                                  get_discount_version)
+from apps.auth_.instrumentation import instrument, record_cache
+from apps.auth_.qr import (get_user_code, get_code_user_id, get_etag, get_image,
+                           get_image_path, get_qr_model)
+from apps.auth_.ratelimit import check_lookup_rate, get_client_ip
+from apps.auth_.serializers import (RegistrationSerializer, QrCodesSerializer,
                                     UserSerializer, UserProfileSerializer)
-from apps.utils import constants
+from apps.auth_.sessions import revoke_session, delete_push_tokens
+from apps.auth_.token import get_token_sid
 from apps.utils.decorators import response_wrapper
 
 User = get_user_model()
 
 
+@method_decorator(instrument(), name='dispatch')
 @method_decorator(response_wrapper(), name='dispatch')
 class UserViewSet(viewsets.GenericViewSet):
     """
@@ -91,33 +104,36 @@ class
     @action(methods=['get'], detail=False)
     def logout(self, request):
         """
-        Simulation of logout, delete all push tokens of user to don't send push when user logout
+        Logout from the device: session of the token is revoked and push tokens of
+        the device (push_token param or token saved in the session) are deleted to don't
+        send push when user logout
         :return:
         """
-        # TODO: maybe several devices?
-        request.user.push_tokens.all().delete()
+        sid = get_token_sid(request.auth) if request.auth else None
+        if sid is not None:
+            revoke_session(sid)
+        delete_push_tokens(request.user, sid, request.query_params.get('push_token'))
         return Response({})
 
     @action(methods=['get', ], detail=False)
     def get_qr(self, request):
         """
-        Return qr code of user if exists or create new and set to the user
-        :return: qr of user
+        Return qr code of user if exists or create new and set to the user.
+        Url points to the pre-rendered image (user/qr/<code>.png) instead of
+        QrUserImage.get_url, QR encodes absolute url of the scan page of the user
+        :return: url of the qr image of user
         """
-        try:
-            qrcode = request.user.qrcode
-            uuid_str = qrcode.code
-        except Exception:
-            uuid_str = uuid.uuid4()
-            qrcode = QrUserImage.objects.create(user=request.user,
-                                                code=uuid_str)
-
-        return Response({'qr': qrcode.get_url(uuid_str)})
+        code = get_user_code(request.user, request)
+        return Response({'qr': request.build_absolute_uri(
+            reverse('auth_:qr-image', kwargs={'code': code}))})
 
 
+@method_decorator(instrument(), name='dispatch')
 class UserDetail(generics.RetrieveAPIView):
     """
-    Class which render template and send to template discounts of user and where they work
+    Class which render template and send to template discounts of user and where they work.
+    Page is versioned by the version of the user's discounts: terminals which scan the same
+    user again get 304, rendered page is cached for the version.
 
     ...
 
@@ -129,6 +145,18 @@ class UserDetail(generics.RetrieveAPIView):
     renderer_classes = [TemplateHTMLRenderer]
     permission_classes = (AllowAny,)
     template_name = 'user/info.html'
+    FRAGMENT_TIMEOUT = 24 * 60 * 60
+
+    def render_page(self, request, code, user_id):
+        """
+        Renders the page with code, user, company name, position and discounts with companies
+        :return: html of the page
+        :rtype: str
+        """
+        user = User.objects.get(id=user_id)
+        data = resolve_discounts(user)
+        return render_to_string(self.template_name, {'code': code, 'user': user, **data},
+                                request=request)
 
     def get(self, request, code):  # noqa
         """
@@ -137,44 +165,95 @@ class UserDetail(generics.RetrieveAPIView):
         :param code: code of user by what qr image made
         :return: data of user related to discounts
         """
-        qr = QrUserImage.objects.get(code=code)
-        user = qr.user
-        user_companies = user.user_companies.all()
-        company_name = ""
-        company_position = ""
-        company_discounts = {}
-        if user.status == constants.EMPLOYEE:
-            for user_company in user_companies:
-                for company_discount in user_company.company_discount.all():
-                    if company_discount.percent != 0 or \
-                            company_discount.amount != 0:
-                        temp = {'percent': company_discount.percent,
-                                'amount': company_discount.amount,
-                                'description': company_discount.description}
-                        if not temp['description']:
-                            temp['description'] = ''
-                        if company_discount.company not in company_discounts.keys():
-                            company_discounts[company_discount.company] = [temp]
-                        else:
-                            company_discounts[company_discount.company].append(temp)
-                if user_company.isEmployer:
-                    company_name = user_company.company.name
-                    company_position = user_company.position
-        else:
-            for discount in FanDiscount.objects.all():
-                for company_discount in discount.company_discounts.all():
-                    if company_discount.percent != 0 or \
-                            company_discount.amount != 0:
-                        temp = {'percent': company_discount.percent,
-                                'amount': company_discount.amount,
-                                'description': company_discount.description}
-                        if not temp['description']:
-                            temp['description'] = ''
-                        if company_discount.company not in company_discounts.keys():
-                            company_discounts[company_discount.company] = [temp]
-                        else:
-                            company_discounts[company_discount.company].append(temp)
-        return Response({'code': code, 'user': user,
-                         'company_name': company_name,
-                         'company_position': company_position,
-                         'company_discounts': company_discounts})
+        user_id = get_code_user_id(code)
+        if user_id is None:
+            raise Http404
+        user_version, catalog_version = get_discount_version(user_id)
+        etag = '"{}-{}-{}"'.format(code, user_version, catalog_version)
+        last_modified = max(user_version, catalog_version) // 1000
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            key = 'user_info:{}:{}:{}'.format(code, user_version, catalog_version)
+            content = cache.get(key)
+            record_cache('user_info', content is not None)
+            if content is None:
+                content = self.render_page(request, code, user_id)
+                cache.set(key, content, self.FRAGMENT_TIMEOUT)
+            response = HttpResponse(content)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+@method_decorator(instrument(), name='dispatch')
+class QrImage(View):
+    """
+    Serves QR image of the user. Image of the code never changes, so it is cached
+    by clients forever and is validated by strong ETag without touching the storage.
+
+    ...
+
+    Methods
+    -------
+    get(self, request, code)
+        returns PNG image or 304 if client has it
+    """
+    CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+    def set_headers(self, response, code):
+        response['ETag'] = get_etag(code)
+        patch_cache_control(response, public=True, max_age=self.CACHE_MAX_AGE, immutable=True)
+        return response
+
+    def get(self, request, code):
+        """
+        Return QR image by code, it is rendered if pre-rendering hasn't finished yet
+        :param request:
+        :param code: code of user by what qr image made
+        :return: PNG image
+        """
+        etag = get_etag(code)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return self.set_headers(HttpResponseNotModified(), code)
+        if not default_storage.exists(get_image_path(code)) and \
+                not get_qr_model().objects.filter(code=code).exists():
+            raise Http404
+        return self.set_headers(HttpResponse(get_image(code, request),
+                                             content_type='image/png'), code)
+
+
+@method_decorator(instrument(), name='dispatch')
+@method_decorator(response_wrapper(), name='dispatch')
+class UserLookup(generics.GenericAPIView):
+    """
+    Returns data of the scan page for many QR codes at once, for terminals of partners.
+
+    ...
+
+    Methods
+    -------
+    post(self, request)
+        return company name, position and discounts by codes
+    """
+    permission_classes = (AllowAny,)
+    serializer_class = QrCodesSerializer
+
+    def post(self, request):
+        """
+        Return company name, position and discounts with companies of each code,
+        unknown codes get null. Users are resolved by a fixed number of queries.
+        Looked up codes are limited by client ip.
+        :param request: request with list of codes
+        :return: data of users by codes
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        codes = list(dict.fromkeys(serializer.validated_data['codes']))
+        check_lookup_rate(get_client_ip(request), len(codes))
+        users = {str(code): (user_id, status) for code, user_id, status in
+                 get_qr_model().objects.filter(code__in=codes)
+                 .values_list('code', 'user_id', 'user__status')}
+        data = resolve_discounts_bulk(dict(users.values()))
+        return Response({'users': {code: data[users[code][0]] if code in users else None
+                                   for code in codes}})